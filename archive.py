@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Contains functions for archiving fetched pages and replaying them
+
+import gzip
+import hashlib
+import sqlite3
+import threading
+from datetime import datetime
+from pathlib import Path
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
+## Archive settings
+
+archive_path = None # directory of the archive, None if not archiving
+replay = False # read pages from the archive instead of the network
+archive_conn = None
+archive_lock = threading.Lock()
+
+## Functions
+
+def set_archive(path, replay_only=False):
+	""" write every fetched page through to an archive in path
+	:param path: directory of the archive, created if needed
+	:param replay_only: read pages from the archive and never use the network
+	:return: nothing
+	"""
+	global archive_path, archive_conn, replay
+	path = Path(path)
+	path.mkdir(parents=True, exist_ok=True)
+	with archive_lock:
+		if archive_conn:
+			archive_conn.close()
+		archive_conn = sqlite3.connect(str(path / "archive.db"), timeout=60, check_same_thread=False)
+		set_up_archive_db(archive_conn)
+		archive_path = path
+		replay = replay_only
+
+def close_archive():
+	""" stop archiving pages and leave replay mode
+	:return: nothing
+	"""
+	global archive_path, archive_conn, replay
+	with archive_lock:
+		if archive_conn:
+			archive_conn.close()
+		archive_conn = None
+		archive_path = None
+		replay = False
+
+def set_up_archive_db(conn):
+	""" sets up the index of archived pages
+		if the table doesn't exists, create it
+	:param conn: database connection
+	:return: nothing
+	"""
+	cur = conn.cursor()
+	cur.executescript('''
+		CREATE TABLE IF NOT EXISTS pages(
+			id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT UNIQUE,
+			url TEXT,
+			fetched TEXT,
+			status INTEGER,
+			digest TEXT,
+			codec TEXT
+		);
+		CREATE INDEX IF NOT EXISTS pages_url ON pages(url, fetched);
+		CREATE INDEX IF NOT EXISTS pages_digest ON pages(digest);
+	''')
+	conn.commit()
+
+def compress(content):
+	""" compress page content with zstd if installed, else gzip
+	:param content: bytes of page
+	:return: (codec name, compressed bytes)
+	"""
+	if zstandard:
+		return "zst", zstandard.ZstdCompressor(level=10).compress(content)
+	return "gz", gzip.compress(content)
+
+def decompress(codec, data):
+	""" decompress archived page content
+	:param codec: codec the content was written with
+	:param data: compressed bytes
+	:return: bytes of page
+	"""
+	if codec == "zst":
+		return zstandard.ZstdDecompressor().decompress(data)
+	return gzip.decompress(data)
+
+def blob_path(digest, codec):
+	""" path of the file holding the content with this digest
+	:param digest: sha256 hex digest of the content
+	:param codec: codec the content was written with
+	:return: path of blob
+	"""
+	return archive_path / digest[:2] / "{}.{}".format(digest, codec)
+
+def archive_page(url, status, content):
+	""" add a fetched page to the archive
+	:param url: url of page
+	:param status: http status code
+	:param content: bytes of page
+	:return: nothing
+	:note: blobs are named by the hash of their content,
+		so a page that did not change is only stored once
+	"""
+	digest = hashlib.sha256(content).hexdigest()
+	fetched = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+	with archive_lock:
+		row = archive_conn.execute(''' SELECT codec FROM pages WHERE digest=? LIMIT 1 ''', (digest,)).fetchone()
+	if row:
+		codec = row[0]
+	else:
+		codec, data = compress(content)
+		fn = blob_path(digest, codec)
+		fn.parent.mkdir(exist_ok=True)
+		fn.write_bytes(data)
+	sql = '''
+		INSERT INTO pages(url, fetched, status, digest, codec)
+		VALUES(?,?,?,?,?)
+	'''
+	with archive_lock:
+		archive_conn.execute(sql, (url, fetched, status, digest, codec))
+		archive_conn.commit()
+
+def read_page(url):
+	""" read the latest archived copy of a page
+	:param url: url of page
+	:return: bytes of page or None if it was never archived
+	"""
+	with archive_lock:
+		sql = ''' SELECT digest, codec FROM pages WHERE url=? ORDER BY fetched DESC, id DESC LIMIT 1 '''
+		row = archive_conn.execute(sql, (url,)).fetchone()
+	if not row:
+		return None
+	(digest, codec) = row
+	return decompress(codec, blob_path(digest, codec).read_bytes())
+
+def archived_urls(prefix=""):
+	""" list the urls in the archive
+	:param prefix: only urls starting with prefix
+	:return: sorted list of urls
+	"""
+	with archive_lock:
+		sql = ''' SELECT DISTINCT url FROM pages WHERE substr(url, 1, ?)=? ORDER BY url '''
+		rows = archive_conn.execute(sql, (len(prefix), prefix)).fetchall()
+	return [row[0] for row in rows]
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Contains functions for cleaning the text of posts and marking
+# probable spam, from notebooks 1.2 (youbemom) and 1.5 (netmums)
+
+import re
+import warnings
+import numpy as np
+from spam import SpamMatcher, get_spam_rules
+
+# str.contains only needs to know whether the url and email patterns match;
+# the notebooks silenced this warning, and the stage's workers don't run them
+warnings.filterwarnings("ignore", "This pattern is interpreted as a regular expression, and has match groups")
+
+## Regex Patterns
+
+### Youbemom
+
+# old pattern = r'(http|ftp|https):\/\/[-a-zA-Z0-9@:%._\+~#=]{1,256}\.[a-zA-Z0-9()]{1,6}\b([-a-zA-Z0-9()@:%_\+.~#?&//=]*)'
+url_pattern = r'''((http|ftp|https):\/\/)[-a-zA-Z0-9:%\._\+~#=]{1,256}\.[a-zA-Z0-9\(\)]{1,8}\b([-a-zA-Z0-9<>\*\^\(\)@:%\!,\[\]\{\}\|'"_\+\.~#\?&/=]*)|(www\.)*[-a-zA-Z0-9@:%\._\+~#=]{1,256}\.(com|be|io|org|net)\b([-a-zA-Z0-9<>\*\^\(\)@:%\!,\[\]\{\}\|'"_\+\.~#\?&/=]*)'''
+url_cutoff_pattern = r'''((http|ftp|https):\/\/)[-a-zA-Z0-9:%\._\+~#=]{1,256}'''
+email_pattern = r'([-a-zA-Z0-9_\.\+]+@[-a-zA-Z0-9]+\.[-a-zA-Z0-9\.]+)'
+large_number_pattern = r'\b[\+\-x0-9]*\d{9,}(?<!0{7})\b'
+subject_pattern = r'- no subject -'
+alpha_pattern = r'[a-zA-Z]'
+lonely_number_pattern = r'^[0-9]+$'
+non_punctuation_pattern = r'[-\w\s\.,/:;!\?\'\"’]'
+
+### Netmums
+
+sent_from_pattern = r'sent from my [^\s]+ using [^\s]+'
+link_pattern = r'::link_[0-9]*::'
+
+## Spam matchers, built once per process for each list of spam words
+
+matchers = {}
+
+## Functions for youbemom
+
+def create_text(df):
+	""" creates text column from
+		title and body
+	:param df: data frame
+	:return df: formatted data frame
+	"""
+	df['title'] = df['title'].replace('This post has been deleted\.', '', regex=True)
+	df['text'] = df['title'] + " " + df['body']
+	return df
+
+def has_url(df):
+	""" finds urls in text strings and creates
+		new column of whether text has a url
+	:param df: data frame
+	:return df: formatted data frame
+	"""
+	regex_pat = re.compile(url_pattern, flags=re.IGNORECASE)
+	df['has_url'] = df['text'].str.contains(regex_pat)
+	regex_pat = re.compile(url_cutoff_pattern, flags=re.IGNORECASE)
+	df['has_cutoff_url'] = df['text'].str.contains(regex_pat)
+	return df
+
+def remove_urls(df):
+	""" removes urls and cutoff urls from text strings and creates
+		new column of text without urls
+	:param df: data frame
+	:return df: formatted data frame
+	"""
+	regex_pat = re.compile(url_pattern, flags=re.IGNORECASE)
+	df['text_clean'] = df['text'].str.replace(regex_pat, "", regex=True)
+	regex_pat = re.compile(url_cutoff_pattern, flags=re.IGNORECASE)
+	df['text_clean'] = df['text_clean'].str.replace(regex_pat, "", regex=True)
+	df['text_clean'] = df['text_clean'].str.strip()
+	return df
+
+def remove_no_subject(df):
+	""" removes - no subject - from clean text strings
+	:param df: data frame
+	:return df: formatted data frame
+	"""
+	regex_pat = re.compile(subject_pattern, flags=re.IGNORECASE)
+	df['text_clean'] = df['text_clean'].str.replace(regex_pat, "", regex=True)
+	df['text_clean'] = df['text_clean'].str.strip()
+	return df
+
+def has_email(df):
+	regex_pat = re.compile(email_pattern, flags=re.IGNORECASE)
+	df['has_email'] = df['text'].str.contains(regex_pat)
+	return df
+
+def has_large_number(df):
+	regex_pat = re.compile(large_number_pattern, flags=re.IGNORECASE)
+	df['has_large_number'] = df['text_clean'].str.contains(regex_pat)
+	return df
+
+def has_alpha(df):
+	regex_pat = re.compile(alpha_pattern, flags=re.IGNORECASE)
+	df['has_alpha'] = df['text_clean'].str.contains(regex_pat)
+	return df
+
+def replace_lonely_numbers(df):
+	regex_pat = re.compile(lonely_number_pattern, flags=re.IGNORECASE)
+	df['text_clean'] = df['text_clean'].str.replace(regex_pat, "", regex=True)
+	df['text_clean'] = df['text_clean'].str.strip()
+	return df
+
+def count_non_punctuation(df):
+	regex_pat = re.compile(non_punctuation_pattern, flags=re.IGNORECASE)
+	df['n_symbols'] = df['text_clean'].str.replace(regex_pat, "", regex=True).str.len()
+	return df
+
+def process_text(df):
+	df = create_text(df)
+	df = has_url(df)
+	df = remove_urls(df)
+	df = has_email(df)
+	df = has_large_number(df)
+	df = remove_no_subject(df)
+	df = count_non_punctuation(df)
+	df['text_length'] = df['text'].str.len()
+	df['text_clean_length'] = df['text_clean'].str.len()
+	return df
+
+def add_spam_dummies(df, words):
+	""" adds a column per spam word and rule, in one pass over the text
+	:param df: data frame
+	:param words: list of spam word patterns, from spam_words.csv
+	:return df: data frame with the spam columns
+	"""
+	key = tuple(words)
+	if key not in matchers:
+		matchers[key] = SpamMatcher(get_spam_rules(words))
+	return matchers[key].add_columns(df)
+
+def probable_spam(df):
+	df['probable_spam'] = (
+		(df.vashikaran) |
+		((~df.has_url) & df.has_large_number & df.text_length > 900) |
+		((~df.has_url) & df.has_large_number & df.n_symbols > 10) |
+		((~df.has_url) & df.has_large_number & df["problem.solution"]) |
+		(df.has_url & df.vs & df.stream) |
+		(df.has_url & df["s.t.r.e.a.m"]) |
+		(df.has_url & df.has_large_number) |
+		(df.has_url & df["visit.here"]) |
+		(df.has_url & df["visit.at"]) |
+		(df.has_url & df["amino.app"]) |
+		(df.has_url & df["male.enhancement"]) |
+		(df.has_url & df.testosterone) |
+		(df.has_url & df["visit.us.at"]) |
+		(df.has_url & df["cbd.oil"]) |
+		(df.has_url & df.Http) |
+		(df.has_url & df.bracket_url) |
+		(df.has_url & df.keto & df.text_length > 320) |
+		(df.has_url & df.supplement & df.text_length > 320) |
+		(df.has_url & df.pills & df.text_length > 320)
+	) & (
+		(~df.has_dd) & (~df.has_dh) & (~df.has_ds)
+	)
+	return df
+
+def clean_youbemom(df, words):
+	""" the text table of a chunk of youbemom posts, as process_data
+		in notebook 1.2
+	:param df: data frame of message_id, title, body
+	:param words: list of spam word patterns, from spam_words.csv
+	:return df: data frame of message_id, text, text_clean, probable_spam
+	"""
+	df = process_text(df)
+	df = add_spam_dummies(df, words)
+	df = probable_spam(df)
+	return df[['message_id', 'text', 'text_clean', 'probable_spam']]
+
+## Functions for netmums
+
+def remove_sent_from(df):
+	""" removes sent from information from clean text strings
+	:param df: data frame
+	:return df: formatted data frame
+	"""
+	regex_pat = re.compile(sent_from_pattern, flags=re.IGNORECASE)
+	df['text_clean'] = df['text_clean'].str.replace(regex_pat, "", regex=True)
+	df['text_clean'] = df['text_clean'].str.strip()
+	return df
+
+def remove_links(df):
+	""" removes link substitutions from clean text strings
+	:param df: data frame
+	:return df: formatted data frame
+	"""
+	regex_pat = re.compile(link_pattern, flags=re.IGNORECASE)
+	df['text_clean'] = df['text_clean'].str.replace(regex_pat, "", regex=True)
+	df['text_clean'] = df['text_clean'].str.strip()
+	return df
+
+def drop_emptys(df):
+	df['text_clean'] = df['text_clean'].replace('', np.nan)
+	df = df.dropna(subset=['text_clean'])
+	return df
+
+def clean_netmums(df):
+	""" the text table of a chunk of netmums posts, as process_text
+		in notebook 1.5
+	:param df: data frame of id, body
+	:return df: data frame of post_id, text_clean
+	"""
+	df = df.rename(columns={"id": "post_id", "body": "text_clean"})
+	df = remove_sent_from(df)
+	df = remove_links(df)
+	df = drop_emptys(df)
+	return df
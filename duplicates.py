@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Contains functions for finding near-duplicate posts, e.g. spam pasted
+# into thousands of posts, with MinHash signatures and LSH bands
+# kept in the forum's database
+
+import itertools
+import re
+import zlib
+import numpy as np
+import pandas as pd
+from scraping import create_connection
+from stages import run_stage, get_stage_state
+
+## Settings
+# two texts share a band with a probability of about s^rows, s being the
+# Jaccard similarity of their shingles, so with 16 bands of 8 rows texts
+# more than about (1/16)^(1/8) = 0.71 alike are likely to be candidates
+
+shingle_words = 3 # words per shingle
+num_perm = 128 # hashes per signature
+bands = 16 # bands per signature, of num_perm / bands rows
+min_words = 10 # shorter texts, e.g. "bump" or "thank you!", are left out
+seed = 7 # of the hash functions; changing it rebuilds the index
+min_cluster = 20 # near-duplicates in a cluster before they are marked spam
+block_shingles = 20000 # shingles hashed at once, bounds the memory used
+
+prime = 4294967311 # smallest prime above 2^32
+band_multiplier = np.uint64(1000003)
+
+## SQL
+
+bands_sql = ''' SELECT rowid AS doc_id, text_clean FROM text WHERE rowid BETWEEN ? AND ? '''
+
+bands_indexes_sql = '''
+	CREATE INDEX IF NOT EXISTS minhash_bands_key ON minhash_bands(band, key, doc_id);
+	CREATE INDEX IF NOT EXISTS minhash_bands_doc ON minhash_bands(doc_id);
+'''
+
+clusters_sql = '''
+	CREATE TABLE IF NOT EXISTS near_dup_clusters (
+		doc_id INTEGER PRIMARY KEY,
+		cluster INTEGER
+	);
+	CREATE INDEX IF NOT EXISTS near_dup_clusters_cluster ON near_dup_clusters(cluster);
+'''
+
+# every text in a band shared by more than one text
+shared_bands_sql = '''
+	SELECT b.band, b.key, b.doc_id
+	FROM (
+		SELECT band, key FROM minhash_bands GROUP BY band, key HAVING COUNT(*) > 1
+	) AS n
+	JOIN minhash_bands AS b ON b.band = n.band AND b.key = n.key
+	ORDER BY b.band, b.key
+'''
+
+# every text in a band of a text added after the watermark
+new_bands_sql = '''
+	SELECT b.band, b.key, b.doc_id
+	FROM (
+		SELECT DISTINCT band, key FROM minhash_bands WHERE doc_id > ?
+	) AS n
+	JOIN minhash_bands AS b ON b.band = n.band AND b.key = n.key
+	ORDER BY b.band, b.key
+'''
+
+flag_sql = '''
+	UPDATE text
+	SET probable_spam=1
+	WHERE probable_spam IS NOT 1 AND rowid IN (
+		SELECT doc_id FROM near_dup_clusters WHERE cluster IN (
+			SELECT cluster FROM near_dup_clusters GROUP BY cluster HAVING COUNT(*) >= ?
+		)
+	)
+'''
+
+## Regex
+
+word = re.compile(r'\w+')
+
+## Hash functions, made once per process for each seed and size
+
+hash_params = {}
+
+## Functions for signatures
+
+def get_hash_params(n, seed):
+	""" the parameters of n hash functions (a * x + b) % prime
+	:param n: number of hash functions
+	:param seed: seed of the parameters
+	:return: (a, b) arrays of uint64, of shape (n, 1)
+	"""
+	if (n, seed) not in hash_params:
+		rng = np.random.RandomState(seed)
+		a = rng.randint(1, 2 ** 32, size=(n, 1), dtype=np.uint64)
+		b = rng.randint(0, 2 ** 32, size=(n, 1), dtype=np.uint64)
+		hash_params[(n, seed)] = (a, b)
+	return hash_params[(n, seed)]
+
+def get_shingles(text, size=shingle_words, least=min_words):
+	""" hash the shingles of a text, its runs of size words
+	:param text: text of post
+	:param size: words per shingle
+	:param least: fewest words a text needs to be shingled
+	:return: list of shingle hashes, empty if the text is too short
+	"""
+	if not isinstance(text, str):
+		return []
+	words = word.findall(text.lower())
+	if len(words) < least:
+		return []
+	shingles = {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+	return [zlib.crc32(s.encode("utf-8")) for s in shingles]
+
+def get_signatures(shingles, n=num_perm, seed=seed):
+	""" MinHash signatures of many texts at once
+	:param shingles: list of lists of shingle hashes, none empty
+	:param n: hashes per signature
+	:param seed: seed of the hash functions
+	:return: array of uint32, one row of n hashes per text
+	:note: the hashes of a block of texts are taken in one array, and the
+		minimum of each text's columns with np.minimum.reduceat
+	"""
+	(a, b) = get_hash_params(n, seed)
+	signatures = np.empty((len(shingles), n), dtype=np.uint32)
+	start = 0
+	while start < len(shingles):
+		end = start
+		total = 0
+		while end < len(shingles) and (end == start or total + len(shingles[end]) <= block_shingles):
+			total += len(shingles[end])
+			end += 1
+		block = shingles[start:end]
+		lengths = np.array([len(s) for s in block])
+		offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+		values = np.fromiter(itertools.chain.from_iterable(block), dtype=np.uint64, count=total)
+		hashed = (a * values + b) % np.uint64(prime)
+		signatures[start:end] = np.minimum.reduceat(hashed, offsets, axis=1).T
+		start = end
+	return signatures
+
+def get_band_keys(signatures, n_bands=bands):
+	""" key of each band of each signature, one number per band
+	:param signatures: array from get_signatures
+	:param n_bands: bands per signature
+	:return: array of int64, one row of n_bands keys per text
+	"""
+	rows = signatures.reshape(len(signatures), n_bands, -1).astype(np.uint64)
+	keys = np.zeros(rows.shape[:2], dtype=np.uint64)
+	for r in range(rows.shape[2]): # wraps around, as a hash
+		keys = keys * band_multiplier ^ rows[:, :, r]
+	return keys.view(np.int64)
+
+def get_bands(df, size=shingle_words, least=min_words, n=num_perm, n_bands=bands, seed=seed):
+	""" the LSH bands of a chunk of texts, the function of the stage
+	:param df: data frame of doc_id, text_clean
+	:param size: words per shingle
+	:param least: fewest words a text needs
+	:param n: hashes per signature
+	:param n_bands: bands per signature
+	:param seed: seed of the hash functions
+	:return: data frame of band, key, doc_id, n_bands rows per text
+		long enough
+	"""
+	shingles = [get_shingles(text, size, least) for text in df["text_clean"]]
+	keep = [i for (i, s) in enumerate(shingles) if s]
+	if not keep:
+		return pd.DataFrame({"band": [], "key": [], "doc_id": []}, dtype="int64")
+	keys = get_band_keys(get_signatures([shingles[i] for i in keep], n, seed), n_bands)
+	doc_ids = df["doc_id"].to_numpy()[keep]
+	return pd.DataFrame({
+		"band": np.tile(np.arange(n_bands, dtype=np.int64), len(keep)),
+		"key": keys.ravel(),
+		"doc_id": np.repeat(doc_ids, n_bands).astype(np.int64),
+	})
+
+## Functions for clusters
+
+def find_root(parent, x):
+	""" root of x in a union-find forest, halving the path to it
+	:param parent: dictionary of doc_id: parent doc_id
+	:param x: doc_id
+	:return: root doc_id
+	"""
+	while parent.get(x, x) != x:
+		parent[x] = parent.get(parent[x], parent[x])
+		x = parent[x]
+	return x
+
+def join(parent, x, y):
+	""" put x and y in the same cluster, rooted at the lower doc_id
+	:param parent: dictionary of doc_id: parent doc_id
+	:param x: doc_id
+	:param y: doc_id
+	:return: nothing
+	"""
+	(x, y) = (find_root(parent, x), find_root(parent, y))
+	if x != y:
+		parent[max(x, y)] = min(x, y)
+	parent.setdefault(min(x, y), min(x, y))
+
+def get_clusters(conn, doc_ids):
+	""" read the clusters some texts are in
+	:param conn: database connection
+	:param doc_ids: list of doc_ids
+	:return: dictionary of doc_id: cluster, for the texts in one
+	"""
+	clusters = {}
+	for i in range(0, len(doc_ids), 500):
+		batch = doc_ids[i:i + 500]
+		sql = ''' SELECT doc_id, cluster FROM near_dup_clusters WHERE doc_id IN ({}) '''.format(", ".join("?" * len(batch)))
+		clusters.update(conn.execute(sql, batch).fetchall())
+	return clusters
+
+def update_clusters(conn, after=None):
+	""" join the texts sharing a band into clusters, numbered by their
+		first doc_id
+	:param conn: database connection
+	:param after: only join the bands of texts after this doc_id, to the
+		clusters found before; every band again if None
+	:return: number of texts whose cluster was written
+	"""
+	if after is None:
+		conn.execute(''' DROP TABLE IF EXISTS near_dup_clusters ''')
+	conn.executescript(clusters_sql)
+	rows = conn.execute(shared_bands_sql) if after is None else conn.execute(new_bands_sql, (after,))
+	parent = {}
+	for (_, group) in itertools.groupby(rows, key=lambda row: row[:2]):
+		doc_ids = [row[2] for row in group]
+		for doc_id in doc_ids[1:]:
+			join(parent, doc_ids[0], doc_id)
+	if not parent:
+		return 0
+	old = get_clusters(conn, list(parent))
+	for (doc_id, cluster) in old.items(): # new texts can join clusters found before
+		join(parent, doc_id, cluster)
+	moved = {(find_root(parent, cluster), cluster) for cluster in set(old.values()) if find_root(parent, cluster) != cluster}
+	conn.executemany(''' UPDATE near_dup_clusters SET cluster=? WHERE cluster=? ''', moved)
+	conn.executemany(''' INSERT OR REPLACE INTO near_dup_clusters (doc_id, cluster) VALUES (?, ?) ''',
+		((doc_id, find_root(parent, doc_id)) for doc_id in parent))
+	conn.commit()
+	return len(parent)
+
+def update_near_duplicates(path_db, workers=None, rebuild=False, verbose=True):
+	""" add the texts written since the last run to the index of bands,
+		then to the clusters
+	:param path_db: database file, with the text table
+	:param workers: number of processes, the number of cores if None
+	:param rebuild: index every text again
+	:param verbose: print the texts clustered
+	:return: (texts read, band rows written)
+	:note: the index is rebuilt when the settings change or the text
+		table is rebuilt, since its rowids are the doc_ids
+	"""
+	conn = create_connection(path_db)
+	before = get_stage_state(conn, "near_duplicates")
+	conn.close()
+	args = (shingle_words, min_words, num_perm, bands, seed)
+	(rows_read, rows_written) = run_stage(path_db, "text", bands_sql, "minhash_bands", get_bands, args,
+		workers, name="near_duplicates", rebuild=rebuild)
+	conn = create_connection(path_db)
+	state = conn.execute(''' SELECT rows_read FROM stage_state WHERE name='near_duplicates' ''').fetchone()
+	sql = ''' SELECT count(name) FROM sqlite_master WHERE type='table' AND name='minhash_bands' '''
+	if state is not None and conn.execute(sql).fetchone()[0]:
+		conn.executescript(bands_indexes_sql)
+		rebuilt = before is None or state[0] == rows_read
+		if rebuilt or rows_read:
+			clustered = update_clusters(conn, None if rebuilt else before[0])
+			if verbose:
+				print("near_duplicates: {} texts clustered".format(clustered), flush=True)
+	conn.close()
+	return (rows_read, rows_written)
+
+def flag_near_duplicates(conn, min_size=min_cluster, verbose=True):
+	""" mark the texts in large clusters as probable spam, in one UPDATE
+	:param conn: database connection
+	:param min_size: fewest texts in a cluster to mark it
+	:param verbose: print how many texts were marked
+	:return: number of texts marked
+	:note: for youbemom, whose text table has probable_spam; run again
+		after the text table is rebuilt, as apply_labels in labels.py
+	"""
+	changed = conn.execute(flag_sql, (min_size,)).rowcount
+	conn.commit()
+	if verbose:
+		print("{} near-duplicates marked as probable spam".format(changed), flush=True)
+	return changed
+
+def get_cluster_sizes(conn, min_size=min_cluster, limit=50):
+	""" the largest clusters, with a text of each to check them by
+	:param conn: database connection
+	:param min_size: fewest texts in a cluster
+	:param limit: most clusters to return
+	:return: data frame of cluster, size, text_clean
+	"""
+	sql = '''
+		SELECT c.cluster, c.size, t.text_clean
+		FROM (
+			SELECT cluster, COUNT(*) AS size FROM near_dup_clusters
+			GROUP BY cluster HAVING COUNT(*) >= ?
+		) AS c
+		JOIN text AS t ON t.rowid = c.cluster
+		ORDER BY c.size DESC
+		LIMIT ?
+	'''
+	return pd.read_sql_query(sql, conn, params=(min_size, limit))
+
+## Functions for queries
+
+def find_near_duplicates(conn, text, least_bands=1):
+	""" find the texts in the index like a text, e.g. a new post, by
+		looking up its bands: the work doesn't grow with the index
+	:param conn: database connection
+	:param text: text to look up
+	:param least_bands: fewest bands a text must share with it
+	:return: list of (doc_id, bands shared), most alike first; the share
+		of bands shared estimates their similarity
+	"""
+	df = get_bands(pd.DataFrame({"doc_id": [0], "text_clean": [text]}))
+	if df.empty:
+		return []
+	values = ", ".join("(?, ?)" for _ in range(len(df)))
+	sql = '''
+		WITH q(band, key) AS (VALUES {})
+		SELECT b.doc_id, COUNT(*) AS shared
+		FROM q
+		JOIN minhash_bands AS b ON b.band = q.band AND b.key = q.key
+		GROUP BY b.doc_id
+		HAVING COUNT(*) >= ?
+		ORDER BY shared DESC, b.doc_id
+	'''.format(values)
+	params = [int(v) for pair in zip(df["band"], df["key"]) for v in pair] + [least_bands]
+	return conn.execute(sql, params).fetchall()
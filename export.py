@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Contains functions for exporting the merged databases to parquet
+# files partitioned by forum, subforum and year, and loading them back
+
+import shutil
+import sqlite3
+import time
+import warnings
+from pathlib import Path
+try:
+	import pyarrow as pa
+	import pyarrow.compute as pc
+	import pyarrow.dataset as ds
+	import pyarrow.parquet as pq
+except ImportError:
+	pa = None
+
+## Export settings
+
+batch_size = 100000 # rows read from sqlite per record batch
+max_partitions = 100000 # subforums x years, well above the forums' own
+
+# youbemom posts repeat a message_id when a post was scraped more than
+# once, so text and sentiment are joined to its first copy only; joined
+# to every copy, their rows would be exported once per copy
+youbemom_posts_by_message = '''(
+	SELECT message_id, subforum, date_created FROM posts
+	WHERE rowid IN (SELECT MIN(rowid) FROM posts GROUP BY message_id)
+) AS p'''
+
+youbemom_posts_by_family = '''(
+	SELECT family_id, subforum, date_created FROM posts
+	WHERE rowid IN (SELECT MIN(rowid) FROM posts WHERE parent_id = "" GROUP BY family_id)
+) AS p'''
+
+# where the subforum and date of the rows of each table come from; the
+# table's own columns are read from alias, the rest are joined in, at
+# most one row per row of the table
+export_tables = {
+	"youbemom": {
+		"posts": {
+			"alias": "p",
+			"from": "posts AS p",
+			"subforum": "p.subforum",
+			"date": "p.date_created",
+		},
+		"text": {
+			"alias": "t",
+			"from": "text AS t LEFT JOIN {} ON p.message_id = t.message_id".format(youbemom_posts_by_message),
+			"subforum": "p.subforum",
+			"date": "p.date_created",
+		},
+		"sentiment": {
+			"alias": "t",
+			"from": "sentiment AS t LEFT JOIN {} ON p.message_id = t.message_id".format(youbemom_posts_by_message),
+			"subforum": "p.subforum",
+			"date": "p.date_created",
+		},
+		"sentiment_family": { # partitioned with the top post of the family
+			"alias": "t",
+			"from": "sentiment_family AS t LEFT JOIN {} ON p.family_id = t.family_id".format(youbemom_posts_by_family),
+			"subforum": "p.subforum",
+			"date": "p.date_created",
+		},
+	},
+	"netmums": {
+		"posts": {
+			"alias": "p",
+			"from": "posts AS p LEFT JOIN threads AS th ON th.id = p.thread_id",
+			"subforum": "th.subforum_id",
+			"date": "p.date_created",
+		},
+		"text": {
+			"alias": "t",
+			"from": "text AS t LEFT JOIN posts AS p ON p.id = t.post_id LEFT JOIN threads AS th ON th.id = p.thread_id",
+			"subforum": "th.subforum_id",
+			"date": "p.date_created",
+		},
+		"sentiment": {
+			"alias": "t",
+			"from": "sentiment AS t LEFT JOIN posts AS p ON p.id = t.post_id LEFT JOIN threads AS th ON th.id = p.thread_id",
+			"subforum": "th.subforum_id",
+			"date": "p.date_created",
+		},
+	},
+}
+
+# formats of the date columns, parsed into timestamps
+date_formats = {
+	"youbemom": {
+		"date_created": "%Y-%m-%d %H:%M:%S",
+		"date_recorded": "%m-%d-%Y %H:%M:%S",
+	},
+	"netmums": {
+		"date_created": "%Y-%m-%d %I:%M%p",
+		"date_recorded": "%Y-%m-%d %H:%M:%S",
+	},
+}
+
+## Functions
+
+def get_path_parquet():
+	""" default directory of the exported tables, next to the database
+		directory, found from the working directory when called
+	:return: path
+	"""
+	return Path.cwd().parents[0] / "parquet"
+
+def get_path_db(forum):
+	""" default merged database file of a forum
+	:param forum: "youbemom" or "netmums"
+	:return: database file
+	"""
+	return str(Path.cwd().parents[0] / "database" / "{}-merged.db".format(forum))
+
+def require_pyarrow():
+	""" stop if pyarrow is not installed
+	:return: nothing
+	"""
+	if pa is None:
+		raise ImportError("exporting to parquet needs pyarrow, pip install pyarrow")
+
+def get_partitioning():
+	""" hive partitioning of a forum's export of a table, subforum=/year=
+	:return: pyarrow partitioning
+	:note: netmums subforums are subforum ids, written as strings
+	"""
+	schema = pa.schema([("subforum", pa.string()), ("year", pa.int16())])
+	return ds.partitioning(schema, flavor="hive")
+
+def get_forum_path(path, table, forum):
+	""" directory of a forum's export of a table; the forums are kept
+		apart since their tables have different columns
+	:param path: directory of the exported tables
+	:param table: name of table
+	:param forum: "youbemom" or "netmums"
+	:return: path/table/forum=
+	"""
+	return Path(path) / table / "forum={}".format(forum)
+
+def get_column_type(name, declared):
+	""" arrow type of a column, from its name or declared sqlite type
+	:param name: name of column
+	:param declared: type the column was created with, e.g. INTEGER
+	:return: (arrow type, sqlite type to cast to when reading)
+	"""
+	declared = (declared or "").upper()
+	if name in ("date_created", "date_recorded"):
+		return (pa.timestamp("s"), "TEXT")
+	if name in ("message_id", "parent_id"): # parent_id is "" for top posts
+		return (pa.string(), "TEXT")
+	if name in ("deleted", "probable_spam"):
+		return (pa.bool_(), "INTEGER")
+	if "INT" in declared:
+		return (pa.int64(), "INTEGER")
+	if "REAL" in declared or "FLOA" in declared or "DOUB" in declared:
+		return (pa.float64(), "REAL")
+	return (pa.string(), "TEXT")
+
+def get_columns(conn, table):
+	""" columns of a table, without the partition columns
+	:param conn: database connection
+	:param table: name of table
+	:return: list of (name, arrow type, sqlite type to cast to)
+	"""
+	columns = []
+	for row in conn.execute(''' PRAGMA table_info({}) '''.format(table)):
+		(name, declared) = (row[1], row[2])
+		if name in ("forum", "subforum", "year"):
+			continue
+		columns.append((name,) + get_column_type(name, declared))
+	return columns
+
+def has_table(conn, table):
+	""" check the table exists
+	:param conn: database connection
+	:param table: name of table
+	:return: True if it exists
+	"""
+	sql = ''' SELECT count(name) FROM sqlite_master WHERE type='table' AND name=? '''
+	return conn.execute(sql, (table,)).fetchone()[0] > 0
+
+def make_array(values, name, arrow_type, forum):
+	""" convert a column read from sqlite to an arrow array
+	:param values: tuple of values of the column
+	:param name: name of column
+	:param arrow_type: type of array
+	:param forum: "youbemom" or "netmums", for the date formats
+	:return: arrow array
+	"""
+	if pa.types.is_timestamp(arrow_type):
+		strings = pa.array(values, pa.string())
+		return pc.strptime(strings, format=date_formats[forum][name], unit="s", error_is_null=True)
+	if pa.types.is_boolean(arrow_type):
+		return pa.array(values, pa.int64()).cast(pa.bool_())
+	return pa.array(values, arrow_type)
+
+def iter_batches(conn, forum, table, columns, schema, nulls=None):
+	""" read a table in record batches, with its partition columns
+	:param conn: database connection
+	:param forum: "youbemom" or "netmums"
+	:param table: name of table
+	:param columns: list of (name, arrow type, sqlite type) from get_columns
+	:param schema: arrow schema of the batches
+	:param nulls: dictionary counting, by column, the dates that didn't
+		match the forum's format and the rows without a year
+	:return: generator of record batches
+	"""
+	nulls = {} if nulls is None else nulls
+	spec = export_tables[forum][table]
+	select = ["CAST({}.{} AS {})".format(spec["alias"], name, cast) for (name, _, cast) in columns]
+	select.append("CAST({} AS TEXT)".format(spec["subforum"]))
+	select.append("CAST(substr({}, 1, 4) AS INTEGER)".format(spec["date"]))
+	sql = ''' SELECT {} FROM {} '''.format(", ".join(select), spec["from"])
+	cur = conn.execute(sql)
+	while True:
+		rows = cur.fetchmany(batch_size)
+		if not rows:
+			break
+		values = list(zip(*rows))
+		arrays = [make_array(values[i], name, arrow_type, forum) for i, (name, arrow_type, _) in enumerate(columns)]
+		arrays.append(pa.array(values[-2], pa.string()))
+		arrays.append(pa.array(values[-1], pa.int64()).cast(pa.int16()))
+		for i, (name, arrow_type, _) in enumerate(columns):
+			if pa.types.is_timestamp(arrow_type):
+				introduced = arrays[i].null_count - sum(value is None for value in values[i])
+				nulls[name] = nulls.get(name, 0) + introduced
+		nulls["year"] = nulls.get("year", 0) + arrays[-1].null_count
+		yield pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+def export_table(conn, forum, table, path=None):
+	""" write a table to parquet files under path/table/forum=/subforum=/year=,
+		replacing the forum's earlier export of the table
+	:param conn: database connection, opened with check_same_thread=False,
+		since pyarrow reads the batches from a thread of its own
+	:param forum: "youbemom" or "netmums"
+	:param table: name of table, a key of export_tables[forum]
+	:param path: directory of the exported tables, get_path_parquet() if None
+	:return: number of rows written
+	:note: raises ValueError if the rows written are not the rows of the
+		table, e.g. a join in export_tables repeated some of them; warns
+		with the count of dates that didn't match the forum's format,
+		written as null, and of rows without a year, written to the
+		year=null partition
+	"""
+	require_pyarrow()
+	path = path or get_path_parquet()
+	columns = get_columns(conn, table)
+	fields = [(name, arrow_type) for (name, arrow_type, _) in columns]
+	schema = pa.schema(fields + [("subforum", pa.string()), ("year", pa.int16())])
+	path_forum = get_forum_path(path, table, forum)
+	shutil.rmtree(path_forum, ignore_errors=True)
+	rows = [0]
+	nulls = {}
+	def counted(batches):
+		for batch in batches:
+			rows[0] += batch.num_rows
+			yield batch
+	ds.write_dataset(
+		counted(iter_batches(conn, forum, table, columns, schema, nulls)),
+		str(path_forum),
+		schema=schema,
+		format="parquet",
+		partitioning=get_partitioning(),
+		basename_template="part-{i}.parquet",
+		existing_data_behavior="overwrite_or_ignore",
+		max_partitions=max_partitions,
+	)
+	expected = conn.execute(''' SELECT COUNT(*) FROM {} '''.format(table)).fetchone()[0]
+	if rows[0] != expected:
+		raise ValueError("{} {}: {} rows written, the table has {}".format(forum, table, rows[0], expected))
+	for (name, count) in nulls.items():
+		if not count:
+			continue
+		if name == "year":
+			warnings.warn("{} {}: {} rows without a year, in the year=null partition".format(forum, table, count))
+		else:
+			warnings.warn("{} {}: {} values of {} didn't match {}, written as null".format(
+				forum, table, count, name, date_formats[forum][name]))
+	return rows[0]
+
+def export_forum(forum, path_db=None, path=None, tables=None, verbose=True):
+	""" export the tables of a forum's merged database to parquet
+	:param forum: "youbemom" or "netmums"
+	:param path_db: merged database file, get_path_db(forum) if None
+	:param path: directory of the exported tables, get_path_parquet() if None
+	:param tables: names of tables to export, every table in export_tables[forum] if None
+	:param verbose: print the rows and time of each table
+	:return: dictionary of table: rows written
+	:note: tables that don't exist yet, e.g. sentiment before it is scored, are skipped
+	"""
+	require_pyarrow()
+	conn = sqlite3.connect(path_db or get_path_db(forum), check_same_thread=False)
+	counts = {}
+	for table in tables or export_tables[forum]:
+		if not has_table(conn, table):
+			if verbose:
+				print("{} {}: no table, skipped".format(forum, table), flush=True)
+			continue
+		start = time.perf_counter()
+		counts[table] = export_table(conn, forum, table, path)
+		if verbose:
+			print("{} {}: {} rows, {:.1f}s".format(forum, table, counts[table], time.perf_counter() - start), flush=True)
+	conn.close()
+	return counts
+
+def get_filter(filters=None, subforum=None, year=None):
+	""" combine filters into one arrow expression
+	:param filters: arrow expression, or list of (column, op, value) tuples
+		as in pyarrow.parquet.read_table
+	:param subforum: subforum or list of subforums
+	:param year: year or list of years
+	:return: arrow expression or None to read every row
+	"""
+	if filters is not None and not isinstance(filters, ds.Expression):
+		filters = pq.filters_to_expression(filters)
+	for (name, value) in (("subforum", subforum), ("year", year)):
+		if value is None:
+			continue
+		if isinstance(value, (list, tuple, set)):
+			values = [str(v) if name == "subforum" else v for v in value]
+			expression = ds.field(name).isin(values)
+		else:
+			expression = ds.field(name) == (str(value) if name == "subforum" else value)
+		filters = expression if filters is None else filters & expression
+	return filters
+
+def load(table, columns=None, filters=None, forum=None, subforum=None, year=None, path=None):
+	""" load an exported table into a dataframe, reading only the
+		columns and partitions needed
+	:param table: name of table, e.g. sentiment
+	:param columns: list of columns to read, every column if None
+	:param filters: arrow expression, or list of (column, op, value) tuples,
+		e.g. [("probable_spam", "=", False)]
+	:param forum: forum or list of forums, every forum exported if None
+	:param subforum: subforum or list of subforums
+	:param year: year or list of years
+	:param path: directory of the exported tables, get_path_parquet() if None
+	:return: dataframe, with a forum column
+	:note: filters on forum, subforum and year skip whole directories,
+		other filters skip row groups by their statistics; columns one
+		forum doesn't have are null in its rows
+	"""
+	require_pyarrow()
+	path = path or get_path_parquet()
+	if forum is None:
+		forums = sorted(d.name.split("=", 1)[1] for d in (Path(path) / table).glob("forum=*"))
+	elif isinstance(forum, str):
+		forums = [forum]
+	else:
+		forums = list(forum)
+	expression = get_filter(filters, subforum, year)
+	tables = []
+	for name in forums:
+		dataset = ds.dataset(str(get_forum_path(path, table, name)), format="parquet", partitioning=get_partitioning())
+		names = None if columns is None else [c for c in columns if c in dataset.schema.names]
+		data = dataset.to_table(columns=names, filter=expression)
+		tables.append(data.append_column("forum", pa.array([name] * data.num_rows, pa.string())))
+	if not tables:
+		raise FileNotFoundError("no export of {} in {}".format(table, path))
+	data = pa.concat_tables(tables, promote_options="default")
+	if columns is not None:
+		data = data.select([c for c in columns if c in data.schema.names] + ([] if "forum" in columns else ["forum"]))
+	return data.to_pandas()
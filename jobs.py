@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Contains functions for queueing crawl jobs and running them in a pool of worker processes
+
+import multiprocessing
+import multiprocessing.connection
+import os
+import socket
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from search import optimize_fts
+
+## Settings
+
+lease_seconds = 600 # a job is handed to another worker if its lease is not renewed in this time
+max_attempts = 3 # a job that fails this many times is marked failed and skipped
+
+## Errors
+
+class JobErrors(Exception):
+	""" some jobs of a batch failed and the rest finished, raised by a
+		handler so run_worker only fails the jobs that did
+	"""
+	def __init__(self, errors):
+		super().__init__("{} jobs failed".format(len(errors)))
+		self.errors = errors # job id: text of error
+
+## Functions for creating and writing to the job database
+
+def connect_jobs(path_jobs):
+	""" create a connection to the job database, shared by all workers
+	:param path_jobs: database file
+	:return: Connection object
+	:note: transactions are begun explicitly, so a claim locks the table until it commits
+	"""
+	conn = sqlite3.connect(path_jobs, timeout=60, isolation_level=None)
+	conn.execute(''' PRAGMA journal_mode=WAL ''')
+	set_up_jobs_db(conn)
+	return conn
+
+def set_up_jobs_db(conn):
+	""" sets up the table of crawl jobs
+		if the table doesn't exists, create it
+	:param conn: database connection
+	:return: nothing
+	"""
+	cur = conn.cursor()
+	cur.executescript('''
+		CREATE TABLE IF NOT EXISTS jobs(
+			id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT UNIQUE,
+			kind TEXT,
+			first INTEGER,
+			last INTEGER,
+			url TEXT,
+			status TEXT DEFAULT 'pending',
+			worker TEXT,
+			lease_until REAL,
+			attempts INTEGER DEFAULT 0,
+			error TEXT,
+			updated TEXT,
+			UNIQUE(kind, first, last)
+		);
+		CREATE INDEX IF NOT EXISTS jobs_status ON jobs(kind, status, id);
+	''')
+
+def add_jobs(conn, kind, jobs):
+	""" add jobs to the queue, skipping any already queued
+	:param kind: name of the handler in job_handlers
+	:param jobs: iterable of (first, last, url)
+	:return: number of jobs added
+	"""
+	sql = '''
+		INSERT OR IGNORE INTO jobs(kind, first, last, url, updated)
+		VALUES(?,?,?,?,?)
+	'''
+	updated = now()
+	before = conn.total_changes
+	conn.execute(''' BEGIN IMMEDIATE ''')
+	conn.executemany(sql, ((kind, first, last, url, updated) for (first, last, url) in jobs))
+	conn.execute(''' COMMIT ''')
+	return conn.total_changes - before
+
+def add_thread_jobs(conn, rows):
+	""" queue one netmums job per thread
+	:param rows: rows of (id, url) from threads table
+	:return: number of jobs added
+	"""
+	return add_jobs(conn, "netmums", ((thread_id, thread_id, url) for (thread_id, url) in rows))
+
+def add_range_jobs(conn, earliest_link, last_link, size):
+	""" queue youbemom jobs over ranges of permalinks
+	:param earliest_link: first permalink
+	:param last_link: permalink after the last one scraped
+	:param size: number of permalinks in each job
+	:return: number of jobs added
+	"""
+	ranges = ((first, min(first + size, last_link), None) for first in range(earliest_link, last_link, size))
+	return add_jobs(conn, "youbemom", ranges)
+
+def reset_thread_jobs(conn, rows):
+	""" queue netmums threads again, including threads already done
+	:param rows: rows of (id, url) from threads table
+	:return: number of jobs queued
+	:note: used by delta crawls, see netmums.find_changed_threads
+	"""
+	rows = list(rows)
+	added = add_thread_jobs(conn, rows)
+	sql = '''
+		UPDATE jobs SET status='pending', attempts=0, error=NULL, updated=?
+		WHERE kind='netmums' AND first=? AND last=? AND status IN ('done', 'failed')
+	'''
+	updated = now()
+	before = conn.total_changes
+	conn.executemany(sql, ((updated, thread_id, thread_id) for (thread_id, url) in rows))
+	return added + conn.total_changes - before
+
+def now():
+	return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+## Functions for leasing jobs
+
+def claim_jobs(conn, kind, worker, n=1):
+	""" lease the next pending jobs to a worker, including
+		jobs whose lease ran out without being renewed
+	:param kind: kind of job to claim
+	:param worker: name of the worker
+	:param n: number of jobs to claim
+	:return: list of (id, first, last, url, attempts)
+	"""
+	sql_select = '''
+		SELECT id, first, last, url, attempts FROM jobs
+		WHERE kind=? AND (status='pending' OR (status='leased' AND lease_until<? AND attempts<?))
+		ORDER BY id LIMIT ?
+	'''
+	sql_lease = '''
+		UPDATE jobs SET status='leased', worker=?, lease_until=?, attempts=attempts+1, updated=?
+		WHERE id=?
+	'''
+	conn.execute(''' BEGIN IMMEDIATE ''')
+	try:
+		rows = conn.execute(sql_select, (kind, time.time(), max_attempts, n)).fetchall()
+		lease_until = time.time() + lease_seconds
+		updated = now()
+		conn.executemany(sql_lease, ((worker, lease_until, updated, row[0]) for row in rows))
+		conn.execute(''' COMMIT ''')
+	except Exception:
+		conn.execute(''' ROLLBACK ''')
+		raise
+	return [(job_id, first, last, url, attempts + 1) for (job_id, first, last, url, attempts) in rows]
+
+def renew_leases(conn, job_ids, worker):
+	""" extend the leases a worker holds
+	:param job_ids: ids of jobs being worked on
+	:param worker: name of the worker
+	:return: number of leases renewed
+	"""
+	sql = ''' UPDATE jobs SET lease_until=? WHERE id=? AND worker=? AND status='leased' '''
+	lease_until = time.time() + lease_seconds
+	before = conn.total_changes
+	conn.executemany(sql, ((lease_until, job_id, worker) for job_id in job_ids))
+	return conn.total_changes - before
+
+def complete_jobs(conn, job_ids, worker):
+	""" mark jobs done
+	:param job_ids: ids of jobs finished
+	:param worker: name of the worker
+	:return: nothing
+	"""
+	sql = ''' UPDATE jobs SET status='done', lease_until=NULL, error=NULL, updated=? WHERE id=? AND worker=? '''
+	updated = now()
+	conn.executemany(sql, ((updated, job_id, worker) for job_id in job_ids))
+
+def fail_jobs(conn, job_ids, worker, error):
+	""" put jobs back in the queue after an error, or mark them
+		failed once they have been tried max_attempts times
+	:param job_ids: ids of jobs that failed
+	:param worker: name of the worker
+	:param error: text of the error
+	:return: nothing
+	"""
+	sql = '''
+		UPDATE jobs SET status=CASE WHEN attempts<? THEN 'pending' ELSE 'failed' END,
+			lease_until=NULL, error=?, updated=?
+		WHERE id=? AND worker=?
+	'''
+	updated = now()
+	conn.executemany(sql, ((max_attempts, error, updated, job_id, worker) for job_id in job_ids))
+
+def reclaim_expired(conn):
+	""" return jobs whose lease ran out to the queue, or mark them
+		failed if they have been tried max_attempts times
+	:return: number of jobs reclaimed
+	"""
+	sql = '''
+		UPDATE jobs SET status=CASE WHEN attempts<? THEN 'pending' ELSE 'failed' END,
+			lease_until=NULL, error='lease expired', updated=?
+		WHERE status='leased' AND lease_until<?
+	'''
+	return conn.execute(sql, (max_attempts, now(), time.time())).rowcount
+
+def get_progress(conn, kind=None):
+	""" count jobs by status
+	:param kind: only count jobs of this kind
+	:return: dictionary of status: count
+	"""
+	if kind:
+		rows = conn.execute(''' SELECT status, COUNT(*) FROM jobs WHERE kind=? GROUP BY status ''', (kind,))
+	else:
+		rows = conn.execute(''' SELECT status, COUNT(*) FROM jobs GROUP BY status ''')
+	progress = {"pending": 0, "leased": 0, "done": 0, "failed": 0}
+	progress.update(rows.fetchall())
+	return progress
+
+def print_progress(conn, kind=None, started=None):
+	""" print the number of jobs in each status
+	:param kind: only count jobs of this kind
+	:param started: time.time() the pool started, to report a rate
+	:return: dictionary of status: count
+	"""
+	progress = get_progress(conn, kind)
+	total = sum(progress.values())
+	line = "{}: {done}/{} done, {leased} leased, {pending} pending, {failed} failed".format(now(), total, **progress)
+	if started:
+		line += ", {:.1f} jobs/min".format(progress["done"] * 60 / max(time.time() - started, 1))
+	print(line, flush=True)
+	return progress
+
+## Functions for running jobs
+
+def run_netmums_jobs(path_db, jobs):
+	""" scrape the threads of netmums jobs into one database
+		shared by every worker
+	:param path_db: database file of posts
+	:param jobs: list of (id, first, last, url, attempts)
+	:return: nothing
+	:note: a thread retried after a worker died resumes after
+		the last page it committed, see netmums.write_checkpoint;
+		the database is set up once by the caller of run_pool, see
+		netmums.set_up_posts_db; raises JobErrors for the threads that
+		stopped at a failed page, so the jobs of the rest are done
+	"""
+	import netmums
+	conn = sqlite3.connect(path_db, timeout=60)
+	rows = [(first, url) for (job_id, first, last, url, attempts) in jobs]
+	errors = netmums.scrape_posts_concurrent(conn, rows, raise_errors=False)
+	conn.close()
+	if errors:
+		job_ids = {first: job_id for (job_id, first, last, url, attempts) in jobs}
+		raise JobErrors({job_ids[err.thread_id]: repr(err) for err in errors})
+
+def run_youbemom_jobs(path_db, jobs, sparse=False):
+	""" scrape the permalinks of youbemom jobs, each range into its own
+		database, to be merged later
+	:param path_db: database file with a {} for the job id, like "youbemomTables-{:02d}.db"
+	:param jobs: list of (id, first, last, url, attempts)
+	:param sparse: only fetch permalinks that could be thread roots, see
+		youbemom.SparseWalk, instead of every permalink
+	:return: nothing
+	:note: a retried range restarts after the last family_id it wrote
+	"""
+	import youbemom
+	for (job_id, first, last, url, attempts) in jobs:
+		path_job_db = path_db.format(job_id)
+		conn = sqlite3.connect(path_job_db, timeout=60)
+		youbemom.set_up_db(conn)
+		youbemom.loop_link_threads(conn, path_job_db, first, last, sparse=sparse)
+		optimize_fts(conn)
+		conn.close()
+
+def run_youbemom_gap_jobs(path_db, jobs):
+	""" scrape permalinks missing from youbemom shards, queued by
+		merge.merge_youbemom, into the shard each gap is in
+	:param path_db: not used, each job names its shard in url
+	:param jobs: list of (id, first permalink, last permalink, shard file, attempts)
+	:return: nothing
+	"""
+	import youbemom
+	for (job_id, first, last, path_shard, attempts) in jobs:
+		conn = sqlite3.connect(path_shard, timeout=60)
+		earliest_link = youbemom.get_earliest_link(conn)
+		missing_ids = [permalink - earliest_link + 1 for permalink in range(first, last + 1)]
+		youbemom.loop_list_links(conn, path_shard, missing_ids, earliest_link)
+		conn.close()
+
+job_handlers = {
+	"netmums": run_netmums_jobs,
+	"youbemom": run_youbemom_jobs,
+	"youbemom_gaps": run_youbemom_gap_jobs
+}
+
+def renew_until_stopped(path_jobs, job_ids, worker, stop):
+	""" renew the leases of running jobs until stop is set
+	:param stop: threading.Event set when the jobs finish
+	:return: nothing
+	"""
+	conn = connect_jobs(path_jobs)
+	while not stop.wait(lease_seconds / 3):
+		renew_leases(conn, job_ids, worker)
+	conn.close()
+
+def run_worker(path_jobs, path_db, kind, batch=8, options=None):
+	""" claim and run jobs until none are left
+	:param path_jobs: job database file
+	:param path_db: database file passed to the handler of kind
+	:param kind: kind of job to run
+	:param batch: number of jobs claimed at once
+	:param options: dictionary of keyword arguments of the handler, e.g. {"sparse": True}
+	:return: nothing
+	"""
+	worker = "{}:{}".format(socket.gethostname(), os.getpid())
+	handler = job_handlers[kind]
+	conn = connect_jobs(path_jobs)
+	while True:
+		jobs = claim_jobs(conn, kind, worker, batch)
+		if not jobs:
+			break
+		job_ids = [job[0] for job in jobs]
+		stop = threading.Event()
+		renewer = threading.Thread(target=renew_until_stopped, args=(path_jobs, job_ids, worker, stop), daemon=True)
+		renewer.start()
+		try:
+			handler(path_db, jobs, **(options or {}))
+		except JobErrors as err:
+			for (job_id, error) in err.errors.items():
+				fail_jobs(conn, [job_id], worker, error)
+			complete_jobs(conn, [job_id for job_id in job_ids if job_id not in err.errors], worker)
+		except Exception as err:
+			fail_jobs(conn, job_ids, worker, repr(err))
+		else:
+			complete_jobs(conn, job_ids, worker)
+		finally:
+			stop.set()
+			renewer.join()
+	conn.close()
+
+def run_pool(path_jobs, path_db, kind, workers=4, batch=8, report_every=60, options=None):
+	""" run jobs in a pool of worker processes, reclaiming the jobs
+		of dead workers and replacing them while jobs remain
+	:param path_jobs: job database file
+	:param path_db: database file passed to the handler of kind
+	:param kind: kind of job to run
+	:param workers: number of worker processes
+	:param batch: number of jobs each worker claims at once
+	:param report_every: seconds between progress reports
+	:param options: dictionary of keyword arguments of the handler, see run_worker
+	:return: dictionary of status: count when the pool finishes
+	"""
+	context = multiprocessing.get_context("spawn")
+	conn = connect_jobs(path_jobs)
+	started = time.time()
+	def start():
+		process = context.Process(target=run_worker, args=(path_jobs, path_db, kind, batch, options))
+		process.start()
+		return process
+	processes = [start() for _ in range(workers)]
+	reported = started
+	while True:
+		sentinels = [process.sentinel for process in processes]
+		if sentinels:
+			multiprocessing.connection.wait(sentinels, timeout=10)
+		else:
+			time.sleep(10)
+		reclaim_expired(conn)
+		progress = get_progress(conn, kind)
+		if time.time() - reported >= report_every:
+			print_progress(conn, kind, started)
+			reported = time.time()
+		for process in [process for process in processes if not process.is_alive()]:
+			process.join()
+			if process.exitcode != 0:
+				print("worker {} exited with {}".format(process.pid, process.exitcode), flush=True)
+			processes.remove(process)
+		# replace exited workers while jobs remain, including jobs reclaimed from dead workers
+		while progress["pending"] and len(processes) < workers:
+			processes.append(start())
+		if not processes and not progress["pending"] and not progress["leased"]:
+			break
+	progress = print_progress(conn, kind, started)
+	conn.close()
+	return progress
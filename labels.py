@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Contains functions for storing the spam labels of youbemom threads,
+# e.g. {sf}_spam.csv coded from 1.2.5-Create_Data-Identify_Spam_Youbemom.R,
+# and applying them to text.probable_spam
+
+import csv
+import hashlib
+from pathlib import Path
+
+## SQL
+
+labels_sql = '''
+	CREATE TABLE IF NOT EXISTS label_sets (
+		id INTEGER PRIMARY KEY,
+		source TEXT,
+		version TEXT,
+		path TEXT,
+		rows INTEGER,
+		spam INTEGER,
+		changed INTEGER,
+		recorded TEXT,
+		applied TEXT,
+		UNIQUE(source, version)
+	);
+	CREATE TABLE IF NOT EXISTS labels (
+		set_id INTEGER,
+		family_id INTEGER,
+		is_spam INTEGER,
+		PRIMARY KEY(set_id, family_id)
+	) WITHOUT ROWID;
+'''
+
+# every post of the threads labelled spam in a set, in one statement;
+# posts already marked are left alone, so changes counts the new marks
+apply_sql = '''
+	UPDATE text
+	SET probable_spam=1
+	WHERE probable_spam IS NOT 1 AND message_id IN (
+		SELECT p.message_id
+		FROM labels AS l
+		JOIN posts AS p ON p.family_id = l.family_id
+		WHERE l.set_id=? AND l.is_spam=1
+	)
+'''
+
+## Functions
+
+def set_up_labels_db(conn):
+	""" sets up the label_sets and labels tables
+	:param conn: database connection
+	:return: nothing
+	"""
+	conn.executescript(labels_sql)
+
+def get_file_version(path):
+	""" version of a label file, a hash of its contents, so reading the
+		same file again adds nothing and an edited file is a new version
+	:param path: label file
+	:return: hex digest, shortened
+	"""
+	with open(path, "rb") as f:
+		return hashlib.sha256(f.read()).hexdigest()[:16]
+
+def read_labels(path):
+	""" read a label file, as the notebook read {sf}_spam.csv: a missing
+		or zero is_spam is not spam
+	:param path: csv file with family_id and is_spam columns
+	:return: list of (family_id, is_spam 0 or 1)
+	"""
+	labels = {}
+	with open(path, newline="", encoding="utf-8") as f:
+		for row in csv.DictReader(f):
+			if not (row.get("family_id") or "").strip():
+				continue
+			family_id = int(float(row["family_id"]))
+			try:
+				is_spam = int(float(row.get("is_spam") or 0) > 0)
+			except ValueError: # e.g. NA
+				is_spam = 0
+			labels[family_id] = is_spam # a repeated thread keeps its last label
+	return list(labels.items())
+
+def ingest_labels(conn, path, source=None, version=None):
+	""" store the labels of a file as a label set
+	:param conn: database connection
+	:param path: csv file with family_id and is_spam columns, e.g. school_spam.csv
+	:param source: name of the labels, the file name if None
+	:param version: version of the labels, a hash of the file if None
+	:return: id of the label set
+	:note: a source and version read before is not read again
+	"""
+	set_up_labels_db(conn)
+	source = source or Path(path).name
+	version = version or get_file_version(path)
+	row = conn.execute(''' SELECT id FROM label_sets WHERE source=? AND version=? ''', (source, version)).fetchone()
+	if row:
+		return row[0]
+	labels = read_labels(path)
+	cur = conn.cursor()
+	cur.execute('''
+		INSERT INTO label_sets (source, version, path, rows, spam, recorded)
+		VALUES (?, ?, ?, ?, ?, datetime('now'))
+	''', (source, version, str(path), len(labels), sum(is_spam for (_, is_spam) in labels)))
+	set_id = cur.lastrowid
+	cur.executemany(''' INSERT INTO labels (set_id, family_id, is_spam) VALUES (?, ?, ?) ''',
+		((set_id, family_id, is_spam) for (family_id, is_spam) in labels))
+	conn.commit()
+	return set_id
+
+def get_label_sets(conn, source=None, latest=True):
+	""" the label sets stored
+	:param conn: database connection
+	:param source: only the sets of this source, every source if None
+	:param latest: only the last version read of each source
+	:return: list of (id, source, version)
+	"""
+	set_up_labels_db(conn)
+	sql = ''' SELECT id, source, version FROM label_sets AS s '''
+	conditions = []
+	if latest:
+		conditions.append(''' id = (SELECT MAX(id) FROM label_sets WHERE source = s.source) ''')
+	if source is not None:
+		conditions.append(''' source=? ''')
+	if conditions:
+		sql += " WHERE " + " AND ".join(conditions)
+	return conn.execute(sql + " ORDER BY id", () if source is None else (source,)).fetchall()
+
+def apply_labels(conn, source=None, latest=True, verbose=True):
+	""" mark the posts of the threads labelled spam as probable spam,
+		one UPDATE per label set
+	:param conn: database connection
+	:param source: only apply the sets of this source, every source if None
+	:param latest: only apply the last version read of each source
+	:param verbose: print how many posts each set marked
+	:return: dictionary of (source, version): posts marked
+	:note: safe to run again, e.g. after the text table is rebuilt or new
+		posts of a labelled thread are added; it only sets probable_spam,
+		so a thread dropped from a later version stays marked until the
+		text table is rebuilt
+	"""
+	changed = {}
+	for (set_id, name, version) in get_label_sets(conn, source, latest):
+		cur = conn.execute(apply_sql, (set_id,))
+		changed[(name, version)] = cur.rowcount
+		conn.execute(''' UPDATE label_sets SET changed=?, applied=datetime('now') WHERE id=? ''', (cur.rowcount, set_id))
+		conn.commit()
+		if verbose:
+			print("{} {}: {} posts marked as probable spam".format(name, version, cur.rowcount), flush=True)
+	return changed
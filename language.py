@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Contains functions for identifying the language of the clean text of
+# posts, written to a lang column of the text table
+
+import hashlib
+import multiprocessing
+import re
+import time
+from importlib import metadata
+from scraping import create_connection, set_bulk_pragmas
+from stages import get_rowid_chunks, get_rules_hash, get_stage_state, set_stage_state, map_processes, print_throughput
+try:
+	import langdetect
+	from langdetect import DetectorFactory, detect
+	from langdetect.lang_detect_exception import LangDetectException
+	# langdetect samples the text at random; a fixed seed gives the same
+	# language for the same text in every process and every run
+	DetectorFactory.seed = 0
+except ImportError:
+	langdetect = None
+
+## Settings
+
+range_rows = 100000 # rowids of text read at once
+batch_size = 500 # texts sent to a process at once
+max_chars = 1000 # characters of normalized text detected and hashed
+unknown = "unknown" # language of texts without letters, or that langdetect can't place
+
+## SQL
+
+lang_cache_sql = '''
+	CREATE TABLE IF NOT EXISTS lang_cache (
+		hash INTEGER PRIMARY KEY,
+		lang TEXT,
+		rules_hash TEXT
+	);
+'''
+
+select_sql = ''' SELECT rowid, text_clean FROM text WHERE rowid BETWEEN ? AND ? '''
+
+## Regex
+
+letters = re.compile(r'[^\W\d_]+')
+
+## Functions
+
+def require_langdetect():
+	""" stop if langdetect is not installed
+	:return: nothing
+	"""
+	if langdetect is None:
+		raise ImportError("identifying languages needs langdetect, pip install langdetect")
+
+def normalize(text):
+	""" the words of a text, casefolded, without numbers, punctuation or
+		extra spaces, so copies of a post differing only in those are
+		detected once
+	:param text: text of post
+	:return: normalized text, at most max_chars long
+	"""
+	if not isinstance(text, str):
+		return ""
+	return " ".join(letters.findall(text.casefold()))[:max_chars]
+
+def get_text_hash(text):
+	""" key of a normalized text in lang_cache
+	:param text: normalized text
+	:return: signed 64-bit integer
+	"""
+	return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "big", signed=True)
+
+def detect_batch(texts):
+	""" the language of each of a batch of texts, in a worker process
+	:param texts: list of normalized texts
+	:return: list of language codes, e.g. en, or unknown
+	"""
+	langs = []
+	for text in texts:
+		try:
+			langs.append(detect(text) if text else unknown)
+		except LangDetectException: # e.g. no letters langdetect knows
+			langs.append(unknown)
+	return langs
+
+def get_rules_version():
+	""" what else the languages depend on, so a new langdetect or
+		normalization empties the cache
+	:return: list of langdetect version, max_chars and seed
+	"""
+	try:
+		version = metadata.version("langdetect")
+	except metadata.PackageNotFoundError:
+		version = None
+	return [version, max_chars, DetectorFactory.seed]
+
+def set_up_lang(conn):
+	""" add the lang column to the text table, and the cache table
+	:param conn: database connection
+	:return: nothing
+	"""
+	columns = [row[1] for row in conn.execute(''' PRAGMA table_info(text) ''')]
+	if "lang" not in columns:
+		conn.execute(''' ALTER TABLE text ADD COLUMN lang TEXT ''')
+	conn.executescript(lang_cache_sql)
+
+def get_cached(conn, hashes):
+	""" read the cached languages of some texts
+	:param conn: database connection
+	:param hashes: list of text hashes
+	:return: dictionary of hash: language
+	"""
+	cached = {}
+	for i in range(0, len(hashes), 500):
+		batch = hashes[i:i + 500]
+		sql = ''' SELECT hash, lang FROM lang_cache WHERE hash IN ({}) '''.format(", ".join("?" * len(batch)))
+		cached.update(conn.execute(sql, batch).fetchall())
+	return cached
+
+def detect_missing(missing, workers):
+	""" detect the languages of texts not in the cache
+	:param missing: dictionary of hash: normalized text
+	:param workers: number of processes
+	:return: dictionary of hash: language
+	"""
+	items = list(missing.items())
+	batches = [items[i:i + batch_size] for i in range(0, len(items), batch_size)]
+	tasks = [([text for (_, text) in batch],) for batch in batches]
+	workers = min(workers, len(tasks))
+	if workers <= 1: # e.g. a daily refresh, quicker without starting a pool
+		results = ((task, detect_batch(*task)) for task in tasks)
+	else:
+		results = map_processes(detect_batch, tasks, workers)
+	found = {}
+	for (batch, (task, langs)) in zip(batches, results):
+		found.update(zip((h for (h, _) in batch), langs))
+	return found
+
+def update_languages(path_db, workers=None, rebuild=False, verbose=True):
+	""" write the language of each text added since the last run to
+		text.lang, detecting each distinct normalized text once: texts
+		detected before, in this table or before it was rebuilt, are
+		read from lang_cache
+	:param path_db: database file, with the text table
+	:param workers: number of processes, the number of cores if None
+	:param rebuild: detect every text again, emptying the cache
+	:param verbose: print the texts read, detected and written
+	:return: (texts read, texts detected)
+	:note: English posts are then t.lang='en'; the text table is
+		rebuilt by process_data without the lang column, and the next
+		run finds every language in the cache
+	"""
+	require_langdetect()
+	name = "lang"
+	workers = workers or multiprocessing.cpu_count()
+	rules_hash = get_rules_hash(select_sql, detect_batch, get_rules_version())
+	conn = create_connection(path_db)
+	set_bulk_pragmas(conn)
+	set_up_lang(conn)
+	state = get_stage_state(conn, name)
+	if rebuild or state is None or state[1] != rules_hash:
+		if rebuild:
+			conn.execute(''' DELETE FROM lang_cache ''')
+		else: # texts detected with other rules
+			conn.execute(''' DELETE FROM lang_cache WHERE rules_hash IS NOT ? ''', (rules_hash,))
+		conn.execute(''' UPDATE text SET lang=NULL WHERE lang IS NOT NULL ''')
+		conn.execute(''' DELETE FROM stage_state WHERE name=? ''', (name,))
+		conn.commit()
+		watermark = None
+	else:
+		watermark = state[0]
+	chunks = get_rowid_chunks(conn, "text", range_rows, watermark)
+	started = time.perf_counter()
+	rows_read = 0
+	rows_detected = 0
+	for (i, chunk) in enumerate(chunks):
+		rows = []
+		missing = {}
+		for (rowid, text) in conn.execute(select_sql, chunk):
+			normalized = normalize(text)
+			text_hash = get_text_hash(normalized)
+			rows.append((rowid, text_hash))
+			missing[text_hash] = normalized
+		langs = get_cached(conn, list(missing))
+		for text_hash in langs:
+			del missing[text_hash]
+		found = detect_missing(missing, workers)
+		conn.executemany(''' INSERT OR REPLACE INTO lang_cache (hash, lang, rules_hash) VALUES (?, ?, ?) ''',
+			((text_hash, lang, rules_hash) for (text_hash, lang) in found.items()))
+		langs.update(found)
+		conn.executemany(''' UPDATE text SET lang=? WHERE rowid=? ''', ((langs[text_hash], rowid) for (rowid, text_hash) in rows))
+		set_stage_state(conn, name, "text", "text", chunk[1], rules_hash, len(rows), len(rows))
+		conn.commit()
+		rows_read += len(rows)
+		rows_detected += len(found)
+		if verbose:
+			print_throughput(name, i + 1, len(chunks), rows_read, rows_read, started)
+	if verbose:
+		if chunks:
+			print("{}: {} distinct texts detected, the rest read from the cache".format(name, rows_detected), flush=True)
+		else:
+			print("{}: up to date at rowid {}".format(name, watermark), flush=True)
+	conn.close()
+	return (rows_read, rows_detected)
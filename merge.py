@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Contains functions for merging the databases scraped in shards
+
+import sqlite3
+import time
+from scraping import create_connection, set_bulk_pragmas
+from netmums import set_up_merged_db
+from youbemom import set_up_db, get_earliest_link
+from migrations import migrate, reset_version
+from search import drop_fts, set_up_fts
+from stages import reset_stages
+
+## SQL
+
+### Netmums
+
+netmums_tables_sql = '''
+	DROP TABLE IF EXISTS users;
+	DROP TABLE IF EXISTS posts;
+	DROP TABLE IF EXISTS quotes;
+	DROP TABLE IF EXISTS links;
+'''
+
+netmums_unique_sql = '''
+	CREATE UNIQUE INDEX IF NOT EXISTS users_unique ON users(name, user_url);
+	CREATE UNIQUE INDEX IF NOT EXISTS posts_unique ON posts(thread_id, post_count);
+	CREATE UNIQUE INDEX IF NOT EXISTS quotes_unique ON quotes(thread_id, quoting_id, citation_n);
+	CREATE UNIQUE INDEX IF NOT EXISTS links_unique ON links(thread_id, post_id, link_count);
+'''
+
+# indexes on the shard for the GROUP BY of each dedup, dropped after the merge
+netmums_shard_indexes_sql = '''
+	CREATE INDEX IF NOT EXISTS shard.merge_posts ON posts(thread_id, post_id, user_url, date_created, id);
+	CREATE INDEX IF NOT EXISTS shard.merge_quotes ON quotes(thread_id, quoting_id, quoted_id, quoted_user, quoted_text, citation_n, id);
+	CREATE INDEX IF NOT EXISTS shard.merge_links ON links(thread_id, post_id, link_count, link_text, link_url, id);
+'''
+
+netmums_drop_shard_indexes_sql = '''
+	DROP INDEX IF EXISTS shard.merge_posts;
+	DROP INDEX IF EXISTS shard.merge_quotes;
+	DROP INDEX IF EXISTS shard.merge_links;
+'''
+
+# posts kept after dedup, with post_count renumbered 1..n within each thread
+netmums_renumber_sql = '''
+	CREATE TEMP TABLE renumbered AS
+	SELECT p.id, p.thread_id, p.post_id,
+		ROW_NUMBER() OVER (PARTITION BY p.thread_id ORDER BY p.post_count, p.id) AS post_count
+	FROM shard.posts p
+	WHERE p.id IN (
+		SELECT MIN(id)
+		FROM shard.posts
+		GROUP BY thread_id, post_id, user_url, date_created
+	);
+	CREATE TEMP TABLE post_counts AS
+	SELECT thread_id, post_id, MIN(post_count) AS post_count
+	FROM renumbered
+	GROUP BY thread_id, post_id;
+	CREATE INDEX temp.post_counts_post ON post_counts(thread_id, post_id);
+'''
+
+netmums_insert_sql = {
+	"users": '''
+		INSERT OR IGNORE INTO main.users (name, user_url)
+		SELECT name, user_url FROM shard.users
+		ORDER BY id
+	''',
+	"posts": '''
+		INSERT OR IGNORE INTO main.posts (thread_id, post_count, post_id, user_url, date_created, date_recorded, body, version)
+		SELECT r.thread_id, r.post_count, p.post_id, p.user_url, p.date_created, p.date_recorded, p.body, p.version
+		FROM temp.renumbered r
+		JOIN shard.posts p ON p.id = r.id
+		ORDER BY r.thread_id, r.post_count
+	''',
+	"quotes": '''
+		INSERT OR IGNORE INTO main.quotes (thread_id, post_count, quoting_id, quoted_id, quoted_user, quoted_text, citation_n)
+		SELECT q.thread_id, COALESCE(c.post_count, q.post_count), q.quoting_id, q.quoted_id, q.quoted_user, q.quoted_text, q.citation_n
+		FROM shard.quotes q
+		LEFT JOIN temp.post_counts c ON c.thread_id = q.thread_id AND c.post_id = q.quoting_id
+		WHERE q.id IN (
+			SELECT MIN(id)
+			FROM shard.quotes
+			GROUP BY thread_id, quoting_id, quoted_id, quoted_user, quoted_text, citation_n
+		)
+		ORDER BY q.id
+	''',
+	"links": '''
+		INSERT OR IGNORE INTO main.links (thread_id, post_count, post_id, link_count, link_text, link_url)
+		SELECT l.thread_id, COALESCE(c.post_count, l.post_count), l.post_id, l.link_count, l.link_text, l.link_url
+		FROM shard.links l
+		LEFT JOIN temp.post_counts c ON c.thread_id = l.thread_id AND c.post_id = l.post_id
+		WHERE l.id IN (
+			SELECT MIN(id)
+			FROM shard.links
+			GROUP BY thread_id, post_id, link_count, link_text, link_url
+		)
+		ORDER BY l.id
+	''',
+}
+
+### Youbemom
+
+youbemom_tables_sql = '''
+	DROP TABLE IF EXISTS threads;
+	DROP TABLE IF EXISTS posts;
+'''
+
+# runs of missing family ids, between ids next to each other in sorted order
+youbemom_gaps_sql = '''
+	SELECT family_id + 1, next_id - 1
+	FROM (
+		SELECT family_id, LEAD(family_id) OVER (ORDER BY family_id) AS next_id
+		FROM (SELECT DISTINCT family_id FROM threads WHERE family_id IS NOT NULL)
+	)
+	WHERE next_id - family_id > 1
+'''
+
+youbemom_insert_sql = {
+	"threads": '''
+		INSERT INTO main.threads (family_id, url, subforum, dne)
+		SELECT family_id + ?, url, subforum, dne FROM shard.threads ORDER BY id
+	''',
+	"posts": '''
+		INSERT INTO main.posts (family_id, message_id, parent_id, date_recorded, date_created, title, body, subforum, deleted)
+		SELECT family_id + ?, message_id, parent_id, date_recorded, date_created, title, body, subforum, deleted FROM shard.posts ORDER BY id
+	''',
+}
+
+empty_shard_ids = 70000 # family ids left for a shard with no threads
+
+## Functions
+
+def report(step, start, rows=None):
+	""" print the time a merge step took
+	:param step: name of step
+	:param start: time.perf_counter() when the step started
+	:param rows: number of rows the step wrote
+	:return: time.perf_counter() now, to start the next step
+	"""
+	now = time.perf_counter()
+	if rows is None:
+		print("  {}: {:.1f}s".format(step, now - start), flush=True)
+	else:
+		print("  {}: {} rows, {:.1f}s".format(step, rows, now - start), flush=True)
+	return now
+
+def merge_netmums(path_merged, shards, verbose=True):
+	""" merge the users, posts, quotes and links of netmums shard
+		databases into the merged database, replacing the merged tables
+	:param path_merged: merged database file, with the forums, subforums and threads tables
+	:param shards: list of shard database files, e.g. netmums01.db to netmums05.db
+	:param verbose: print the rows and time of each step
+	:return: dictionary of table: rows in the merged table
+	:note: each shard is merged in one pass: duplicate rows are dropped with
+		a GROUP BY on indexes built on the shard up front, post_count is
+		renumbered 1..n within each thread with ROW_NUMBER(), and quotes and
+		links follow their posts to the new post_count; the merged tables
+		have unique indexes, so rows repeated across shards are skipped
+	"""
+	conn = create_connection(path_merged)
+	set_bulk_pragmas(conn)
+	set_up_merged_db(conn) # stops if threads repeat a url, before anything is dropped
+	drop_fts(conn)
+	conn.executescript(netmums_tables_sql)
+	reset_version(conn)
+	reset_stages(conn) # the posts get new rowids
+	set_up_merged_db(conn)
+	conn.executescript(netmums_unique_sql)
+	started = time.perf_counter()
+	for i, path_shard in enumerate(shards):
+		if verbose:
+			print("merging {} ({}/{})".format(path_shard, i + 1, len(shards)), flush=True)
+		start = time.perf_counter()
+		conn.execute(''' ATTACH DATABASE ? AS shard ''', (path_shard,))
+		try:
+			conn.executescript(netmums_shard_indexes_sql)
+			if verbose:
+				start = report("indexes", start)
+			conn.executescript(netmums_renumber_sql)
+			if verbose:
+				start = report("renumber", start)
+			for table in ("users", "posts", "quotes", "links"):
+				rows = conn.execute(netmums_insert_sql[table]).rowcount
+				if verbose:
+					start = report(table, start, rows)
+			conn.commit()
+		finally:
+			conn.executescript(''' DROP TABLE IF EXISTS temp.renumbered; DROP TABLE IF EXISTS temp.post_counts; ''')
+			conn.executescript(netmums_drop_shard_indexes_sql)
+			conn.commit()
+			conn.execute(''' DETACH DATABASE shard ''')
+	counts = {}
+	for table in ("users", "posts", "quotes", "links"):
+		counts[table] = conn.execute(''' SELECT COUNT(*) FROM {} '''.format(table)).fetchone()[0]
+	if verbose:
+		print("merged {} shards in {:.1f}s: {}".format(len(shards), time.perf_counter() - started, counts), flush=True)
+	migrate(conn, "netmums", verbose)
+	set_up_fts(conn, verbose=verbose)
+	conn.close()
+	return counts
+
+def scan_youbemom_shard(path_shard):
+	""" read the family id range and the gaps in the family ids of a shard
+	:param path_shard: shard database file
+	:return: (min family id, max family id, list of gaps of (first permalink,
+		last permalink, first family id, last family id)), the ids are None
+		if the shard has no threads
+	"""
+	conn = create_connection(path_shard)
+	cur = conn.cursor()
+	cur.execute(''' SELECT MIN(family_id), MAX(family_id) FROM threads ''')
+	(min_id, max_id) = cur.fetchone()
+	gaps = []
+	if min_id is not None:
+		cur.execute(youbemom_gaps_sql)
+		gaps = [(int(first), int(last)) for (first, last) in cur.fetchall()]
+		if gaps:
+			earliest_link = get_earliest_link(conn)
+			gaps = [(earliest_link + first - 1, earliest_link + last - 1, first, last) for (first, last) in gaps]
+	conn.close()
+	return (min_id, max_id, gaps)
+
+def get_youbemom_offsets(shards, verbose=True):
+	""" compute the family id offset of each shard up front, numbering
+		the shards' family ids one after another in merged order
+	:param shards: list of shard database files in merged order
+	:param verbose: print the id range and gaps of each shard
+	:return: (list of offsets, list of refetch jobs of (first permalink, last permalink, shard file))
+	:note: same numbering as the merge in notebook 1.1: the ids of a shard
+		are moved to start at 1, then shifted past the largest id of the
+		shards before it, and a shard with no threads takes up empty_shard_ids
+	"""
+	offsets = []
+	refetch = []
+	last_max = 0
+	for path_shard in shards:
+		(min_id, max_id, gaps) = scan_youbemom_shard(path_shard)
+		if min_id is None:
+			offsets.append(last_max)
+			last_max += empty_shard_ids
+			continue
+		shift = min(0, 1 - int(min_id)) # ids start at 1
+		offsets.append(shift + last_max)
+		last_max += int(max_id) + shift
+		refetch.extend((first, last, path_shard) for (first, last, first_id, last_id) in gaps)
+		if verbose:
+			missing = sum(last_id - first_id + 1 for (first, last, first_id, last_id) in gaps)
+			print("{}: ids {} to {}, {} missing in {} gaps".format(path_shard, min_id, max_id, missing, len(gaps)), flush=True)
+	return (offsets, refetch)
+
+def merge_youbemom(path_merged, shards, path_jobs=None, verbose=True):
+	""" merge the threads and posts of youbemom shard databases into
+		the merged database, replacing the merged tables
+	:param path_merged: merged database file
+	:param shards: list of shard database files in merged order, e.g. youbemomTables-01.db to youbemomTables-50.db
+	:param path_jobs: job database file to queue the missing permalinks in, see jobs.run_youbemom_gap_jobs
+	:param verbose: print the rows and time of each step
+	:return: list of refetch jobs of (first permalink, last permalink, shard file)
+	:note: the shards are not changed; family ids are remapped by an offset
+		computed up front, in one INSERT ... SELECT per table and shard
+	"""
+	started = time.perf_counter()
+	(offsets, refetch) = get_youbemom_offsets(shards, verbose)
+	conn = create_connection(path_merged)
+	set_bulk_pragmas(conn)
+	conn.executescript(youbemom_tables_sql)
+	reset_version(conn)
+	reset_stages(conn) # the posts get new rowids
+	set_up_db(conn)
+	drop_fts(conn) # set up again after the posts are inserted
+	for i, (path_shard, offset) in enumerate(zip(shards, offsets)):
+		if verbose:
+			print("merging {} ({}/{}), family ids + {}".format(path_shard, i + 1, len(shards), offset), flush=True)
+		start = time.perf_counter()
+		conn.execute(''' ATTACH DATABASE ? AS shard ''', (path_shard,))
+		try:
+			for table in ("threads", "posts"):
+				rows = conn.execute(youbemom_insert_sql[table], (offset,)).rowcount
+				if verbose:
+					start = report(table, start, rows)
+			conn.commit()
+		finally:
+			conn.execute(''' DETACH DATABASE shard ''')
+	if verbose:
+		print("merged {} shards in {:.1f}s, {} gaps to refetch".format(len(shards), time.perf_counter() - started, len(refetch)), flush=True)
+	migrate(conn, "youbemom", verbose)
+	set_up_fts(conn, verbose=verbose)
+	conn.close()
+	if path_jobs and refetch:
+		import jobs
+		jobs_conn = jobs.connect_jobs(path_jobs)
+		added = jobs.add_jobs(jobs_conn, "youbemom_gaps", refetch)
+		jobs_conn.close()
+		if verbose:
+			print("{} refetch jobs queued".format(added), flush=True)
+	return refetch
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Contains versioned migrations that index the merged databases,
+# and a benchmark of the queries the analysis runs against them
+
+import sqlite3
+import time
+from datetime import datetime
+
+## Migrations
+# (version, tables the migration needs, sql), applied in order and recorded
+# in PRAGMA user_version; a migration whose tables don't exist yet (e.g. text
+# before the spam filter has run) stops the run and is applied next time
+
+youbemom_migrations = [
+	(1, ("posts", "threads"), '''
+		CREATE INDEX IF NOT EXISTS posts_message ON posts(message_id, subforum, parent_id, family_id, date_created);
+		CREATE INDEX IF NOT EXISTS posts_subforum ON posts(subforum, parent_id, family_id, message_id);
+		CREATE INDEX IF NOT EXISTS posts_family ON posts(family_id, parent_id, message_id);
+		CREATE INDEX IF NOT EXISTS threads_family ON threads(family_id);
+		CREATE INDEX IF NOT EXISTS threads_subforum ON threads(subforum, family_id);
+	'''),
+	(2, ("text",), '''
+		CREATE INDEX IF NOT EXISTS text_message ON text(message_id);
+	'''),
+]
+
+netmums_migrations = [
+	(1, ("users", "threads", "posts", "quotes", "links"), '''
+		CREATE INDEX IF NOT EXISTS posts_thread ON posts(thread_id, post_count, user_url);
+		CREATE INDEX IF NOT EXISTS posts_user ON posts(user_url, thread_id);
+		CREATE INDEX IF NOT EXISTS users_url ON users(user_url, name);
+		CREATE INDEX IF NOT EXISTS threads_subforum ON threads(subforum_id);
+		CREATE INDEX IF NOT EXISTS quotes_thread ON quotes(thread_id, quoted_id);
+		CREATE INDEX IF NOT EXISTS links_thread ON links(thread_id, post_count);
+	'''),
+	(2, ("text",), '''
+		CREATE INDEX IF NOT EXISTS text_post ON text(post_id);
+	'''),
+]
+
+migrations = {
+	"youbemom": youbemom_migrations,
+	"netmums": netmums_migrations,
+}
+
+## Benchmark queries
+# the queries of lemmatize.gen_sql*, the sentiment and spam notebooks and the
+# user network, with fixed arguments so runs can be compared
+
+youbemom_queries = {
+	"gen_sql all": '''
+		SELECT p.family_id AS family_id, t.message_id AS message_id, t.text_clean AS text_clean
+		FROM text AS t
+		JOIN posts AS p
+		ON t.message_id = p.message_id
+		WHERE t.text_clean<>"" AND t.probable_spam=0
+	''',
+	"gen_sql toddler parent": '''
+		SELECT p.family_id AS family_id, t.message_id AS message_id, t.text_clean AS text_clean
+		FROM text AS t
+		JOIN posts AS p
+		ON t.message_id = p.message_id
+		WHERE p.subforum="toddler" AND p.parent_id="" AND t.text_clean<>"" AND t.probable_spam=0
+	''',
+	"gen_sql_dates toddler": '''
+		SELECT p.family_id AS family_id, t.message_id AS message_id, t.text_clean AS text_clean, p.date_created AS date_created
+		FROM text AS t
+		JOIN posts AS p
+		ON t.message_id = p.message_id
+		WHERE p.subforum="toddler" AND t.text_clean<>"" AND t.probable_spam=0
+	''',
+	"gen_sql_school child": '''
+		SELECT p.family_id AS family_id, t.message_id AS message_id, t.text_clean AS text_clean
+		FROM text AS t
+		JOIN posts AS p
+		ON t.message_id = p.message_id
+		WHERE (p.subforum="tween-teen" OR p.subforum="elementary" OR p.subforum="preschool") AND p.parent_id="<>" AND t.text_clean<>"" AND t.probable_spam=0
+	''',
+	"gen_samp_sql_per toddler": '''
+		SELECT family_id FROM threads WHERE subforum="toddler"
+	''',
+	"family posts": '''
+		SELECT message_id
+		FROM posts
+		WHERE family_id IN (SELECT family_id FROM threads WHERE subforum="toddler" LIMIT 1000)
+	''',
+	"sentiment family": '''
+		SELECT p.family_id, t.message_id, t.text_clean
+		FROM text AS t
+		LEFT JOIN posts AS p
+		WHERE t.message_id = p.message_id AND t.probable_spam = 0
+	''',
+}
+
+netmums_queries = {
+	"forum network": '''
+		SELECT
+			COUNT(*) AS n_posts,
+			f.id,
+			f.name,
+			p.user_url
+		FROM posts AS p
+		LEFT JOIN threads AS t
+		ON t.id=p.thread_id
+		LEFT JOIN subforums AS s
+		ON s.id=t.subforum_id
+		LEFT JOIN forums AS f
+		ON f.id=s.forum_id
+		WHERE p.user_url!="Anonymous"
+		GROUP BY
+			p.user_url,
+			f.id
+	''',
+	"quoted posts": '''
+		SELECT
+			p.thread_id AS thread_id,
+			p.post_count AS post_count,
+			p.body AS body
+		FROM posts AS p
+		LEFT JOIN users AS u
+			ON p.user_url = u.user_url
+		WHERE
+			p.thread_id IN (SELECT thread_id FROM quotes WHERE quoted_id="" LIMIT 1000)
+			AND u.name<>"Anonymous"
+			AND p.post_count<1000
+	''',
+	"unmatched quotes": '''
+		SELECT *
+		FROM quotes
+		WHERE quoted_id=""
+	''',
+	"subforum posts": '''
+		SELECT p.id, p.body
+		FROM posts AS p
+		JOIN threads AS t
+		ON t.id=p.thread_id
+		WHERE t.subforum_id=1
+	''',
+	"text posts": '''
+		SELECT p.thread_id, p.post_count, t.text_clean
+		FROM text AS t
+		JOIN posts AS p
+		ON p.id = t.post_id
+	''',
+}
+
+queries = {
+	"youbemom": youbemom_queries,
+	"netmums": netmums_queries,
+}
+
+## Functions
+
+def set_up_benchmark_db(conn):
+	""" sets up the table of query plans and timings
+		if the table doesn't exists, create it
+	:param conn: database connection
+	:return: nothing
+	"""
+	cur = conn.cursor()
+	cur.executescript('''
+		CREATE TABLE IF NOT EXISTS query_plans(
+			id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT UNIQUE,
+			name TEXT,
+			version INTEGER,
+			plan TEXT,
+			rows INTEGER,
+			seconds REAL,
+			recorded TEXT
+		);
+	''')
+	conn.commit()
+
+def get_version(conn):
+	""" version of the last migration applied to the database
+	:param conn: database connection
+	:return: user_version, 0 if never migrated
+	"""
+	return conn.execute(''' PRAGMA user_version ''').fetchone()[0]
+
+def reset_version(conn):
+	""" mark the database as never migrated, e.g. after its tables
+		were dropped and created again without indexes
+	:param conn: database connection
+	:return: nothing
+	"""
+	conn.execute(''' PRAGMA user_version = 0 ''')
+
+def has_tables(conn, tables):
+	""" check the tables exist
+	:param conn: database connection
+	:param tables: names of tables
+	:return: True if all the tables exist
+	"""
+	sql = ''' SELECT count(name) FROM sqlite_master WHERE type='table' AND name=? '''
+	return all(conn.execute(sql, (table,)).fetchone()[0] for table in tables)
+
+def migrate(conn, kind, verbose=True):
+	""" apply the migrations newer than the database's version,
+		then ANALYZE so the planner uses the new indexes
+	:param conn: database connection
+	:param kind: "youbemom" or "netmums"
+	:param verbose: print each migration and the time it took
+	:return: list of versions applied
+	"""
+	applied = []
+	for (version, tables, sql) in migrations[kind]:
+		if version <= get_version(conn):
+			continue
+		if not has_tables(conn, tables):
+			if verbose:
+				print("migration {} waits for tables {}".format(version, ", ".join(tables)), flush=True)
+			break
+		start = time.perf_counter()
+		conn.executescript("BEGIN;" + sql + "PRAGMA user_version = {}; COMMIT;".format(version))
+		applied.append(version)
+		if verbose:
+			print("migration {}: {:.1f}s".format(version, time.perf_counter() - start), flush=True)
+	if applied:
+		start = time.perf_counter()
+		conn.execute(''' ANALYZE ''')
+		conn.commit()
+		if verbose:
+			print("analyze: {:.1f}s".format(time.perf_counter() - start), flush=True)
+	return applied
+
+def explain(conn, sql):
+	""" the query plan sqlite picks for a query
+	:param conn: database connection
+	:param sql: query
+	:return: plan, one line per step, indented by depth
+	"""
+	rows = conn.execute("EXPLAIN QUERY PLAN " + sql).fetchall()
+	depth = {0: 0}
+	lines = []
+	for (node, parent, _, detail) in rows:
+		depth[node] = depth.get(parent, 0) + 1
+		lines.append("  " * (depth[node] - 1) + detail)
+	return "\n".join(lines)
+
+def benchmark(conn, kind, names=None, verbose=True):
+	""" record the plan, rows and time of the benchmark queries
+		in the query_plans table, at the database's current version
+	:param conn: database connection
+	:param kind: "youbemom" or "netmums"
+	:param names: names of queries to run, all queries if None
+	:param verbose: print each plan and time
+	:return: list of (name, plan, rows, seconds)
+	:note: queries on tables that don't exist are skipped; each query is
+		read to the end, so a full table scan costs what it would in pandas
+	"""
+	set_up_benchmark_db(conn)
+	version = get_version(conn)
+	results = []
+	for (name, sql) in queries[kind].items():
+		if names is not None and name not in names:
+			continue
+		try:
+			plan = explain(conn, sql)
+		except sqlite3.OperationalError as e:
+			if verbose:
+				print("{}: skipped, {}".format(name, e), flush=True)
+			continue
+		start = time.perf_counter()
+		rows = 0
+		for _ in conn.execute(sql):
+			rows += 1
+		seconds = time.perf_counter() - start
+		recorded = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+		conn.execute('''
+			INSERT INTO query_plans(name, version, plan, rows, seconds, recorded)
+			VALUES(?,?,?,?,?,?)
+		''', (name, version, plan, rows, seconds, recorded))
+		conn.commit()
+		results.append((name, plan, rows, seconds))
+		if verbose:
+			print("{} (version {}): {} rows, {:.2f}s\n{}".format(name, version, rows, seconds, plan), flush=True)
+	return results
+
+def compare_benchmarks(conn):
+	""" compare the latest time of each query at each version
+	:param conn: database connection
+	:return: list of (name, version, rows, seconds, speedup over the first version recorded)
+	"""
+	sql = '''
+		SELECT name, version, rows, seconds,
+			FIRST_VALUE(seconds) OVER (PARTITION BY name ORDER BY version) / seconds
+		FROM query_plans
+		WHERE id IN (SELECT MAX(id) FROM query_plans GROUP BY name, version)
+		ORDER BY name, version
+	'''
+	return conn.execute(sql).fetchall()
+
+def migrate_and_benchmark(conn, kind, verbose=True):
+	""" benchmark the queries, migrate, then benchmark them again
+		if any migration was applied
+	:param conn: database connection
+	:param kind: "youbemom" or "netmums"
+	:param verbose: print plans, times and the speedups
+	:return: list of versions applied
+	"""
+	benchmark(conn, kind, verbose=verbose)
+	applied = migrate(conn, kind, verbose)
+	if applied:
+		benchmark(conn, kind, verbose=verbose)
+	if verbose:
+		for (name, version, rows, seconds, speedup) in compare_benchmarks(conn):
+			print("{:<26} version {}: {:>9} rows {:8.2f}s {:6.1f}x".format(name, version, rows, seconds, speedup or 0))
+	return applied
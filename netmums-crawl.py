@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+## Imports
+
+from jobs import connect_jobs, add_thread_jobs, run_pool
+from scraping import create_connection
+from netmums import set_up_posts_db
+from search import optimize_fts
+from pathlib import Path
+
+## File Locations
+
+p = Path.cwd()
+path_parent = p.parents[0]
+path_db_parent = str(path_parent / "database" / "netmums-merged.db")
+path_db_child = str(path_parent / "database" / "netmums-posts.db") # merged into netmums-merged.db by 1.4-Scrape_Data-Merge_Netmums.ipynb
+path_jobs = str(path_parent / "database" / "netmums-jobs.db")
+
+## Queue threads, skipping threads already queued
+
+if __name__ == "__main__":
+    conn = create_connection(path_db_parent)
+    cur = conn.cursor()
+    cur.execute(''' SELECT id, url FROM threads ''')
+    rows = cur.fetchall()
+    conn.close()
+
+    conn = connect_jobs(path_jobs)
+    print("{} jobs added".format(add_thread_jobs(conn, rows)))
+    conn.close()
+
+## Scrape threads into one database shared by the workers, set up here once
+
+    conn = create_connection(path_db_child)
+    set_up_posts_db(conn)
+    conn.close()
+    run_pool(path_jobs, path_db_child, "netmums", workers=5, batch=8)
+
+## Merge the segments the new posts added to the full-text index
+
+    conn = create_connection(path_db_child)
+    optimize_fts(conn)
+    conn.close()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+## Imports
+
+from netmums import *
+from scraping import *
+from jobs import connect_jobs, reset_thread_jobs, run_pool
+from search import optimize_fts
+from pathlib import Path
+
+## File Locations
+
+p = Path.cwd()
+path_parent = p.parents[0]
+path_db_parent = str(path_parent / "database" / "netmums-merged.db")
+path_db_child = str(path_parent / "database" / "netmums-posts.db")
+path_jobs = str(path_parent / "database" / "netmums-jobs.db")
+path_validators = str(path_parent / "database" / "netmums-validators.json")
+
+if __name__ == "__main__":
+
+## Load the ETag and Last-Modified of the pages fetched by the last delta
+
+    if Path(path_validators).exists():
+        load_validators(path_validators)
+
+## Read the subforum indexes, adding threads not seen before
+
+    conn = create_connection(path_db_parent)
+    set_up_merged_db(conn)
+    cur = conn.cursor()
+    cur.execute(''' SELECT id, url FROM subforums ''')
+    subforums = cur.fetchall()
+    listing = []
+    for row in subforums:
+        (subforum_id, url) = row
+        for soup in iter_index_pages(row):
+            for (thread_url, subject, replies) in write_threads(cur, soup, subforum_id):
+                cur.execute(''' SELECT id FROM threads WHERE url=? ''', (thread_url,))
+                listing.append((cur.fetchone()[0], thread_url, replies))
+        conn.commit()
+    conn.close()
+
+## Find the threads that are new or gained posts since they were scraped,
+## counting the threads of the merged netmums01 to netmums05 shards as scraped
+
+    conn = create_connection(path_db_child)
+    set_up_posts_db(conn)
+    seed_checkpoints(conn, path_db_parent)
+    rows = find_changed_threads(conn, listing, conditional=True)
+    conn.close()
+
+## Scrape them, resuming changed threads at their last page
+
+    conn = connect_jobs(path_jobs)
+    print("{} of {} threads queued".format(reset_thread_jobs(conn, rows), len(listing)))
+    conn.close()
+    run_pool(path_jobs, path_db_child, "netmums", workers=5, batch=8)
+
+## Merge the segments the new posts added to the full-text index
+
+    conn = create_connection(path_db_child)
+    optimize_fts(conn)
+    conn.close()
+
+## Save the validators for the next delta
+
+    save_validators(path_validators)
@@ -5,6 +5,7 @@
 
 from netmums import *
 from scraping import *
+from search import optimize_fts
 from pathlib import Path
 
 ## File Locations
@@ -24,9 +25,9 @@ cur.execute(''' SELECT MAX(thread_id) FROM posts ''')
 max_thread = cur.fetchone()[0]
 if max_thread == None:
     first = 1
-else: # restart scraping from last complete thread id
-    cur.execute(''' DELETE FROM posts WHERE thread_id=?''', (max_thread,))
-    conn.commit()
+else: # resume scraping the last thread after its last written page
+    if max_thread not in load_checkpoints(conn, [max_thread]):
+        clear_thread(conn, max_thread) # written before checkpoints, restart the thread
     first = max_thread
 conn.close()
 
@@ -43,7 +44,7 @@ set_up_posts_db(conn)
 
 ## Scrape threads
 
-for row in rows:
-    scrape_posts(conn, row)
+scrape_posts_concurrent(conn, rows)
+optimize_fts(conn)
 
 conn.close()
@@ -4,7 +4,12 @@
 # Contains functions for scraping Netmums forum posts
 
 import re
+import html
 import sqlite3
+import threading
+from collections import OrderedDict
+from functools import partial
+from html.parser import HTMLParser
 from datetime import datetime, timedelta
 from bs4 import BeautifulSoup, Doctype
 from dateutil.parser import parse
@@ -12,6 +17,7 @@ from scraping import *
 import json
 import emoji
 import time
+from search import set_up_fts
 
 ## Regex
 
@@ -20,6 +26,42 @@ sent_from = re.compile(r'sent\s+from\s+my\s+[a-z0-9\-]*\s+using\s+netmums\s+mobi
 shortened_url = re.compile(r'\[\.\.\.\]', re.IGNORECASE)
 extra_spaces = re.compile(r'\s+')
 url_id = re.compile(r'#post([0-9]+)')
+index_page = re.compile(r'index([0-9]+)\.html')
+listing_replies_class = "sujetCase5" # cell of the reply count in subforum index rows, if listed
+
+### Markers of pages from the new version of the forum, read without a soup
+
+doctype_tag = re.compile(rb'^(?:\xef\xbb\xbf)?\s*<!doctype\s+([^>]*)>', re.IGNORECASE)
+next_data_script = re.compile(rb'<script\b[^>]*\bid\s*=\s*["\']__NEXT_DATA__["\'][^>]*>(.*?)</script\s*>', re.IGNORECASE | re.DOTALL)
+error404_div = re.compile(rb'<div\b[^>]*\bclass\s*=\s*["\'][^"\']*(?<![\w-])error-404(?![\w-])', re.IGNORECASE)
+faq_meta = re.compile(rb'<meta\b[^>]*\bcontent\s*=\s*["\']Netmums FAQs["\']', re.IGNORECASE)
+link_tag = re.compile(rb'<link\b[^>]*>', re.IGNORECASE)
+tag_attribute = re.compile(rb'([\w-]+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+fragment_cleaners = threading.local()
+unclosed_tag = re.compile(r'<[a-zA-Z/!?][^>]*$')
+void_tags = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "param", "source", "track", "wbr"}
+
+## User cache
+
+user_cache_size = 100000 # users remembered per process, least recently seen dropped first
+user_cache = OrderedDict() # user_url: name last written
+user_cache_lock = threading.Lock()
+
+# tags html5lib moves text around for, or reads the contents of differently
+restructured_tags = {"table", "caption", "colgroup", "tbody", "thead", "tfoot", "tr", "td", "th", "select", "option",
+	"template", "svg", "math", "html", "head", "body", "frameset", "title", "textarea", "pre", "listing", "plaintext",
+	"xmp", "noscript", "iframe", "noembed", "noframes", "script", "style", "form", "button", "nobr"}
+
+## Errors
+
+class PageError(Exception):
+	""" a page of a thread still failed after the retries of get_page,
+		so the thread stops at the last page written and is not done
+	"""
+	def __init__(self, thread_id, url):
+		super().__init__("thread {} stopped at {}".format(thread_id, url))
+		self.thread_id = thread_id
+		self.url = url
 
 ## Functions for creating and writing to the database
 
@@ -28,6 +70,7 @@ def set_up_posts_db(conn):
 		if the table doesn't exists, create it
 	:param conn: database connection
 	:return: nothing
+	:note: also sets up the full-text index of posts, see search.set_up_fts
 	"""
 	cur = conn.cursor()
 	cur.executescript('''
@@ -66,7 +109,36 @@ def set_up_posts_db(conn):
 			link_text TEXT,
 			link_url TEXT
 		);
+		CREATE TABLE IF NOT EXISTS checkpoints(
+			thread_id INTEGER NOT NULL PRIMARY KEY,
+			page INTEGER,
+			post_count INTEGER,
+			next_url TEXT,
+			url TEXT,
+			done INTEGER DEFAULT 0
+		);
+		CREATE TABLE IF NOT EXISTS thread_state(
+			thread_id INTEGER NOT NULL PRIMARY KEY,
+			pages INTEGER,
+			post_count INTEGER,
+			last_page_url TEXT,
+			last_page_start INTEGER,
+			url TEXT,
+			last_post_id TEXT,
+			last_date TEXT,
+			listing_replies INTEGER,
+			updated TEXT,
+			pending_replies INTEGER,
+			deleted INTEGER
+		);
 	''')
+	columns = [row[1] for row in cur.execute(''' PRAGMA table_info(thread_state) ''')]
+	for column in ("pending_replies", "deleted"):
+		if column not in columns: # thread_state from before it was added
+			cur.execute(''' ALTER TABLE thread_state ADD COLUMN {} INTEGER '''.format(column))
+	set_up_users_index(conn)
+	clear_user_cache()
+	set_up_fts(conn, verbose=False)
 
 def set_up_merged_db(conn):
 	""" sets up tables in netmums database
@@ -129,6 +201,122 @@ def set_up_merged_db(conn):
 			link_url TEXT
 		);
 	''')
+	set_up_threads_url_index(conn)
+
+def set_up_threads_url_index(conn):
+	""" makes threads.url unique, so thread rows can be upserted
+		if the index doesn't exist, create it
+	:param conn: database connection
+	:return: nothing
+	:note: doesn't change the threads: if urls are repeated, stops and
+		asks for merge_duplicate_threads, which also moves the posts,
+		checkpoints and jobs of the repeated threads
+	"""
+	cur = conn.cursor()
+	cur.execute(''' SELECT count(name) FROM sqlite_master WHERE type='index' AND name='threads_url' ''')
+	if cur.fetchone()[0]:
+		return
+	cur.execute(''' SELECT COUNT(*) - COUNT(DISTINCT url) FROM threads ''')
+	duplicates = cur.fetchone()[0]
+	if duplicates:
+		raise sqlite3.IntegrityError("{} threads repeat the url of another thread, "
+			"run netmums.merge_duplicate_threads first".format(duplicates))
+	cur.execute(''' CREATE UNIQUE INDEX threads_url ON threads(url) ''')
+	conn.commit()
+
+def merge_duplicate_threads(conn, paths_posts=(), path_jobs=None, verbose=True):
+	""" merge threads with the same url into the one with the lowest id,
+		then make threads.url unique
+		in each database, the rows of a repeated thread are moved to the
+		kept thread if it has none of its own there, and deleted if it
+		has, as the same thread scraped twice
+	:param conn: connection to the database with the threads table
+	:param paths_posts: database files of posts, checkpoints and thread_state
+		besides the database of conn, e.g. netmums01.db to netmums05.db
+		and netmums-posts.db; every one the threads were scraped into,
+		since the repeated threads are gone after the first run
+	:param path_jobs: job database file with netmums jobs to move, if any
+	:return: number of threads merged
+	:note: every database is changed in one transaction
+	"""
+	schemas = ["main"]
+	for (i, path_posts) in enumerate(paths_posts):
+		schema = "posts_db{}".format(i)
+		conn.execute(''' ATTACH DATABASE ? AS {} '''.format(schema), (path_posts,))
+		schemas.append(schema)
+	if path_jobs:
+		conn.execute(''' ATTACH DATABASE ? AS jobs_db ''', (path_jobs,))
+	try:
+		cur = conn.cursor()
+		cur.execute('''
+			SELECT t.id, k.id
+			FROM threads AS t
+			JOIN (SELECT url, MIN(id) AS id FROM threads GROUP BY url) AS k ON k.url = t.url
+			WHERE t.id <> k.id
+			ORDER BY t.id
+		''')
+		pairs = cur.fetchall()
+		moved = {}
+		deleted = {}
+		for (duplicate_id, kept_id) in pairs:
+			for schema in schemas:
+				tables = [row[0] for row in cur.execute(''' SELECT name FROM {}.sqlite_master WHERE type='table' '''.format(schema))]
+				tables = [t for t in ("posts", "quotes", "links", "checkpoints", "thread_state") if t in tables]
+				kept_rows = sum(cur.execute(''' SELECT COUNT(*) FROM {}.{} WHERE thread_id=? '''.format(schema, t), (kept_id,)).fetchone()[0]
+					for t in tables if t in ("posts", "checkpoints"))
+				for table in tables:
+					name = "{}.{}".format(schema, table)
+					if kept_rows:
+						cur.execute(''' DELETE FROM {} WHERE thread_id=? '''.format(name), (duplicate_id,))
+						deleted[name] = deleted.get(name, 0) + cur.rowcount
+					else:
+						cur.execute(''' UPDATE {} SET thread_id=? WHERE thread_id=? '''.format(name), (kept_id, duplicate_id))
+						moved[name] = moved.get(name, 0) + cur.rowcount
+			if path_jobs:
+				cur.execute(''' UPDATE OR IGNORE jobs_db.jobs SET first=?, last=? WHERE kind='netmums' AND first=? ''', (kept_id, kept_id, duplicate_id))
+				moved["jobs"] = moved.get("jobs", 0) + cur.rowcount
+				cur.execute(''' DELETE FROM jobs_db.jobs WHERE kind='netmums' AND first=? ''', (duplicate_id,))
+				deleted["jobs"] = deleted.get("jobs", 0) + cur.rowcount
+		cur.executemany(''' DELETE FROM main.threads WHERE id=? ''', ((duplicate_id,) for (duplicate_id, kept_id) in pairs))
+		cur.execute(''' CREATE UNIQUE INDEX IF NOT EXISTS main.threads_url ON threads(url) ''')
+		conn.commit()
+	except:
+		conn.rollback()
+		raise
+	finally:
+		attached = [row[1] for row in conn.execute(''' PRAGMA database_list ''')]
+		for schema in schemas[1:] + ["jobs_db"]:
+			if schema in attached:
+				conn.execute(''' DETACH DATABASE {} '''.format(schema))
+	if verbose:
+		print("merged {} duplicate threads, rows moved: {}, rows deleted: {}".format(len(pairs), moved, deleted), flush=True)
+	return len(pairs)
+
+def set_up_users_index(conn):
+	""" makes users unique by name and url, so users can be inserted or ignored
+		if the index doesn't exist, delete duplicate users keeping
+		the lowest id, then create it
+	:param conn: database connection
+	:return: number of duplicate users deleted
+	"""
+	cur = conn.cursor()
+	cur.execute(''' SELECT count(name) FROM sqlite_master WHERE type='index' AND name='users_name_url' ''')
+	if cur.fetchone()[0]:
+		return 0
+	cur.execute(''' DELETE FROM users WHERE id NOT IN (SELECT MIN(id) FROM users GROUP BY name, user_url) ''')
+	deleted = cur.rowcount
+	if deleted:
+		print("deleted {} duplicate users".format(deleted))
+	cur.execute(''' CREATE UNIQUE INDEX users_name_url ON users(name, user_url) ''')
+	conn.commit()
+	return deleted
+
+def clear_user_cache():
+	""" forget the users written, e.g. when switching databases
+	:return: nothing
+	"""
+	with user_cache_lock:
+		user_cache.clear()
 
 def write_citation(cur, thread_id, post_count, quoting_id, quoted_id, quoted_user, quoted_text, citation_n):
 	""" writes citation ids to the quotes table,
@@ -168,21 +356,108 @@ def write_post(cur, thread_id, post_count, post_id, user_url, date_created, body
 	cur.execute(sql, parsed)
 
 def write_user(cur, name, user_url):
-	""" write user information to users table
+	""" write user information to users table,
+		unless it was the last name written for the url
 	:param name: string of name
 	:param user_url: url of profile
 	:return: nothing
-	:note: does not check for duplicates,
-		will delete duplicates after scrape
-		to make writing quicker
+	:note: users seen recently are kept in user_cache, so most posts
+		don't write at all; the rest are ignored by the unique index
 	"""
+	with user_cache_lock:
+		if user_cache.get(user_url) == name:
+			user_cache.move_to_end(user_url)
+			return
+		user_cache[user_url] = name
+		user_cache.move_to_end(user_url)
+		if len(user_cache) > user_cache_size:
+			user_cache.popitem(last=False)
 	parsed = (name, user_url)
 	sql = '''
-		INSERT INTO users(name, user_url)
+		INSERT OR IGNORE INTO users(name, user_url)
 		VALUES(?,?)
 	'''
 	cur.execute(sql, parsed)
 
+def write_checkpoint(cur, thread_id, page, post_count, next_url, url, done=0):
+	""" record the last page of a thread written, committed
+		with the posts of the page so a restart resumes after it
+	:param thread_id: id of thread, linked to threads table
+	:param page: number of the last page written
+	:param post_count: count of posts in thread after the page
+	:param next_url: url of the next page or False if none
+	:param url: url the pages of the new version of the forum are numbered from
+	:param done: 1 if there are no more pages in the thread
+	:return: nothing
+	"""
+	sql = '''
+		INSERT OR REPLACE INTO checkpoints(thread_id,page,post_count,next_url,url,done)
+		VALUES(?,?,?,?,?,?)
+	'''
+	parsed = (thread_id, page, post_count, next_url or None, url, done)
+	cur.execute(sql, parsed)
+
+def load_checkpoints(conn, thread_ids):
+	""" read the checkpoints of threads
+	:param thread_ids: ids of threads
+	:return: dictionary of thread_id: (page, post_count, next_url, url, done)
+	"""
+	sql = ''' SELECT thread_id, page, post_count, next_url, url, done FROM checkpoints WHERE thread_id=? '''
+	checkpoints = {}
+	for thread_id in thread_ids:
+		row = conn.execute(sql, (thread_id,)).fetchone()
+		if row:
+			checkpoints[row[0]] = row[1:]
+	return checkpoints
+
+def clear_thread(conn, thread_id):
+	""" delete everything written for a thread, so it is scraped again from page 1
+	:param thread_id: id of thread, linked to threads table
+	:return: nothing
+	"""
+	for table in ("posts", "quotes", "links", "checkpoints"):
+		conn.execute(''' DELETE FROM {} WHERE thread_id=? '''.format(table), (thread_id,))
+	conn.commit()
+
+def write_thread_state(cur, thread_id, pages, post_count, last_page_url, last_page_start, url, last_post_id, last_date):
+	""" record what a finished thread looked like, to compare with the
+		subforum index in a delta crawl, see find_changed_threads
+	:param pages: number of pages in thread
+	:param post_count: count of posts in thread
+	:param last_page_url: url of the last page
+	:param last_page_start: count of posts in thread before the last page
+	:param url: url the pages of the new version of the forum are numbered from
+	:param last_post_id: id of the last post
+	:param last_date: date the last post was created
+	:return: nothing
+	:note: the reply count the subforum index listed when the thread was
+		reopened, pending_replies, becomes the count it was scraped for,
+		listing_replies, now that the thread is finished; a thread marked
+		deleted by find_changed_threads is unmarked
+	"""
+	sql = '''
+		INSERT INTO thread_state(thread_id,pages,post_count,last_page_url,last_page_start,url,last_post_id,last_date,updated)
+		VALUES(?,?,?,?,?,?,?,?,?)
+		ON CONFLICT(thread_id) DO UPDATE SET pages=excluded.pages, post_count=excluded.post_count,
+			last_page_url=excluded.last_page_url, last_page_start=excluded.last_page_start, url=excluded.url,
+			last_post_id=excluded.last_post_id, last_date=excluded.last_date, updated=excluded.updated,
+			listing_replies=COALESCE(thread_state.pending_replies, thread_state.listing_replies), pending_replies=NULL,
+			deleted=NULL
+	'''
+	updated = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+	parsed = (thread_id, pages, post_count, last_page_url, last_page_start, url, last_post_id, last_date, updated)
+	cur.execute(sql, parsed)
+
+def clear_after(cur, thread_id, post_count):
+	""" delete the posts of a thread after a post count, before its
+		last page is written again
+	:param thread_id: id of thread, linked to threads table
+	:param post_count: count of posts in thread to keep
+	:return: nothing
+	"""
+	for table in ("posts", "quotes", "links"):
+		cur.execute(''' DELETE FROM {} WHERE thread_id=? AND post_count>? '''.format(table), (thread_id, post_count))
+
 def write_link(cur, thread_id, post_count, post_id, link_count, link_text, link_url):
 	""" write link information to links table
 	:param thread_id: id of thread, linked to threads table
@@ -216,30 +491,99 @@ def keep_forum(name):
 
 ### Threads
 
-def scrape_threads(cur, row):
+def scrape_threads(cur, row, max_workers=8):
 	""" scrape information on threads from list of subforums
 	:param row: row selected from subforum table
+	:param max_workers: number of index pages fetched at once
 	:return: nothing
 	"""
-	page = 1
+	(subforum_id, url) = row
+	for soup in iter_index_pages(row, max_workers):
+		write_threads(cur, soup, subforum_id)
+
+def iter_index_pages(row, max_workers=8):
+	""" fetch the index pages of a subforum in order
+	:param row: row selected from subforum table
+	:param max_workers: number of index pages fetched at once
+	:return: generator of soups of index pages with threads
+	:note: the page count is read from the pagination links of the first
+		page and the rest are fetched concurrently; the page after the
+		last is checked in case the links were cut short, and if there
+		are no links pages are probed in batches of max_workers until
+		one has no threads
+	"""
 	(subforum_id, url) = row
 	next_url = url + "index{}.html"
 	soup = get_soup(url)
-	not_end = True
-	while not_end:
-		if soup.find("a", {"class": "cCatTopic"}):
-			for thread in soup.find_all("td", {"class": "sujetCase3"}):
-				link = thread.find("a", {"class": "cCatTopic"})
-				parsed = (link['href'], link.get_text(), subforum_id)
-				sql = '''
-					INSERT INTO threads(url,subject,subforum_id)
-					VALUES(?,?,?)
-				'''
-				cur.execute(sql, parsed)
-			page += 1
-			soup = get_soup(next_url.format(str(page)))
-		else:
-			not_end = False
+	if not soup or not soup.find("a", {"class": "cCatTopic"}):
+		return
+	yield soup
+	last_page = get_index_page_count(soup)
+	urls = [next_url.format(str(p)) for p in range(2, last_page + 1)]
+	page = last_page
+	batch = 1 if last_page > 1 else max_workers
+	while True:
+		for page_url, soup in map_concurrent(get_soup, urls, max_workers):
+			if not soup or not soup.find("a", {"class": "cCatTopic"}):
+				return
+			yield soup
+		urls = [next_url.format(str(p)) for p in range(page + 1, page + batch + 1)]
+		page += batch
+		batch = max_workers
+
+def get_index_page_count(soup):
+	""" get the number of the last index page linked from an index page
+	:param soup: soup of the first index page
+	:return: number of last page, 1 if there are no links to other pages
+	"""
+	pages = [1]
+	for link in soup.find_all("a", href=True):
+		match = re.search(index_page, link['href'])
+		if match:
+			pages.append(int(match.group(1)))
+	return max(pages)
+
+def read_threads(soup):
+	""" read the threads listed on a subforum index page
+	:param soup: soup of the index page
+	:return: list of (url, subject, replies), replies is None if not listed
+	"""
+	threads = []
+	for thread in soup.find_all("td", {"class": "sujetCase3"}):
+		link = thread.find("a", {"class": "cCatTopic"})
+		threads.append((link['href'], link.get_text(), get_listing_replies(thread)))
+	return threads
+
+def get_listing_replies(thread):
+	""" get the reply count of a thread from its row in the subforum index
+	:param thread: subject cell of the thread's row
+	:return: count of replies or None if not listed
+	"""
+	row = thread.find_parent("tr")
+	if row:
+		cell = row.find("td", {"class": listing_replies_class})
+		if cell:
+			replies = cell.get_text().strip().replace(",", "")
+			if replies.isdigit():
+				return int(replies)
+	return None
+
+def write_threads(cur, soup, subforum_id):
+	""" write the threads listed on a subforum index page,
+		updating threads already written
+	:param soup: soup of the index page
+	:param subforum_id: id of subforum, linked to subforums table
+	:return: list of (url, subject, replies) written
+	:note: needs the unique index on threads.url, see set_up_threads_url_index
+	"""
+	threads = read_threads(soup)
+	sql = '''
+		INSERT INTO threads(url,subject,subforum_id)
+		VALUES(?,?,?)
+		ON CONFLICT(url) DO UPDATE SET subject=excluded.subject, subforum_id=excluded.subforum_id
+	'''
+	cur.executemany(sql, ((url, subject, subforum_id) for (url, subject, replies) in threads))
+	return threads
 
 ### Posts
 
@@ -352,10 +696,11 @@ def get_citations_old(cur, post, thread_id, post_count, post_id):
 		write_citation(cur, thread_id, post_count, post_id, cite_id, cited_user, "", i + 1)
 	return len(citations)
 
-def process_citation_new(cur, cite, thread_id, post_count, post_id, citation_n):
+def process_citation_new(cur, cite, thread_id, post_count, post_id, citation_n, content=None):
 	""" finds the citations in a post using the new interface
 	:param cite: citation content json
 	:param post_id: post id
+	:param content: cleaned text of the quote, if already cleaned
 	:return: length of citations list
 	:note: writes citations to quotes table
 	"""
@@ -363,7 +708,8 @@ def process_citation_new(cur, cite, thread_id, post_count, post_id, citation_n):
 		cited_user = "Anonymous"
 	else:
 		cited_user = cite["quotedPostAuthor"]["pseudo"]
-	content = clean_text_new(cur, cite["quotedPostContent"], thread_id, post_count, post_id, write=False)
+	if content is None:
+		content = clean_text_new(cur, cite["quotedPostContent"], thread_id, post_count, post_id, write=False)
 	write_citation(cur, thread_id, post_count, post_id, "", cited_user, content, citation_n)
 
 def id_from_url(text):
@@ -399,10 +745,11 @@ def replace_breaks(soup):
 		br.replace_with('\n')
 	return soup
 
-def replace_hrefs(cur, soup, thread_id, post_count, post_id, write=True):
+def replace_hrefs(cur, soup, thread_id, post_count, post_id, write=True, links=None):
 	""" finds any links in the body with shortened urls
 		and replaces them with the full url
 	:param soup: post body
+	:param links: list to add (link_count, link_text, link_url) of each link to
 	:return: soup cleaned of shortened urls
 	"""
 	hrefs = soup.find_all("a")
@@ -413,19 +760,147 @@ def replace_hrefs(cur, soup, thread_id, post_count, post_id, write=True):
 		href.string = "::link_{}::".format(link_count)
 		if write:
 			write_link(cur, thread_id, post_count, post_id, link_count, link_text, link_url)
+		if links is not None:
+			links.append((link_count, link_text, link_url))
 	return soup
 
+class FragmentCleaner(HTMLParser):
+	""" streaming cleaner for the html of a post from the new interface,
+		does in one pass what replace_breaks, replace_emojis and
+		replace_hrefs do to a soup
+	:note: sets broken if the html is not well nested or has tags that
+		html5lib would restructure, then the result can't be used
+	"""
+	def __init__(self):
+		super().__init__(convert_charrefs=True)
+		self.text = []
+		self.links = []
+		self.link = None # [link_url, list of link text] of the open link
+		self.open_tags = []
+		self.broken = False
+
+	def clean(self, content):
+		""" clean one fragment
+		:param content: html of the fragment
+		:return: (text, list of (link_count, link_text, link_url))
+		"""
+		self.reset()
+		self.text = []
+		self.links = []
+		self.link = None
+		self.open_tags = []
+		self.broken = False
+		# html5lib normalizes new lines before parsing
+		self.feed(content.replace("\r\n", "\n").replace("\r", "\n"))
+		self.close()
+		self.end_link()
+		if self.open_tags:
+			self.broken = True
+		return "".join(self.text), self.links
+
+	def add_text(self, text):
+		if self.link is None:
+			self.text.append(text)
+		else:
+			self.link[1].append(text)
+
+	def end_link(self):
+		if self.link is not None:
+			link_count = len(self.links) + 1
+			self.links.append((link_count, "".join(self.link[1]), self.link[0]))
+			self.text.append("::link_{}::".format(link_count))
+			self.link = None
+
+	def handle_starttag(self, tag, attrs):
+		if tag in restructured_tags:
+			self.broken = True
+		if tag not in void_tags:
+			self.open_tags.append(tag)
+		if tag == "br":
+			self.add_text("\n")
+		elif tag == "img":
+			attrs = dict(attrs)
+			if "wysiwyg_smiley" in (attrs.get("class") or "").split():
+				if "title" in attrs:
+					self.add_text(" " + (attrs["title"] or "") + " ")
+				else:
+					self.add_text(" ::emoji:: ")
+		elif tag == "a":
+			if self.link is not None: # html5lib splits nested links
+				self.broken = True
+			self.link = [dict(attrs).get("href"), []]
+
+	def handle_startendtag(self, tag, attrs):
+		if tag not in void_tags: # html5lib ignores the / and leaves the tag open
+			self.broken = True
+		self.handle_starttag(tag, attrs)
+
+	def handle_endtag(self, tag):
+		if tag == "br": # </br> is read as <br>
+			self.add_text("\n")
+		elif tag in void_tags:
+			pass
+		elif self.open_tags and self.open_tags[-1] == tag:
+			self.open_tags.pop()
+			if tag == "a":
+				self.end_link()
+		else:
+			self.broken = True
+
+	def handle_data(self, data):
+		self.add_text(data)
+
+	def handle_decl(self, decl):
+		self.broken = True
+
+	def handle_pi(self, data):
+		self.broken = True
+
+	def unknown_decl(self, data):
+		self.broken = True
+
+def clean_fragment(post_content):
+	""" cleans the html of a post or quote from the new interface
+	:param post_content: html of the post
+	:return: (text before strip_text, list of (link_count, link_text, link_url))
+	:note: html the streaming cleaner can't read the same way as html5lib
+		goes through make_soup, so broken markup is repaired as before
+	"""
+	if not re.search(unclosed_tag, post_content):
+		if not hasattr(fragment_cleaners, "cleaner"):
+			fragment_cleaners.cleaner = FragmentCleaner()
+		cleaner = fragment_cleaners.cleaner
+		(text, links) = cleaner.clean(post_content)
+		if not cleaner.broken:
+			return text, links
+	links = []
+	content = make_soup(post_content, repair=True)
+	content = replace_breaks(content)
+	content = replace_emojis(content)
+	content = replace_hrefs(None, content, None, None, None, write=False, links=links)
+	return content.get_text(), links
+
+def clean_fragments(contents):
+	""" cleans a batch of html fragments, e.g. all posts and quotes on a page
+	:param contents: list of html of the posts
+	:return: list of (stripped text, list of (link_count, link_text, link_url))
+	"""
+	cleaned = []
+	for post_content in contents:
+		(text, links) = clean_fragment(post_content)
+		cleaned.append((strip_text(text), links))
+	return cleaned
+
 def clean_text_new(cur, post_content, thread_id, post_count, post_id, write=True):
 	""" cleans the text from the new interface
 	:param text: text to clean
 	returns: clean text
 	"""
-	content = BeautifulSoup(post_content, "html5lib")
-	content = replace_breaks(content)
-	content = replace_emojis(content)
-	content = replace_hrefs(cur, content, thread_id, post_count, post_id, write)
-	content = content.get_text()
-	return strip_text(content)
+	(text, links) = clean_fragment(post_content)
+	if write:
+		for (link_count, link_text, link_url) in links:
+			write_link(cur, thread_id, post_count, post_id, link_count, link_text, link_url)
+	return strip_text(text)
 
 def get_text_no_cite(cur, post, thread_id, post_count, post_id):
 	""" finds the text from posts with no citations
@@ -461,8 +936,15 @@ def get_text_cite(cur, post, thread_id, post_count, post_id):
 
 def get_posts(soup):
 	script = soup.find("script", {"id":"__NEXT_DATA__"})
-	script = script.get_text()
+	script = script.string
 	script = json.loads(script)
+	return get_posts_json(script)
+
+def get_posts_json(script):
+	""" get the posts from the decoded __NEXT_DATA__ json
+	:param script: dict of the json
+	:return: list of post json
+	"""
 	return script["props"]["pageProps"]["initialReduxState"]["currentThread"]["currentThread"]["pagePosts"]
 
 def is_error(soup):
@@ -470,92 +952,484 @@ def is_error(soup):
 		return True
 	return False
 
-def scrape_posts(conn, row):
-	""" scrape information on posts from threads table
+def is_error_content(content):
+	""" checks the html for a Cloudflare error page without building a soup
+	:param content: bytes of page
+	:return: bool
+	"""
+	if re.search(cloudflare_error, content):
+		return True
+	return False
+
+def get_canonical(content):
+	""" finds the href of the canonical link in the html
+	:param content: bytes of page
+	:return: canonical url or None if not found
+	"""
+	for tag in re.finditer(link_tag, content):
+		attributes = {}
+		for name, double, single in re.findall(tag_attribute, tag.group(0)):
+			attributes[name.lower()] = double or single
+		if b"canonical" in attributes.get(b"rel", b"").lower().split() and b"href" in attributes:
+			return html.unescape(attributes[b"href"].decode("utf-8", "replace"))
+	return None
+
+def read_new_page(content):
+	""" reads a page from the new version of the forum straight from
+		the html, without building a soup
+	:param content: bytes of page
+	:return: dict of error404, faq, canonical and posts (None if the json
+		can't be read), or None if the page needs a full parse
+	:note: only pages that are clearly the new version are read here,
+		old pages and anything unexpected go through make_soup
+	"""
+	doctype = re.match(doctype_tag, content)
+	if not doctype or doctype.group(1).strip().lower() != b"html":
+		return None
+	script = re.search(next_data_script, content)
+	canonical = get_canonical(content)
+	if not script or not canonical:
+		return None
+	try:
+		posts = get_posts_json(json.loads(script.group(1)))
+	except:
+		posts = None
+	return {
+		"error404": bool(re.search(error404_div, content)),
+		"faq": bool(re.search(faq_meta, content)),
+		"canonical": canonical,
+		"posts": posts,
+	}
+
+def read_new_soup(soup):
+	""" reads a page from the new version of the forum from its soup
+	:param soup: soup of page
+	:return: dict of error404, faq, canonical and posts (None if the json
+		can't be read)
+	"""
+	page = {
+		"error404": bool(soup.find("div", {"class":"error-404"})),
+		"faq": bool(soup.find("meta", {"content":"Netmums FAQs"})),
+		"canonical": None,
+		"posts": None,
+	}
+	canonical_link = soup.find("link", {"rel":"canonical"})
+	if canonical_link:
+		page["canonical"] = canonical_link["href"]
+	try:
+		page["posts"] = get_posts(soup)
+	except:
+		pass
+	return page
+
+def get_page(thread_id, next_url, conditional=False):
+	""" get the html of a thread page, retrying while the page is an error
+	:param thread_id: id of thread, linked to threads table
+	:param next_url: url of the page
+	:param conditional: only get the page if it changed since it was last fetched
+	:return content: bytes of the page, False if it is still an error
+		or None if not modified
+	:note: writes skipped pages to errors.csv, retries wait for the host's
+		rate limiter to recover from the error, see HostLimiter
+	"""
+	content = fetch_content(next_url, conditional)
+	error_count = 0
+	while not (conditional and content is None) and (not content or is_error_content(content)):
+		error_count += 1
+		if error_count > 5 or archive.replay: # archived pages don't change
+			print("skip next url:", next_url)
+			write_list("errors.csv", [thread_id,next_url])
+			return False
+		content = fetch_content(next_url, conditional)
+	return content
+
+def iter_thread_pages(row, checkpoint=None, conditional=False):
+	""" fetch the pages of a thread one at a time, following
+		the pagination of either version of the forum
 	:param row: row from threads table
-	:return: nothing
+	:param checkpoint: (page, post_count, next_url, url, done) to resume after
+	:param conditional: stop at a page that hasn't changed since it was
+		last fetched, see scraping.fetch
+	:return: generator of (page, page url, soup, posts, next url, url) for pages
+		with posts, soup is None for pages from the new version, posts is None
+		for pages from the old version
+	:note: pages from the new version are read from the __NEXT_DATA__
+		json without building a soup, see read_new_page; raises PageError
+		if a page still fails after get_page's retries, after yielding
+		the pages before it
 	"""
-	cur = conn.cursor()
 	(thread_id, url) = row
 	next_url = url
-	post_count = 0
 	page = 0
+	if checkpoint:
+		(page, post_count, next_url, url, done) = checkpoint
+		if done:
+			return
 	while next_url:
-		page_post_count = 0
 		page += 1
-		soup = get_soup(next_url)
-		error_count = 0
-		skip_row = False
-		while is_error(soup):
-			error_count += 1
-			time.sleep(10)
-			soup = get_soup(next_url)
-			if error_count > 5:
-				print("skip next url:", next_url)
-				write_list("errors.csv", [thread_id,next_url])
-				skip_row = True
-				break
-		if not skip_row:
+		page_url = next_url
+		content = get_page(thread_id, page_url, conditional)
+		if content is None: # not modified
+			return
+		if not content:
+			raise PageError(thread_id, page_url)
+		new_page = read_new_page(content)
+		soup = None
+		if new_page is None:
+			soup = make_soup(content)
 			doctype_soup = doctype_html(soup)
-			if doctype_soup:
-				# page from new version of forum
-				error404 = soup.find("div", {"class":"error-404"})
-				faq = soup.find("meta", {"content":"Netmums FAQs"})
-				if error404:
-					break
-				if faq:
-					break
-				else:
-					if page == 1:
-						canonical_link = soup.find("link", {"rel":"canonical"})["href"]
-						if canonical_link != next_url: # redirected page
-							url = canonical_link
-					next_url = re.sub(r'.html', '-{}.html'.format(page + 1), url)
-					script = soup.find("script", {"id":"__NEXT_DATA__"})
-					try:
-						script = script.get_text()
-						script = json.loads(script)
-						posts = script["props"]["pageProps"]["initialReduxState"]["currentThread"]["currentThread"]["pagePosts"]
-					except:
-						print(soup)
-						posts = []
-						write_list("errors.csv", [thread_id,next_url])
-					for post in posts:
-						post_count += 1
-						user_url = get_user_new(cur, post)
-						date_created = get_date_new(post)
-						post_id = post["id"]
-						text = clean_text_new(cur, post["content"], thread_id, post_count, post_id)
-						citations = post["quotedPosts"]
-						for i, cite in enumerate(citations):
-							process_citation_new(cur, cite, thread_id, post_count, post_id, i + 1)
-						write_post(cur, thread_id, post_count, post_id, user_url, date_created, text, 1)
-						conn.commit()
-			elif doctype_soup is None:
+			if doctype_soup is None:
 				# no next page for new version of forum
-				next_url = False
+				break
+			if soup.find("div", {"class":"error-404"}):
+				break
+			if doctype_soup:
+				new_page = read_new_soup(soup)
+				soup = None
+		if new_page:
+			# page from new version of forum
+			if new_page["error404"] or new_page["faq"]:
+				break
+			if page == 1:
+				canonical_link = new_page["canonical"]
+				if canonical_link and canonical_link != page_url: # redirected page
+					url = canonical_link
+			next_url = re.sub(r'.html', '-{}.html'.format(page + 1), url)
+			posts = new_page["posts"]
+			if posts is None:
+				print("no posts in", page_url)
+				posts = []
+				write_list("errors.csv", [thread_id,page_url])
+		else:
+			# page from old version of forum
+			next_url = get_next_url(soup) # returns False if no next url
+			posts = None
+		yield page, page_url, soup, posts, next_url, url
+
+def fetch_thread(row, checkpoint=None):
+	""" fetch every page of a thread
+	:param row: row from threads table
+	:param checkpoint: (page, post_count, next_url, url, done) to resume after
+	:return: (list of (page, page url, soup, posts, next url, url), PageError
+		or None), the pages before the error if a page failed
+	"""
+	pages = []
+	try:
+		for page in iter_thread_pages(row, checkpoint):
+			pages.append(page)
+	except PageError as err:
+		return (pages, err)
+	return (pages, None)
+
+def replay_pages(pages, error):
+	""" the pages fetched by fetch_thread, then its error if it had one
+	:param pages: list of pages
+	:param error: PageError or None
+	:return: generator of pages, for write_thread
+	"""
+	yield from pages
+	if error:
+		raise error
+
+def write_page_new(cur, thread_id, post_count, posts):
+	""" write the posts on a page from the new version of the forum
+	:param thread_id: id of thread, linked to threads table
+	:param post_count: count of posts in thread before this page
+	:param posts: list of post json from the page
+	:return: count of posts in thread after this page
+	"""
+	contents = []
+	for post in posts:
+		contents.append(post["content"])
+		contents.extend(cite["quotedPostContent"] for cite in post["quotedPosts"])
+	cleaned = iter(clean_fragments(contents))
+	for post in posts:
+		post_count += 1
+		user_url = get_user_new(cur, post)
+		date_created = get_date_new(post)
+		post_id = post["id"]
+		(text, links) = next(cleaned)
+		for (link_count, link_text, link_url) in links:
+			write_link(cur, thread_id, post_count, post_id, link_count, link_text, link_url)
+		citations = post["quotedPosts"]
+		for i, cite in enumerate(citations):
+			(content, quote_links) = next(cleaned)
+			process_citation_new(cur, cite, thread_id, post_count, post_id, i + 1, content)
+		write_post(cur, thread_id, post_count, post_id, user_url, date_created, text, 1)
+	return post_count
+
+def write_page_old(cur, thread_id, post_count, page, soup):
+	""" write the posts on a page from the old version of the forum
+	:param thread_id: id of thread, linked to threads table
+	:param post_count: count of posts in thread before this page
+	:param page: page number in thread
+	:param soup: soup of the page
+	:return: count of posts in thread after this page
+	"""
+	page_post_count = 0
+	cases = soup.find_all("div", {"class":"md-topic_post"})
+	for case in cases:
+		page_post_count += 1
+		if page > 1 and page_post_count == 1: # skip dup posts on top of page
+			continue
+		else:
+			post_count += 1
+			user_url = get_user_old(cur, case)
+			date_created = get_date_old(case)
+			post = case.find("div", {"class": "post_content"})
+			post_id = get_post_id(post)
+			len_citations = get_citations_old(cur, post, thread_id, post_count, post_id)
+			if len_citations == 0:
+				text = get_text_no_cite(cur, post, thread_id, post_count, post_id)
 			else:
-				# page from old version of forum
-				error404 = soup.find("div", {"class":"error-404"})
-				if error404:
-					break
-				else:
-					next_url = get_next_url(soup) # returns False if no next url
-					cases = soup.find_all("div", {"class":"md-topic_post"})
-					for case in cases:
-						page_post_count += 1
-						if page > 1 and page_post_count == 1: # skip dup posts on top of page
-							continue
-						else:
-							post_count += 1
-							user_url = get_user_old(cur, case)
-							date_created = get_date_old(case)
-							post = case.find("div", {"class": "post_content"})
-							post_id = get_post_id(post)
-							len_citations = get_citations_old(cur, post, thread_id, post_count, post_id)
-							if len_citations == 0:
-								text = get_text_no_cite(cur, post, thread_id, post_count, post_id)
-							else:
-								text = get_text_cite(cur, post, thread_id, post_count, post_id)
-							write_post(cur, thread_id, post_count, post_id, user_url, date_created, text, 0)
-							conn.commit()
\ No newline at end of file
+				text = get_text_cite(cur, post, thread_id, post_count, post_id)
+			write_post(cur, thread_id, post_count, post_id, user_url, date_created, text, 0)
+	return post_count
+
+def write_thread(conn, row, pages, writer=None, checkpoint=None):
+	""" write the posts on the pages of a thread
+	:param row: row from threads table
+	:param pages: iterable of (page, page url, soup, posts, next url, url)
+	:param writer: BulkWriter on conn, if one is already open
+	:param checkpoint: (page, post_count, next_url, url, done) the pages resume after
+	:return: nothing
+	:note: rows are buffered and committed once per page, together
+		with the checkpoint of the page; if pages raises PageError, the
+		thread is left at the last page written, not done and without
+		a thread_state, and the error is raised so the next run resumes it
+	"""
+	writer = writer or BulkWriter(conn)
+	(thread_id, url) = row
+	post_count = 0
+	page = 0
+	if checkpoint:
+		(page, post_count, next_url, url, done) = checkpoint
+		if done:
+			return
+	resumed = checkpoint is not None
+	last_page = None
+	for page, page_url, soup, posts, next_url, url in pages:
+		if resumed:
+			# posts after the checkpoint are from a page being written again, see reopen_threads
+			clear_after(writer, thread_id, post_count)
+			resumed = False
+		last_page = (page_url, post_count, soup, posts)
+		if soup is None:
+			post_count = write_page_new(writer, thread_id, post_count, posts)
+		else:
+			post_count = write_page_old(writer, thread_id, post_count, page, soup)
+		write_checkpoint(writer, thread_id, page, post_count, next_url, url)
+		writer.flush()
+	write_checkpoint(writer, thread_id, page, post_count, False, url, done=1)
+	if last_page:
+		(page_url, page_start, soup, posts) = last_page
+		(page_posts, last_post_id, last_date) = get_last_post(page, soup, posts)
+		write_thread_state(writer, thread_id, page, post_count, page_url, page_start, url, last_post_id, last_date)
+	writer.flush()
+
+def get_last_post(page, soup, posts):
+	""" count the posts on a page and find the last one
+	:param page: page number in thread
+	:param soup: soup of a page from the old version of the forum, else None
+	:param posts: list of post json of a page from the new version
+	:return: (count of posts, id of last post, date of last post), the id and date are None if there are no posts
+	:note: counts posts the way write_page_new and write_page_old do
+	"""
+	if soup is None:
+		if not posts:
+			return (0, None, None)
+		return (len(posts), str(posts[-1]["id"]), get_date_new(posts[-1]))
+	cases = soup.find_all("div", {"class":"md-topic_post"})
+	if page > 1: # skip dup posts on top of page
+		cases = cases[1:]
+	if not cases:
+		return (0, None, None)
+	post = cases[-1].find("div", {"class": "post_content"})
+	return (len(cases), get_post_id(post), get_date_old(cases[-1]))
+
+def scrape_posts(conn, row):
+	""" scrape information on posts from threads table,
+		resuming after the last page written
+	:param row: row from threads table
+	:return: nothing
+	"""
+	checkpoint = load_checkpoints(conn, [row[0]]).get(row[0])
+	write_thread(conn, row, iter_thread_pages(row, checkpoint), checkpoint=checkpoint)
+
+def scrape_posts_concurrent(conn, rows, max_workers=8, raise_errors=True):
+	""" scrape posts from many threads, fetching threads
+		concurrently and writing them in the order of rows,
+		resuming each thread after the last page written
+	:param rows: rows from threads table
+	:param max_workers: number of threads fetched at once
+	:param raise_errors: raise the first PageError once the rest are written
+	:return: list of PageError of the threads that stopped, if not raised
+	:note: threads with a page that failed are left to resume
+	"""
+	writer = BulkWriter(conn)
+	checkpoints = load_checkpoints(conn, [row[0] for row in rows])
+	rows = [row for row in rows if not (row[0] in checkpoints and checkpoints[row[0]][4])]
+	def fetch(row):
+		return fetch_thread(row, checkpoints.get(row[0]))
+	errors = []
+	for row, (pages, error) in map_concurrent(fetch, rows, max_workers):
+		try:
+			write_thread(conn, row, replay_pages(pages, error), writer, checkpoints.get(row[0]))
+		except PageError as err:
+			print(err, flush=True)
+			errors.append(err)
+	if errors and raise_errors: # after the other threads are written, so a retried job only resumes these
+		raise errors[0]
+	return errors
+
+### Delta crawls
+
+def load_thread_states(conn, thread_ids):
+	""" read the state threads were last scraped in
+	:param thread_ids: ids of threads
+	:return: dictionary of thread_id: (pages, post_count, last_page_url,
+		last_page_start, url, last_post_id, last_date, listing_replies, deleted)
+	"""
+	sql = '''
+		SELECT thread_id, pages, post_count, last_page_url, last_page_start, url, last_post_id, last_date, listing_replies, deleted
+		FROM thread_state WHERE thread_id=?
+	'''
+	states = {}
+	for thread_id in thread_ids:
+		row = conn.execute(sql, (thread_id,)).fetchone()
+		if row:
+			states[row[0]] = row[1:]
+	return states
+
+def probe_thread(item, conditional=False):
+	""" fetch the last page of a thread, and the page after it,
+		to see if posts were added since it was scraped
+	:param item: (thread_id, state) with state from load_thread_states
+	:param conditional: ask for the last page only if it changed since
+		it was last fetched; unchanged, it has no new posts and no link to
+		a page after it
+	:return: True if posts were added, False if not, None if its last
+		page still fails, e.g. the thread was deleted
+	"""
+	(thread_id, state) = item
+	(pages, post_count, last_page_url, last_page_start, url, last_post_id, last_date, listing_replies, deleted) = state
+	checkpoint = (pages - 1, last_page_start, last_page_url, url, 0)
+	try:
+		for page, page_url, soup, posts, next_url, page_base in iter_thread_pages((thread_id, url), checkpoint, conditional):
+			if page > pages:
+				return True
+			(page_posts, page_last_post_id, page_last_date) = get_last_post(page, soup, posts)
+			if page_posts != post_count - last_page_start or page_last_post_id != last_post_id:
+				return True
+	except PageError:
+		return None
+	return False
+
+def find_changed_threads(conn, listing, probe=True, max_workers=8, conditional=False):
+	""" compare the threads listed in the subforum indexes with the
+		state they were last scraped in, and reopen the threads that
+		gained posts at their last page
+	:param conn: connection to the posts database
+	:param listing: list of (thread_id, url, replies), replies is None if not listed
+	:param probe: fetch the last page of threads listed without a reply count
+	:param max_workers: number of threads probed at once
+	:param conditional: probe with conditional requests, using the
+		validators of scraping.load_validators
+	:return: list of (thread_id, url) rows to scrape: new and unfinished
+		threads, and threads that changed, which resume at their last page
+	:note: threads finished before thread_state existed are scraped
+		again from page 1 if their reply count went up, and otherwise
+		left alone; the reply count of a changed thread is only kept as
+		listing_replies once it is scraped, see write_thread_state, so a
+		scrape that fails or is stopped is found again by the next delta
+	:note: a thread whose last page fails when probed is marked deleted
+		in thread_state, not scraped, and not probed again unless the
+		subforum index lists a reply count for it
+	"""
+	thread_ids = [thread_id for (thread_id, url, replies) in listing]
+	states = load_thread_states(conn, thread_ids)
+	checkpoints = load_checkpoints(conn, thread_ids)
+	rows = []
+	changed = []
+	probes = []
+	for (thread_id, url, replies) in listing:
+		state = states.get(thread_id)
+		checkpoint = checkpoints.get(thread_id)
+		if state is None:
+			if checkpoint is None or not checkpoint[4]:
+				rows.append((thread_id, url))
+			elif replies is not None and replies + 1 > checkpoint[1]:
+				clear_thread(conn, thread_id)
+				rows.append((thread_id, url))
+			continue
+		listing_replies = state[7]
+		if replies is not None and listing_replies is not None:
+			if replies != listing_replies:
+				changed.append((thread_id, url))
+		elif replies is not None:
+			if replies + 1 > state[1]:
+				changed.append((thread_id, url))
+		elif probe and not state[8]:
+			probes.append((thread_id, state))
+	deleted = []
+	for (thread_id, state), probed in map_concurrent(partial(probe_thread, conditional=conditional), probes, max_workers):
+		if probed:
+			changed.append((thread_id, state[4]))
+		elif probed is None:
+			deleted.append(thread_id)
+	conn.executemany(''' UPDATE thread_state SET deleted=1 WHERE thread_id=? ''', ((thread_id,) for thread_id in deleted))
+	reopen_threads(conn, [thread_id for (thread_id, url) in changed], states)
+	changed_ids = {thread_id for (thread_id, url) in changed}
+	listed = [(replies, thread_id) for (thread_id, url, replies) in listing if replies is not None and thread_id in states]
+	conn.executemany(''' UPDATE thread_state SET pending_replies=? WHERE thread_id=? ''',
+		(row for row in listed if row[1] in changed_ids))
+	conn.executemany(''' UPDATE thread_state SET listing_replies=?, pending_replies=NULL WHERE thread_id=? ''',
+		(row for row in listed if row[1] not in changed_ids))
+	conn.commit()
+	return rows + changed
+
+def seed_checkpoints(conn, path_merged, verbose=True):
+	""" mark the threads of the merged database as done, so a delta
+		crawl into a new posts database compares them with the subforum
+		indexes instead of scraping every one as new
+	:param conn: connection to the posts database
+	:param path_merged: merged database file, with the threads and the
+		posts merged from the netmums01 to netmums05 shards
+	:param verbose: print the number of threads marked
+	:return: number of threads marked
+	:note: safe to run before every delta, threads with a checkpoint
+		are left alone; the post count of each thread is its merged
+		post count, so find_changed_threads scrapes it again from page 1
+		if its reply count went up
+	"""
+	sql = '''
+		INSERT OR IGNORE INTO main.checkpoints(thread_id,page,post_count,next_url,url,done)
+		SELECT p.thread_id, NULL, MAX(p.post_count), NULL, t.url, 1
+		FROM merged.posts AS p
+		JOIN merged.threads AS t ON t.id = p.thread_id
+		GROUP BY p.thread_id
+	'''
+	conn.commit()
+	conn.execute(''' ATTACH DATABASE ? AS merged ''', (path_merged,))
+	try:
+		seeded = conn.execute(sql).rowcount
+		conn.commit()
+	finally:
+		conn.execute(''' DETACH DATABASE merged ''')
+	if verbose:
+		print("{} threads from {} marked done".format(seeded, path_merged), flush=True)
+	return seeded
+
+def reopen_threads(conn, thread_ids, states):
+	""" set the checkpoints of finished threads back to before their
+		last page, so it is written again with any new posts
+	:param thread_ids: ids of threads to reopen
+	:param states: dictionary of thread_id: state from load_thread_states
+	:return: nothing
+	:note: the posts of the last page stay until it is written again,
+		see write_thread
+	"""
+	for thread_id in thread_ids:
+		(pages, post_count, last_page_url, last_page_start, url, last_post_id, last_date, listing_replies, deleted) = states[thread_id]
+		write_checkpoint(conn, thread_id, pages - 1, last_page_start, last_page_url, url)
+	conn.commit()
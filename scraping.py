@@ -3,11 +3,65 @@
 
 # Contains functions for scraping
 
+import csv
+import json
+import re
 import sqlite3
+import threading
+import time
 import requests
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
-from bs4 import BeautifulSoup, NavigableString
+from bs4 import BeautifulSoup, NavigableString, FeatureNotFound
+import archive
+
+## Concurrency
+
+default_host_limit = 8 # most requests in flight at once per host
+host_limits = {}
+host_limiters = {}
+host_limiters_lock = threading.Lock()
+
+### Rate limits, see HostLimiter
+
+initial_host_rate = 2.0 # requests per second to a host before any responses
+min_host_rate = 0.1
+max_host_rate = 20.0
+rate_increase = 0.1 # requests per second added after each healthy response
+rate_decrease = 0.5 # share of the rate kept after a throttled response
+throttle_cooldown = 10 # seconds without requests to a host after it throttles, unless it sends Retry-After
+throttle_status = {429, 503}
+cloudflare_error = re.compile(rb'<h2\b[^>]*\bdata-translate\s*=\s*["\']what_happened["\']|<span\b[^>]*\bclass\s*=\s*["\'][^"\']*(?<![\w-])cf-error-code(?![\w-])', re.IGNORECASE)
+
+## HTTP client
+
+headers = {'User-Agent':'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:85.0) Gecko/20100101 Firefox/85.0'}
+try:
+	import brotli # lets urllib3 decode br responses
+	headers['Accept-Encoding'] = 'gzip, deflate, br'
+except ImportError:
+	headers['Accept-Encoding'] = 'gzip, deflate'
+session = None
+session_lock = threading.Lock()
+validators = {} # url: (etag, last modified) for conditional requests
+http_stats = {"requests": 0, "bytes": 0, "retries": 0, "not_modified": 0}
+http_stats_lock = threading.Lock()
+
+## Parsing
+
+parser_backend = "lxml" # tree builder tried before html5lib, see make_soup
+parser_stats = {} # tree builder: pages parsed, and fallbacks to html5lib
+parser_stats_lock = threading.Lock()
+balanced_tags = ["div", "span", "a", "ul", "table", "tr", "td", "form", "script"]
+open_tag = {tag: re.compile((r'<' + tag + r'[\s>/]').encode(), re.IGNORECASE) for tag in balanced_tags}
+close_tag = {tag: re.compile((r'</' + tag + r'\s*>').encode(), re.IGNORECASE) for tag in balanced_tags}
+# tags html5lib closes or adds implicitly where lxml doesn't, e.g. a <p>
+# closed by a <div> inside it, or the <tbody> of a table, so pages with
+# them are always parsed by html5lib
+implied_tags = re.compile(rb'<(?:p|li|dd|dt|option|optgroup|table|tr|td|th)[\s>/]', re.IGNORECASE)
 
 def write_list(fn, l):
 	with open(fn, 'a') as f:
@@ -33,11 +87,86 @@ def create_connection(db_file):
 		print(err)
 	return conn
 
-def requests_retry_session(retries=10, backoff_factor=.1, session=None):
+def set_bulk_pragmas(conn):
+	""" set pragmas suited to loading many rows: a write-ahead log,
+		and only syncing to disk at checkpoints
+	:param conn: database connection
+	:return: nothing
+	"""
+	cur = conn.cursor()
+	cur.execute(''' PRAGMA journal_mode=WAL ''')
+	cur.execute(''' PRAGMA synchronous=NORMAL ''')
+	cur.execute(''' PRAGMA temp_store=MEMORY ''')
+
+class BulkWriter:
+	""" buffers inserts and writes them with executemany in one
+		transaction per flush, e.g. once per page or thread
+	:note: has the execute method of a cursor, so the write_ functions
+		of both forums can be given a BulkWriter instead of a cursor
+	"""
+	def __init__(self, conn, pragmas=True):
+		self.conn = conn
+		self.buffers = {} # sql: list of rows, in the order first seen
+		self.rows = 0
+		self.flushes = 0
+		self.flush_seconds = 0
+		self.last_flush_seconds = 0
+		if pragmas:
+			set_bulk_pragmas(conn)
+
+	def execute(self, sql, parsed=()):
+		""" buffer a row to be inserted at the next flush
+		:param sql: insert statement
+		:param parsed: tuple of values
+		:return: nothing
+		"""
+		self.buffers.setdefault(sql, []).append(parsed)
+
+	def flush(self):
+		""" insert the buffered rows of every table and commit
+		:return: number of rows written
+		"""
+		start = time.perf_counter()
+		n = 0
+		try:
+			for sql, rows in self.buffers.items():
+				self.conn.executemany(sql, rows)
+				n += len(rows)
+			self.conn.commit()
+		except:
+			self.conn.rollback()
+			raise
+		finally:
+			self.buffers = {}
+		self.last_flush_seconds = time.perf_counter() - start
+		self.flush_seconds += self.last_flush_seconds
+		self.flushes += 1
+		self.rows += n
+		return n
+
+	def stats(self):
+		""" get counts of rows written and time spent flushing
+		:return: dict of rows, flushes, flush_seconds, last_flush_seconds, rows_per_sec
+		"""
+		if self.flush_seconds:
+			rows_per_sec = self.rows / self.flush_seconds
+		else:
+			rows_per_sec = 0
+		return {
+			"rows": self.rows,
+			"flushes": self.flushes,
+			"flush_seconds": self.flush_seconds,
+			"last_flush_seconds": self.last_flush_seconds,
+			"rows_per_sec": rows_per_sec,
+		}
+
+def requests_retry_session(retries=10, backoff_factor=.5, session=None, pool_connections=10, pool_maxsize=default_host_limit):
 	""" retry the request, backing off with longer rest each time
 	:param retries: number of retries
 	:param backoff_factor: each retry is longer by {backoff factor} * (2 ** ({number of total retries} - 1))
 	:param session: persist session across requests
+	:param pool_connections: number of hosts to keep connection pools for
+	:param pool_maxsize: number of keep-alive connections kept per host
 	:return session: session
 	"""
 	session = session or requests.Session()
@@ -46,22 +175,359 @@ def requests_retry_session(retries=10, backoff_factor=.1, session=None):
 		read=retries,
 		connect=retries,
 		backoff_factor=backoff_factor,
+		respect_retry_after_header=False, # 429 and 503 are left to the host's rate limiter
 	)
-	adapter = HTTPAdapter(max_retries=retry)
+	adapter = HTTPAdapter(max_retries=retry, pool_connections=pool_connections, pool_maxsize=pool_maxsize)
 	session.mount('http://', adapter)
 	session.mount('https://', adapter)
 	return session
 
-def get_soup(next_url):
-	""" get the soup from the url
+def get_session():
+	""" get the session shared by every request, creating it on first use
+	:return session: session with retries and keep-alive connection pools
+	:note: reusing one session keeps TCP/TLS connections open between pages
+	"""
+	global session
+	with session_lock:
+		if session is None:
+			session = requests_retry_session()
+			session.headers.update(headers)
+		return session
+
+def fetch(next_url, conditional=False):
+	""" request the url with the shared session
 	:param next_url: string of next url to query
-	:return soup: soup of url html
-	:note: uses html5lib and not html because missing html returns errors
+	:param conditional: send the ETag and Last-Modified from the last
+		fetch of the url, so an unchanged page returns 304
+	:return res: response or False if the request failed
 	"""
-	headers = {'User-Agent':'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:85.0) Gecko/20100101 Firefox/85.0'}
+	request_headers = {}
+	if conditional and next_url in validators:
+		(etag, last_modified) = validators[next_url]
+		if etag:
+			request_headers['If-None-Match'] = etag
+		if last_modified:
+			request_headers['If-Modified-Since'] = last_modified
+	limiter = get_host_limiter(next_url)
+	limiter.acquire()
 	try:
-		res_next = requests_retry_session().get(next_url, headers=headers)
+		res = get_session().get(next_url, headers=request_headers)
 	except:
+		limiter.release("failed")
+		return False
+	if res.status_code in throttle_status:
+		limiter.release(str(res.status_code), retry_after(res))
+	elif re.search(cloudflare_error, res.content):
+		limiter.release("cloudflare")
+	else:
+		limiter.release("ok")
+	record_response(next_url, res)
+	return res
+
+def retry_after(res):
+	""" get the seconds to wait from the Retry-After header
+	:param res: response
+	:return: seconds or None if not given in seconds
+	"""
+	value = res.headers.get("Retry-After", "")
+	if value.isdigit():
+		return int(value)
+	return None
+
+def record_response(next_url, res):
+	""" add the response to the http stats and keep its validators
+	:param next_url: url requested
+	:param res: response
+	:return: nothing
+	"""
+	retries = getattr(res.raw, "retries", None)
+	with http_stats_lock:
+		http_stats["requests"] += 1
+		http_stats["bytes"] += len(res.content)
+		if retries:
+			http_stats["retries"] += len(retries.history)
+		if res.status_code == 304:
+			http_stats["not_modified"] += 1
+		elif res.status_code == 200:
+			etag = res.headers.get("ETag")
+			last_modified = res.headers.get("Last-Modified")
+			if etag or last_modified:
+				validators[next_url] = (etag, last_modified)
+
+def get_http_stats():
+	""" get counts of requests made with the shared session
+	:return stats: dict of requests, bytes, retries, not_modified,
+		connections opened and the share of requests that reused a connection
+	"""
+	with http_stats_lock:
+		stats = dict(http_stats)
+	connections = 0
+	pool_requests = 0
+	adapters = {id(a): a for a in get_session().adapters.values()}
+	for adapter in adapters.values():
+		pools = adapter.poolmanager.pools
+		for key in pools.keys():
+			pool = pools[key]
+			connections += pool.num_connections
+			pool_requests += pool.num_requests
+	stats["connections"] = connections
+	if pool_requests:
+		stats["reuse_ratio"] = 1 - connections / pool_requests
+	else:
+		stats["reuse_ratio"] = 0
+	stats["hosts"] = get_limiter_stats()
+	return stats
+
+def save_validators(fn):
+	""" save the ETag and Last-Modified of fetched urls for the next crawl
+	:param fn: json file name
+	:return: nothing
+	"""
+	with open(fn, 'w') as f:
+		json.dump(validators, f)
+
+def load_validators(fn):
+	""" load the ETag and Last-Modified saved by an earlier crawl
+	:param fn: json file name
+	:return: nothing
+	"""
+	with open(fn) as f:
+		validators.update({url: tuple(v) for url, v in json.load(f).items()})
+
+def fetch_content(next_url, conditional=False):
+	""" get the html of the url, from the archive in replay mode,
+		else from the network, writing it through to the archive if set
+	:param next_url: string of next url to query
+	:param conditional: only get the page if it changed since it was last fetched
+	:return content: bytes of page, False on error or None if not modified
+	:note: see archive.set_archive
+	"""
+	if archive.replay:
+		content = archive.read_page(next_url)
+		if content is None:
+			return False
+		return content
+	res_next = fetch(next_url, conditional)
+	if res_next is False:
 		return False
-	soup = BeautifulSoup(res_next.content, "html5lib")
+	if res_next.status_code == 304:
+		return None
+	if archive.archive_path:
+		archive.archive_page(next_url, res_next.status_code, res_next.content)
+	return res_next.content
+
+def get_soup(next_url, conditional=False):
+	""" get the soup from the url
+	:param next_url: string of next url to query
+	:param conditional: only get the page if it changed since it was last fetched
+	:return soup: soup of url html, False on error or None if not modified
+	"""
+	content = fetch_content(next_url, conditional)
+	if not content:
+		return content
+	return make_soup(content)
+
+def set_parser(backend):
+	""" set the tree builder tried first by make_soup
+	:param backend: "lxml", "html.parser" or "html5lib" to always use html5lib
+	:return: nothing
+	"""
+	global parser_backend
+	parser_backend = backend
+
+def make_soup(content, repair=False):
+	""" parse html with the fast tree builder, falling back to
+		html5lib if the page is malformed or the builder is missing
+	:param content: bytes or string of html
+	:param repair: html is known to need html5lib, skip the fast tree builder
+	:return soup: soup of html
+	:note: html5lib repairs broken markup the way browsers do, so malformed
+		pages must use it to give the same tree as before
+	"""
+	if parser_backend != "html5lib":
+		try:
+			if not repair and not is_malformed(content):
+				soup = BeautifulSoup(content, parser_backend)
+				count_parse(parser_backend)
+				return soup
+		except FeatureNotFound:
+			pass
+		count_parse("fallback")
+	soup = BeautifulSoup(content, "html5lib")
+	count_parse("html5lib")
 	return soup
+
+def is_malformed(content):
+	""" checks if the html has unclosed or stray container tags, or
+		tags html5lib closes or adds implicitly, where the tree builders
+		could disagree on the tree
+	:param content: bytes or string of html
+	:return: bool
+	"""
+	if isinstance(content, str):
+		content = content.encode()
+	if implied_tags.search(content):
+		return True
+	for tag in balanced_tags:
+		if len(open_tag[tag].findall(content)) != len(close_tag[tag].findall(content)):
+			return True
+	return False
+
+def count_parse(backend):
+	""" add a parsed page to the parser stats
+	:param backend: tree builder used, or "fallback"
+	:return: nothing
+	"""
+	with parser_stats_lock:
+		parser_stats[backend] = parser_stats.get(backend, 0) + 1
+
+class HostLimiter:
+	""" token bucket limiting the rate and concurrency of requests to a host,
+		adjusted by additive increase and multiplicative decrease: each healthy
+		response raises the rate a little and, once per window of responses,
+		the concurrency by one; a throttled response (Cloudflare error page,
+		429 or 503) halves both and pauses the host for a cooldown; a failed
+		request (connection error or timeout) is only counted, the session's
+		retry adapter already waited between its attempts
+	"""
+	def __init__(self, max_concurrency=default_host_limit):
+		self.cond = threading.Condition()
+		self.max_concurrency = max_concurrency
+		self.concurrency = min(2, max_concurrency)
+		self.rate = initial_host_rate
+		self.tokens = 1.0
+		self.refilled = time.monotonic()
+		self.paused_until = 0
+		self.in_flight = 0
+		self.healthy = 0 # healthy responses since concurrency was last raised
+		self.counters = {"requests": 0, "ok": 0, "cloudflare": 0, "429": 0, "503": 0, "failed": 0, "waits": 0}
+		self.wait_seconds = 0
+
+	def refill(self, now):
+		self.tokens = min(self.concurrency, self.tokens + (now - self.refilled) * self.rate)
+		self.refilled = now
+
+	def acquire(self):
+		""" wait until a request can be sent to the host
+		:return: nothing
+		"""
+		start = time.monotonic()
+		with self.cond:
+			while True:
+				now = time.monotonic()
+				self.refill(now)
+				if now < self.paused_until:
+					timeout = self.paused_until - now
+				elif self.in_flight >= self.concurrency:
+					timeout = None # until a request is released
+				elif self.tokens < 1:
+					timeout = (1 - self.tokens) / self.rate
+				else:
+					break
+				self.cond.wait(timeout)
+			self.tokens -= 1
+			self.in_flight += 1
+			self.counters["requests"] += 1
+			waited = time.monotonic() - start
+			if waited > 0.001:
+				self.counters["waits"] += 1
+				self.wait_seconds += waited
+
+	def release(self, outcome, cooldown=None):
+		""" end a request and adjust the limits to its outcome
+		:param outcome: "ok", "cloudflare", "429", "503" or "failed"
+		:param cooldown: seconds to pause the host, e.g. from Retry-After
+		:return: nothing
+		:note: "failed" leaves the limits as they are, a connection error
+			says nothing about how fast the host lets us request
+		"""
+		with self.cond:
+			now = time.monotonic()
+			self.in_flight -= 1
+			self.counters[outcome] += 1
+			if outcome == "ok":
+				self.rate = min(max_host_rate, self.rate + rate_increase)
+				self.healthy += 1
+				if self.healthy >= self.concurrency:
+					self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+					self.healthy = 0
+			elif outcome == "failed":
+				pass
+			elif now >= self.paused_until:
+				# only back off once for the requests that were in flight together
+				self.refill(now)
+				self.rate = max(min_host_rate, self.rate * rate_decrease)
+				self.concurrency = max(1, int(self.concurrency * rate_decrease))
+				self.tokens = min(self.tokens, 1.0)
+				self.healthy = 0
+				self.paused_until = now + (cooldown or throttle_cooldown)
+			self.cond.notify_all()
+
+	def stats(self):
+		""" get the current limits and counts of responses
+		:return: dict of rate, concurrency, in_flight, paused seconds left,
+			wait_seconds and the counters of each outcome
+		"""
+		with self.cond:
+			stats = dict(self.counters)
+			stats["rate"] = self.rate
+			stats["concurrency"] = self.concurrency
+			stats["in_flight"] = self.in_flight
+			stats["paused"] = max(0, self.paused_until - time.monotonic())
+			stats["wait_seconds"] = self.wait_seconds
+		return stats
+
+def set_host_concurrency(host, n):
+	""" set how many requests can be in flight at once to a host
+	:param host: host name, e.g. www.netmums.com
+	:param n: maximum number of concurrent requests
+	:return: nothing
+	"""
+	with host_limiters_lock:
+		host_limits[host] = n
+		host_limiters.pop(host, None)
+
+def get_host_limiter(url):
+	""" get the rate limiter of the url's host
+	:param url: url about to be requested
+	:return: HostLimiter for the host
+	"""
+	host = urlparse(url).netloc
+	with host_limiters_lock:
+		if host not in host_limiters:
+			host_limiters[host] = HostLimiter(host_limits.get(host, default_host_limit))
+		return host_limiters[host]
+
+def get_limiter_stats():
+	""" get the limits and response counts of every host requested
+	:return: dict of host: HostLimiter.stats()
+	"""
+	with host_limiters_lock:
+		limiters = dict(host_limiters)
+	return {host: limiter.stats() for host, limiter in limiters.items()}
+
+def map_concurrent(func, items, max_workers=8):
+	""" apply func to each item on a pool of threads and yield
+		the results in the same order as the items
+	:param func: function taking one item, e.g. get_soup
+	:param items: iterable of items, e.g. urls
+	:param max_workers: number of threads
+	:return: generator of (item, result) tuples
+	:note: keeps at most 2 * max_workers items in flight so the
+		caller can write results as they arrive; results of items
+		not yet consumed are cancelled if the caller stops early
+	"""
+	with ThreadPoolExecutor(max_workers=max_workers) as executor:
+		pending = deque()
+		try:
+			for item in items:
+				pending.append((item, executor.submit(func, item)))
+				if len(pending) >= 2 * max_workers:
+					item, future = pending.popleft()
+					yield item, future.result()
+			while pending:
+				item, future = pending.popleft()
+				yield item, future.result()
+		finally:
+			for item, future in pending:
+				future.cancel()
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Contains functions for the full-text index of posts and searching it
+
+import re
+import time
+
+## SQL
+# posts_fts is an external content table: it indexes the text of posts
+# without storing a copy, and the triggers keep it up to date as the
+# writers insert, update and delete posts; netmums.set_up_posts_db and
+# youbemom.set_up_db set it up, and the merges rebuild it
+
+fts_sql = '''
+	CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts USING fts5(
+		{columns},
+		content='posts',
+		content_rowid='id',
+		tokenize='unicode61 remove_diacritics 2',
+		prefix='2 3'
+	);
+'''
+
+fts_triggers_sql = '''
+	CREATE TRIGGER IF NOT EXISTS posts_fts_insert AFTER INSERT ON posts BEGIN
+		INSERT INTO posts_fts(rowid, {columns}) VALUES (new.id, {new});
+	END;
+	CREATE TRIGGER IF NOT EXISTS posts_fts_delete AFTER DELETE ON posts BEGIN
+		INSERT INTO posts_fts(posts_fts, rowid, {columns}) VALUES ('delete', old.id, {old});
+	END;
+	CREATE TRIGGER IF NOT EXISTS posts_fts_update AFTER UPDATE OF {columns} ON posts BEGIN
+		INSERT INTO posts_fts(posts_fts, rowid, {columns}) VALUES ('delete', old.id, {old});
+		INSERT INTO posts_fts(rowid, {columns}) VALUES (new.id, {new});
+	END;
+'''
+
+drop_fts_sql = '''
+	DROP TRIGGER IF EXISTS posts_fts_insert;
+	DROP TRIGGER IF EXISTS posts_fts_delete;
+	DROP TRIGGER IF EXISTS posts_fts_update;
+	DROP TABLE IF EXISTS posts_fts;
+'''
+
+## Regex
+
+word = re.compile(r'\w+')
+
+## Functions for the index
+
+def get_fts_columns(conn):
+	""" columns of posts to index, title and body for youbemom,
+		body for netmums
+	:param conn: database connection
+	:return: list of column names
+	"""
+	columns = [row[1] for row in conn.execute(''' PRAGMA table_info(posts) ''')]
+	return [c for c in ("title", "body") if c in columns]
+
+def has_fts(conn):
+	""" check the posts have a full-text index
+	:param conn: database connection
+	:return: True if posts_fts exists
+	"""
+	sql = ''' SELECT count(name) FROM sqlite_master WHERE type='table' AND name='posts_fts' '''
+	return conn.execute(sql).fetchone()[0] > 0
+
+def drop_fts(conn):
+	""" drop the full-text index and its triggers, e.g. before
+		inserting many posts, when rebuilding afterwards is quicker
+	:param conn: database connection
+	:return: nothing
+	"""
+	conn.executescript(drop_fts_sql)
+
+def set_up_fts(conn, rebuild=False, verbose=True):
+	""" sets up the full-text index of posts
+		if the index doesn't exist, create it from the posts
+		already written, then add the triggers that keep it up to date
+	:param conn: database connection
+	:param rebuild: index the posts again even if the index exists
+	:param verbose: print the time the index took
+	:return: nothing
+	"""
+	columns = get_fts_columns(conn)
+	exists = has_fts(conn)
+	start = time.perf_counter()
+	conn.executescript(fts_sql.format(columns=", ".join(columns)))
+	if rebuild or not exists:
+		conn.execute(''' INSERT INTO posts_fts(posts_fts) VALUES('rebuild') ''')
+		if verbose:
+			print("full-text index: {:.1f}s".format(time.perf_counter() - start), flush=True)
+	conn.executescript(fts_triggers_sql.format(
+		columns=", ".join(columns),
+		new=", ".join("new." + c for c in columns),
+		old=", ".join("old." + c for c in columns),
+	))
+	conn.commit()
+
+def optimize_fts(conn):
+	""" merge the index's segments, e.g. after a crawl added many posts
+	:param conn: database connection
+	:return: nothing
+	"""
+	conn.execute(''' INSERT INTO posts_fts(posts_fts) VALUES('optimize') ''')
+	conn.commit()
+
+## Functions for queries
+
+def phrase(text, n_words=None):
+	""" a query matching the words of text in order, e.g. a quote
+	:param text: text to match
+	:param n_words: only match the first n words, e.g. of a quote cut short
+	:return: fts5 query string
+	"""
+	words = word.findall(text)
+	if n_words:
+		words = words[:n_words]
+	return '"{}"'.format(" ".join(words))
+
+def prefix(text):
+	""" a query matching words starting with each word of text
+	:param text: start of words, e.g. "mum" for mum, mums and mummy
+	:return: fts5 query string
+	"""
+	return " ".join('"{}"*'.format(w) for w in word.findall(text))
+
+def keywords(words, any_word=True):
+	""" a query matching posts with any or all of the words
+	:param words: list of words or phrases
+	:param any_word: match posts with any of the words, else all of them
+	:return: fts5 query string
+	"""
+	joiner = " OR " if any_word else " AND "
+	return joiner.join(phrase(w) for w in words)
+
+def search(conn, query, columns="p.*", where="", params=(), limit=None):
+	""" find the posts matching a full-text query, best matches first
+	:param conn: database connection
+	:param query: fts5 query, e.g. from phrase, prefix or keywords,
+		or written by hand, e.g. 'body: "sent from my" NOT netmums'
+	:param columns: columns of posts p to return
+	:param where: more conditions on posts p, e.g. "p.subforum=?"
+	:param params: values of the parameters in where
+	:param limit: most posts to return, all if None
+	:return: list of rows
+	"""
+	sql = '''
+		SELECT {}
+		FROM posts_fts
+		JOIN posts AS p ON p.id = posts_fts.rowid
+		WHERE posts_fts MATCH ? {}
+		ORDER BY posts_fts.rank
+	'''.format(columns, "AND " + where if where else "")
+	params = (query,) + tuple(params)
+	if limit is not None:
+		sql += " LIMIT ?"
+		params += (limit,)
+	return conn.execute(sql, params).fetchall()
+
+def count(conn, query):
+	""" count the posts matching a full-text query, e.g. for spam keywords
+	:param conn: database connection
+	:param query: fts5 query
+	:return: number of posts
+	"""
+	sql = ''' SELECT COUNT(*) FROM posts_fts WHERE posts_fts MATCH ? '''
+	return conn.execute(sql, (query,)).fetchone()[0]
+
+def snippets(conn, query, limit=20, tokens=12):
+	""" the text around the matches of a full-text query
+	:param conn: database connection
+	:param query: fts5 query
+	:param limit: most posts to return
+	:param tokens: words in each snippet
+	:return: list of (post id, snippet)
+	"""
+	sql = '''
+		SELECT rowid, snippet(posts_fts, -1, '[', ']', '...', ?)
+		FROM posts_fts
+		WHERE posts_fts MATCH ?
+		ORDER BY rank
+		LIMIT ?
+	'''
+	return conn.execute(sql, (tokens, query, limit)).fetchall()
+
+def find_quoted_posts(conn, thread_id, quoted_text, post_count, n_words=12):
+	""" find the netmums posts a quote could be from: earlier posts
+		in the same thread containing the start of the quote
+	:param conn: database connection
+	:param thread_id: id of thread of the quoting post
+	:param quoted_text: text of the quote
+	:param post_count: count of the quoting post in the thread
+	:param n_words: words of the quote to match
+	:return: list of (thread_id, post_count, body)
+	"""
+	query = phrase(quoted_text, n_words)
+	if query == '""':
+		return []
+	return search(conn, query, "p.thread_id, p.post_count, p.body",
+		"p.thread_id=? AND p.post_count<?", (thread_id, post_count))
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Contains functions for marking spam words in posts, in one pass over each text
+
+import csv
+import itertools
+import re
+import pandas as pd
+try:
+	import ahocorasick
+except ImportError:
+	ahocorasick = None
+
+## Spam rules
+# (pattern, column name or None to name it by the pattern, ignore case),
+# added after the words of spam_words.csv, as in add_spam_dummies of
+# notebook 1.2
+
+spam_rules = [
+	(r'\[url', "bracket_url", True),
+	(r'^Http', "Http", False),
+	(r's\.t\.r\.e\.a\.m', "s.t.r.e.a.m", True),
+	(r'''\bdd['s]*\b''', "has_dd", False),
+	(r'''\bdh['s]*\b''', "has_dh", False),
+	(r'''\bds['s]*\b''', "has_ds", False),
+]
+
+# letters that match i when ignoring case, but don't casefold to it
+dotted_i = {0x130: "i", 0x131: "i"}
+
+## Functions
+
+def read_spam_words(path):
+	""" read the spam words, one regex pattern per row
+	:param path: spam_words.csv, with a words column
+	:return: list of patterns
+	"""
+	with open(path, newline="", encoding="utf-8") as f:
+		return [row["words"] for row in csv.DictReader(f)]
+
+def get_spam_rules(words):
+	""" the rules of the spam dummies, the spam words then spam_rules
+	:param words: list of spam word patterns, from read_spam_words
+	:return: list of (pattern, column name, ignore case)
+	"""
+	return [(w, w, True) for w in words] + [(p, name or p, ignorecase) for (p, name, ignorecase) in spam_rules]
+
+def get_anchor(pattern):
+	""" the longest run of plain characters every match of pattern
+		must contain, e.g. "problem" for problem.solution
+	:param pattern: regex pattern
+	:return: the run, casefolded, or "" if there is none, e.g. for a|b
+	"""
+	runs = [""]
+	depth = 0
+	i = 0
+	while i < len(pattern):
+		c = pattern[i]
+		if c == "\\":
+			nxt = pattern[i + 1:i + 2]
+			if depth == 0 and nxt and not nxt.isalnum():
+				runs[-1] += nxt
+			else: # classes like \b and \d, or inside a group
+				runs.append("")
+			i += 2
+			continue
+		if c in "([":
+			depth += 1
+			runs.append("")
+		elif c in ")]":
+			depth -= 1
+			runs.append("")
+		elif depth > 0:
+			pass
+		elif c == "|":
+			return ""
+		elif c in "*?{":
+			# the character before is optional
+			runs[-1] = runs[-1][:-1]
+			runs.append("")
+			if c == "{":
+				i = pattern.find("}", i)
+				if i < 0:
+					return ""
+		elif c in ".^$+":
+			runs.append("")
+		else:
+			runs[-1] += c
+		i += 1
+	return max(runs, key=len).casefold()
+
+class SpamMatcher:
+	""" finds every spam rule in a text at once: the texts are searched
+		for the plain anchor of each rule in one pass, with Aho-Corasick if
+		pyahocorasick is installed, and only the rules whose anchor was
+		found are checked with their regex
+	:note: gives the same columns as calling has_word once per rule
+	"""
+	def __init__(self, rules):
+		rules_by_name = {} # a repeated name replaces the rule, as it would the column
+		for (pattern, name, ignorecase) in rules:
+			if ignorecase:
+				rules_by_name[name] = re.compile(pattern.lower(), flags=re.IGNORECASE)
+			else:
+				rules_by_name[name] = re.compile(pattern)
+		self.names = list(rules_by_name)
+		self.patterns = list(rules_by_name.values())
+		self.unanchored = [] # rules checked on every text
+		self.anchors = {} # anchor: list of rules
+		for i, compiled in enumerate(self.patterns):
+			anchor = get_anchor(compiled.pattern)
+			if anchor:
+				self.anchors.setdefault(anchor, []).append(i)
+			else:
+				self.unanchored.append(i)
+		self.automaton = None
+		if ahocorasick and self.anchors:
+			self.automaton = ahocorasick.Automaton()
+			for (anchor, rule_ids) in self.anchors.items():
+				self.automaton.add_word(anchor, rule_ids)
+			self.automaton.make_automaton()
+
+	def candidates(self, text):
+		""" the rules whose anchor is in the text
+		:param text: text of post
+		:return: iterable of lists of rule indexes, may repeat
+		"""
+		folded = text.translate(dotted_i).casefold()
+		if self.automaton:
+			return (rule_ids for (_, rule_ids) in self.automaton.iter(folded))
+		return (rule_ids for (anchor, rule_ids) in self.anchors.items() if anchor in folded)
+
+	def match(self, text):
+		""" check a text for every rule
+		:param text: text of post
+		:return: list of True/False per rule, None if text is not a string
+		"""
+		if not isinstance(text, str):
+			return None
+		matches = [False] * len(self.names)
+		checked = set()
+		for rule_ids in itertools.chain((self.unanchored,), self.candidates(text)):
+			for i in rule_ids:
+				if i not in checked:
+					checked.add(i)
+					matches[i] = self.patterns[i].search(text) is not None
+		return matches
+
+	def add_columns(self, df, column="text"):
+		""" add a column per rule of whether the text matches it
+		:param df: data frame
+		:param column: column of text
+		:return df: data frame with the rule columns
+		:note: texts that are missing get what str.contains gives them,
+			NaN in the pandas the notebooks were written with
+		"""
+		texts = df[column]
+		missing = pd.Series([None], dtype=texts.dtype).str.contains("a").iloc[0]
+		no_match = [missing] * len(self.names)
+		results = [self.match(text) or no_match for text in texts]
+		columns = zip(*results) if results else [()] * len(self.names)
+		for (name, values) in zip(self.names, columns):
+			df[name] = list(values)
+		return df
+
+def add_spam_dummies(df, words, column="text"):
+	""" add the spam word columns of notebook 1.2 to a data frame
+	:param df: data frame
+	:param words: list of spam word patterns, from read_spam_words
+	:param column: column of text
+	:return df: data frame with the spam columns
+	:note: builds the matcher each call; keep a SpamMatcher to reuse it over chunks
+	"""
+	return SpamMatcher(get_spam_rules(words)).add_columns(df, column)
@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Contains functions for running a processing stage over a table in
+# chunks on a pool of processes, writing the results to another table
+
+import hashlib
+import inspect
+import json
+import multiprocessing
+import sqlite3
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import pandas as pd
+from scraping import create_connection, set_bulk_pragmas
+
+## SQL
+
+# how far each stage has got through its source table, and a hash of the
+# rules its rows were written with
+stage_state_sql = '''
+	CREATE TABLE IF NOT EXISTS stage_state (
+		name TEXT PRIMARY KEY,
+		source TEXT,
+		target TEXT,
+		watermark INTEGER,
+		rules_hash TEXT,
+		rows_read INTEGER,
+		rows_written INTEGER,
+		updated TEXT
+	);
+'''
+
+## Stage settings
+
+chunk_rows = 50000 # rowids per chunk
+report_every = 30 # seconds between throughput reports
+
+## Connections of the worker processes, one per database file
+
+worker_conns = {}
+
+## Functions
+
+def set_up_stage_state(conn):
+	""" sets up the stage_state table
+	:param conn: database connection
+	:return: nothing
+	"""
+	conn.executescript(stage_state_sql)
+
+def get_stage_state(conn, name):
+	""" read how far a stage has got
+	:param conn: database connection
+	:param name: name of stage
+	:return: (watermark, rules hash), or None if the stage hasn't run
+	"""
+	set_up_stage_state(conn)
+	return conn.execute(''' SELECT watermark, rules_hash FROM stage_state WHERE name=? ''', (name,)).fetchone()
+
+def set_stage_state(conn, name, source, target, watermark, rules_hash, rows_read, rows_written):
+	""" record how far a stage has got, without committing, so the
+		state is committed with the rows it covers
+	:param conn: database connection
+	:param name: name of stage
+	:param source: table read
+	:param target: table written
+	:param watermark: last rowid of source read
+	:param rules_hash: from get_rules_hash
+	:param rows_read: rows read since the last call, added to the total
+	:param rows_written: rows written since the last call, added to the total
+	:return: nothing
+	"""
+	conn.execute('''
+		INSERT OR REPLACE INTO stage_state (name, source, target, watermark, rules_hash, rows_read, rows_written, updated)
+		VALUES (?, ?, ?, ?, ?,
+			COALESCE((SELECT rows_read FROM stage_state WHERE name=?), 0) + ?,
+			COALESCE((SELECT rows_written FROM stage_state WHERE name=?), 0) + ?,
+			datetime('now'))
+	''', (name, source, target, watermark, rules_hash, name, rows_read, name, rows_written))
+
+def reset_stages(conn):
+	""" forget how far every stage has got, e.g. after the source tables
+		were dropped and written again with new rowids, so the next run of
+		each stage rebuilds its table
+	:param conn: database connection
+	:return: nothing
+	"""
+	conn.execute(''' DROP TABLE IF EXISTS stage_state ''')
+	conn.commit()
+
+def get_code_names(code):
+	""" global names a function's code uses, with those of the
+		comprehensions and functions defined in it
+	:param code: code object
+	:return: set of names
+	"""
+	names = set(code.co_names)
+	for const in code.co_consts:
+		if inspect.iscode(const):
+			names |= get_code_names(const)
+	return names
+
+def get_dependencies(func):
+	""" modules of this repository a function depends on: its own, and
+		those of the functions, classes and modules it uses, and they use
+	:param func: function defined in a module of this repository
+	:return: list of modules, sorted by name
+	"""
+	root = Path(inspect.getfile(func)).resolve().parent
+	modules = {}
+	seen = set()
+	stack = [func]
+	while stack:
+		obj = stack.pop()
+		if id(obj) in seen:
+			continue
+		seen.add(id(obj))
+		module = obj if inspect.ismodule(obj) else inspect.getmodule(obj)
+		path = getattr(module, "__file__", None)
+		if not path or Path(path).resolve().parent != root: # e.g. pandas
+			continue
+		modules[module.__name__] = module
+		if inspect.isclass(obj):
+			stack.extend(value for value in vars(obj).values() if inspect.isfunction(value))
+		elif inspect.isfunction(obj):
+			for name in get_code_names(obj.__code__):
+				value = obj.__globals__.get(name)
+				if inspect.isfunction(value) or inspect.isclass(value) or inspect.ismodule(value):
+					stack.append(value)
+	return [modules[name] for name in sorted(modules)]
+
+def get_rules_hash(sql, func, rules):
+	""" hash of what a stage's rows depend on besides the source rows
+	:param sql: select of the stage
+	:param func: function of the stage; the source of its module and of
+		the modules it depends on is hashed, see get_dependencies, so
+		editing e.g. probable_spam in clean.py or the SpamMatcher of
+		spam.py changes the hash
+	:param rules: anything json can write, e.g. the spam words
+	:return: hex digest
+	"""
+	parts = [sql, "{}.{}".format(func.__module__, func.__qualname__)]
+	for module in get_dependencies(func):
+		parts.extend([module.__name__, inspect.getsource(module)])
+	parts.append(json.dumps(rules, sort_keys=True, default=str))
+	return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+
+def get_rowid_chunks(conn, table, size=None, after=None):
+	""" split a table into ranges of rowids
+	:param conn: database connection
+	:param table: name of table
+	:param size: rowids per range, chunk_rows if None
+	:param after: only the rowids after this one, every rowid if None
+	:return: list of (first rowid, last rowid)
+	"""
+	size = size or chunk_rows
+	sql = ''' SELECT MIN(rowid), MAX(rowid) FROM {} WHERE rowid > ? '''.format(table)
+	(first, last) = conn.execute(sql, (-1 if after is None else after,)).fetchone()
+	if first is None:
+		return []
+	return [(lo, min(lo + size - 1, last)) for lo in range(first, last + 1, size)]
+
+def get_worker_conn(path_db):
+	""" a read connection for this process, opened on first use
+	:param path_db: database file
+	:return: database connection
+	"""
+	if path_db not in worker_conns:
+		worker_conns[path_db] = sqlite3.connect(path_db, timeout=60)
+	return worker_conns[path_db]
+
+def run_chunk(path_db, sql, chunk, func, args):
+	""" read a chunk of rows and apply the stage to it, in a worker process
+	:param path_db: database file
+	:param sql: select with two parameters, the first and last rowid of the chunk
+	:param chunk: (first rowid, last rowid)
+	:param func: function taking a data frame and args, returning a data frame;
+		defined in a module, so the worker can import it
+	:param args: more arguments of func
+	:return: (rows read, data frame to write)
+	"""
+	df = pd.read_sql_query(sql, get_worker_conn(path_db), params=chunk)
+	rows = len(df)
+	return (rows, func(df, *args))
+
+def write_rows(conn, target, df):
+	""" insert the rows of a data frame into a table, creating it from the
+		data frame's columns if it doesn't exist, without committing
+	:param conn: database connection
+	:param target: name of table
+	:param df: data frame
+	:return: nothing
+	:note: unlike to_sql, leaves the transaction open, so the rows and the
+		stage's watermark are committed together
+	"""
+	sql = ''' SELECT count(name) FROM sqlite_master WHERE type='table' AND name=? '''
+	if conn.execute(sql, (target,)).fetchone()[0] == 0:
+		df.head(0).to_sql(target, conn, index=False)
+	if df.empty:
+		return
+	columns = ", ".join('"{}"'.format(c) for c in df.columns)
+	marks = ", ".join("?" for c in df.columns)
+	rows = df.astype(object).where(df.notna(), None).itertuples(index=False, name=None)
+	conn.executemany(''' INSERT INTO "{}" ({}) VALUES ({}) '''.format(target, columns, marks), rows)
+
+def map_processes(func, items, max_workers):
+	""" apply func to each item on a pool of processes and yield
+		the results in the same order as the items
+	:param func: function taking one item, defined in a module
+	:param items: iterable of items
+	:param max_workers: number of processes
+	:return: generator of (item, result) tuples
+	:note: as scraping.map_concurrent, keeps at most 2 * max_workers
+		items in flight so results are written as they arrive
+	"""
+	context = multiprocessing.get_context("spawn")
+	with ProcessPoolExecutor(max_workers=max_workers, mp_context=context) as executor:
+		pending = deque()
+		try:
+			for item in items:
+				pending.append((item, executor.submit(func, *item)))
+				if len(pending) >= 2 * max_workers:
+					item, future = pending.popleft()
+					yield item, future.result()
+			while pending:
+				item, future = pending.popleft()
+				yield item, future.result()
+		finally:
+			for item, future in pending:
+				future.cancel()
+
+def print_throughput(name, done, total, rows_read, rows_written, started):
+	""" print how far a stage has got and how quickly
+	:param name: name of stage
+	:param done: chunks written
+	:param total: chunks in the stage
+	:param rows_read: rows read so far
+	:param rows_written: rows written so far
+	:param started: time.perf_counter() when the stage started
+	:return: nothing
+	"""
+	elapsed = time.perf_counter() - started
+	rate = rows_read / elapsed if elapsed else 0
+	left = (total - done) * elapsed / done if done else 0
+	print("{}: {}/{} chunks, {} rows read, {} written, {:.0f} rows/s, {:.0f}s elapsed, {:.0f}s left".format(
+		name, done, total, rows_read, rows_written, rate, elapsed, left), flush=True)
+
+def run_stage(path_db, source, sql, target, func, args=(), workers=None, size=None, name=None, rules=None, rebuild=False):
+	""" run a stage over a table: read it in chunks of rowids, apply
+		func to the chunks on a pool of processes, and write the results
+		to the target table in the order of the chunks
+		if the stage has run before with the same rules, only the rows
+		of source after its watermark, the last rowid it read, are read
+		and their results appended; otherwise the target is rebuilt
+	:param path_db: database file
+	:param source: table read, chunked by its rowid
+	:param sql: select from source, with "rowid BETWEEN ? AND ?" for the chunk
+	:param target: table written
+	:param func: function taking a data frame and args, returning a data frame,
+		e.g. clean.clean_youbemom; defined in a module, so the workers can import it
+	:param args: more arguments of func, e.g. the spam words
+	:param workers: number of processes, the number of cores if None
+	:param size: rowids per chunk, chunk_rows if None
+	:param name: name of stage in stage_state and the reports, the target if None
+	:param rules: what else the results depend on, e.g. the spam rules, args if None
+	:param rebuild: rebuild the target even if the rules haven't changed
+	:return: (rows read, rows written)
+	:note: rows of source changed or deleted below the watermark are not
+		read again; rebuild, or reset_stages after writing source again
+	"""
+	name = name or target
+	rules_hash = get_rules_hash(sql, func, args if rules is None else rules)
+	conn = create_connection(path_db)
+	set_bulk_pragmas(conn) # a write-ahead log, so the workers can read while the writer writes
+	state = get_stage_state(conn, name)
+	last = conn.execute(''' SELECT MAX(rowid) FROM {} '''.format(source)).fetchone()[0]
+	if rebuild:
+		reason = "rebuild asked for"
+	elif state is None:
+		reason = "first run"
+	elif state[1] != rules_hash:
+		reason = "rules changed"
+	elif last is not None and last < state[0]:
+		reason = "{} was written again".format(source)
+	else:
+		reason = None
+	if reason:
+		print("{}: rebuilding, {}".format(name, reason), flush=True)
+		conn.execute(''' DROP TABLE IF EXISTS {} '''.format(target))
+		# forget this stage, and the stages reading its target, whose rows follow its rowids
+		conn.execute(''' DELETE FROM stage_state WHERE name=? OR source=? ''', (name, target))
+		conn.commit()
+		watermark = None
+	else:
+		watermark = state[0]
+	chunks = get_rowid_chunks(conn, source, size, watermark)
+	if not chunks:
+		print("{}: up to date at rowid {}".format(name, watermark), flush=True)
+		conn.close()
+		return (0, 0)
+	workers = min(workers or multiprocessing.cpu_count(), len(chunks))
+	started = time.perf_counter()
+	last_report = started
+	rows_read = 0
+	rows_written = 0
+	tasks = ((path_db, sql, chunk, func, args) for chunk in chunks)
+	if workers == 1: # e.g. a daily refresh, quicker without starting a pool
+		results = ((task, run_chunk(*task)) for task in tasks)
+	else:
+		results = map_processes(run_chunk, tasks, workers)
+	for i, (task, (rows, df)) in enumerate(results):
+		write_rows(conn, target, df)
+		set_stage_state(conn, name, source, target, task[2][1], rules_hash, rows, len(df))
+		conn.commit()
+		rows_read += rows
+		rows_written += len(df)
+		if time.perf_counter() - last_report > report_every or i + 1 == len(chunks):
+			print_throughput(name, i + 1, len(chunks), rows_read, rows_written, started)
+			last_report = time.perf_counter()
+	conn.close()
+	return (rows_read, rows_written)
@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+## Imports
+
+from jobs import connect_jobs, add_range_jobs, run_pool
+from pathlib import Path
+
+## File Locations
+
+p = Path.cwd()
+path_parent = p.parents[0]
+path_jobs = str(path_parent / "database" / "youbemom-jobs.db")
+path_db = str(path_parent / "database" / "youbemomTables-{:02d}.db")
+
+## Queue permalink ranges, skipping ranges already queued
+
+earliest_link = 6987340 # start 2014/01/01: 6987340
+last_link = 11043529 # first post in 2021/01/01: 11043529
+size = 81124 # permalinks per job, each scraped into its own database
+sparse = False # only fetch permalinks that could be thread roots, see youbemom.SparseWalk
+
+if __name__ == "__main__":
+    conn = connect_jobs(path_jobs)
+    print("{} jobs added".format(add_range_jobs(conn, earliest_link, last_link, size)))
+    conn.close()
+
+## Scrape permalinks, each range into its own database
+
+    run_pool(path_jobs, path_db, "youbemom", workers=10, batch=1, options={"sparse": sparse})
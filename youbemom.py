@@ -10,6 +10,12 @@ from datetime import datetime, timedelta
 from bs4 import BeautifulSoup
 from dateutil.parser import parse
 from scraping import *
+from search import set_up_fts
+
+# For skipping permalinks in sparse mode, see SparseWalk
+
+dne_run = 50 # missing posts in a row before probing ahead
+max_stride = 64 # most permalinks skipped between probes
 
 # ## Functions
 # For accessing the database
@@ -19,6 +25,7 @@ def set_up_db(conn):
         SQLite database for the results
     :param conn: database connection
     :return: nothing
+    :note: also sets up the full-text index of posts, see search.set_up_fts
     """
     cur = conn.cursor()
     cur.executescript('''
@@ -42,29 +49,28 @@ def set_up_db(conn):
             deleted INTEGER
         );
     ''')
+    set_up_fts(conn, verbose=False)
 
 def write_to_threads(conn, family_id, url, subforum, dne):
     """ inserts the parsed data into the threads table
+    :param conn: connection or BulkWriter, committed by the caller
     :param parsed: a tuple of the parsed data
     :return: nothing
     """
     sql = ''' INSERT INTO threads(family_id, url, subforum, dne)
     VALUES(?,?,?,?) '''
     parsed = (family_id, url, subforum, dne)
-    cur = conn.cursor()
-    cur.execute(sql, parsed)
-    conn.commit()
+    conn.execute(sql, parsed)
 
 def write_to_posts(parsed, conn):
     """ inserts the parsed data into the posts table
     :param parsed: a tuple of the parsed data
+    :param conn: connection or BulkWriter, committed by the caller
     :return: nothing
     """
     sql = ''' INSERT INTO posts(family_id,message_id,parent_id,date_recorded,date_created,title,body,subforum,deleted)
     VALUES(?,?,?,?,?,?,?,?,?) '''
-    cur = conn.cursor()
-    cur.execute(sql, parsed)
-    conn.commit()
+    conn.execute(sql, parsed)
 
 # For parsing post text
 
@@ -215,18 +221,89 @@ def parse_post_child(soup, conn, family_id, parent_id, date_recorded, subforum):
     return message_id
 
 def search_children(children, conn, family_id, parent_id, date_recorded, subforum):
+    """ parse the replies to a post and their replies
+    :return message_ids: list of message ids of the replies
+    """
+    message_ids = []
     for child in children:
         message_id = parse_post_child(child, conn, family_id, parent_id, date_recorded, subforum)
+        message_ids.append(message_id)
         replies = child.find('ul')
         if replies:
             grandchildren = replies.find_all("li", recursive=False)
-            search_children(grandchildren, conn, family_id, message_id, date_recorded, subforum)
+            message_ids.extend(search_children(grandchildren, conn, family_id, message_id, date_recorded, subforum))
+    return message_ids
 
 
 # For looping through the forum
 
-def loop_link_threads(conn, path_db, earliest_link, last_link):
-    forum_url = "https://www.youbemom.com/forum/permalink/"
+def get_permalink_soup(permalink):
+    """ get the soup of a permalink page
+    :param permalink: int of permalink number
+    :return soup: soup of page or False on error
+    """
+    return get_soup("https://www.youbemom.com/forum/permalink/" + str(permalink))
+
+class SparseWalk:
+    """ walks the permalinks from first to last, skipping permalinks
+        already scraped as replies, and probing ahead with a doubling
+        stride after dne_run missing posts in a row
+    :note: the walk is read ahead of the pages being written, so it
+           follows report() with a lag of the permalinks in flight
+    """
+    def __init__(self, first, last, seen):
+        self.next = first
+        self.last = last
+        self.seen = seen # message ids already scraped
+        self.missing = 0
+        self.stride = 1
+        self.skipped = {} # permalink: dne code written to threads
+
+    def __iter__(self):
+        while self.next < self.last:
+            permalink = self.next
+            if permalink in self.seen:
+                self.skipped[permalink] = 2
+                self.next += 1
+                continue
+            yield permalink
+            self.next = min(permalink + self.stride, self.last)
+            for skip in range(permalink + 1, self.next):
+                self.skipped[skip] = 2 if skip in self.seen else 3
+
+    def report(self, dne, message_ids):
+        """ adjust the stride to the page of a permalink
+        :param dne: 1 if the post does not exist
+        :param message_ids: message ids scraped from the page
+        """
+        self.seen.update(int(message_id) for message_id in message_ids if message_id.isdigit())
+        if dne == 1:
+            self.missing += 1
+            if self.missing >= dne_run:
+                self.stride = min(max_stride, self.stride * 2)
+        else:
+            self.missing = 0
+            self.stride = 1
+
+def get_seen_ids(conn):
+    """ get the message ids already in posts
+    :return: set of message ids as int
+    """
+    cur = conn.cursor()
+    cur.execute(""" SELECT message_id FROM posts """)
+    return {int(row[0]) for row in cur.fetchall() if str(row[0]).isdigit()}
+
+def loop_link_threads(conn, path_db, earliest_link, last_link, max_workers=8, sparse=False):
+    """ scrape every permalink from earliest_link to last_link,
+        restarting after the largest family_id already in threads
+    :param max_workers: number of permalinks fetched at once
+    :param sparse: only fetch permalinks that could be thread roots, see SparseWalk
+    :note: pages are fetched concurrently but written in permalink order,
+           rows are committed once per permalink
+    :note: in sparse mode each skipped permalink is still written to threads,
+           with dne 2 if it was scraped as a reply or dne 3 if it was skipped
+           in a run of missing posts, so family ids stay one per permalink
+    """
     sql = """ SELECT MAX(family_id) FROM threads """
     cur = conn.cursor()
     cur.execute(sql)
@@ -235,50 +312,99 @@ def loop_link_threads(conn, path_db, earliest_link, last_link):
         next_id = int(max_id) + 1
     else:
         next_id = 1
-    for post_num in range(earliest_link + next_id - 1, last_link):
-        next_url = forum_url + str(post_num)
-        soup = get_soup(next_url)
+    writer = BulkWriter(conn)
+    first_link = earliest_link + next_id - 1
+    if sparse:
+        permalinks = SparseWalk(first_link, last_link, get_seen_ids(conn))
+    else:
+        permalinks = range(first_link, last_link)
+    for post_num, soup in map_concurrent(get_permalink_soup, permalinks, max_workers):
+        if sparse:
+            write_skipped(writer, permalinks, earliest_link, next_id, post_num)
+        next_id = post_num - earliest_link + 1
         if soup:
             url = "/forum/permalink/" + str(post_num)
             dne = post_dne(soup)
+            message_ids = []
             if dne == 1:
-                write_to_threads(conn, next_id, url, "none", dne)
+                write_to_threads(writer, next_id, url, "none", dne)
             else:
                 subforum = get_subforum(soup)
                 if subforum:
-                    write_to_threads(conn, next_id, url, subforum, dne)
-                    parse_link(conn, path_db, subforum, next_id, url)
+                    write_to_threads(writer, next_id, url, subforum, dne)
+                    message_ids = parse_link(writer, path_db, subforum, next_id, url, soup)
+            if sparse:
+                permalinks.report(dne, message_ids)
+            writer.flush()
         next_id += 1
+    if sparse:
+        write_skipped(writer, permalinks, earliest_link, next_id, last_link)
+        writer.flush()
     return
 
-def parse_link(conn, path_db, subforum, family_id, url):
+def write_skipped(writer, walk, earliest_link, next_id, permalink):
+    """ write the permalinks a sparse walk skipped before a permalink
+    :param walk: SparseWalk
+    :param next_id: family id of the first permalink not yet written
+    :param permalink: permalink to write up to, not included
+    """
+    for skip in range(earliest_link + next_id - 1, permalink):
+        url = "/forum/permalink/" + str(skip)
+        write_to_threads(writer, skip - earliest_link + 1, url, "none", walk.skipped.pop(skip))
+
+def parse_link(conn, path_db, subforum, family_id, url, soup=None):
+    """ parse the thread on a permalink page
+    :param conn: connection or BulkWriter, committed by the caller
+    :param soup: soup of the page if already fetched, else it is fetched
+    :return message_ids: list of message ids of the posts on the page
+    """
     date_recorded = datetime.now().strftime("%m-%d-%Y %H:%M:%S")
     if 'https://www.youbemom.com' not in url or 'http://www.youbemom.com' not in url:
         url = 'https://www.youbemom.com' + url
-    soup = get_soup(url)
+    if soup is None:
+        soup = get_soup(url)
+    message_ids = []
     if soup:
         message_id = parse_post_parent(soup, conn, family_id, date_recorded, subforum)
+        message_ids.append(message_id)
         replies = soup.find('ul', {'id' : 'reply-list'})
         if replies:
             children = replies.find_all('li', recursive=False)
-            search_children(children, conn, family_id, message_id, date_recorded, subforum)
-    return
+            message_ids.extend(search_children(children, conn, family_id, message_id, date_recorded, subforum))
+    return message_ids
+
+def get_earliest_link(conn):
+    """ get the permalink family id 1 was scraped from, so that the
+        permalink of a family id is earliest_link + family_id - 1
+    :return earliest_link: int of permalink number or None if no threads
+    """
+    sql = """ SELECT family_id, url FROM threads WHERE family_id IS NOT NULL ORDER BY family_id LIMIT 1 """
+    cur = conn.cursor()
+    cur.execute(sql)
+    row = cur.fetchone()
+    if row:
+        (family_id, url) = row
+        return int(url.rsplit("/", 1)[1]) - int(family_id) + 1
+    return None
 
-def loop_list_links(conn, path_db, missing_ids, min_permalink):
-    forum_url = "https://www.youbemom.com/forum/permalink/"
-    for missing_id in missing_ids:
-        permalink = min_permalink + missing_id - 1
-        next_url = forum_url + str(permalink)
-        print("getting {}".format(next_url))
-        soup = get_soup(next_url)
+def loop_list_links(conn, path_db, missing_ids, min_permalink, max_workers=8):
+    """ scrape the permalinks of a list of missing family ids
+    :param max_workers: number of permalinks fetched at once
+    """
+    writer = BulkWriter(conn)
+    permalinks = (min_permalink + missing_id - 1 for missing_id in missing_ids)
+    pages = map_concurrent(get_permalink_soup, permalinks, max_workers)
+    for missing_id, (permalink, soup) in zip(missing_ids, pages):
+        print("getting /forum/permalink/{}".format(permalink))
         if soup:
             url = "/forum/permalink/" + str(permalink)
             dne = post_dne(soup)
             if dne == 1:
-                write_to_threads(conn, missing_id, url, "none", dne)
+                write_to_threads(writer, missing_id, url, "none", dne)
             else:
                 subforum = get_subforum(soup)
                 if subforum:
-                    write_to_threads(conn, missing_id, url, subforum, dne)
-                    parse_link(conn, path_db, subforum, missing_id, url)
+                    write_to_threads(writer, missing_id, url, subforum, dne)
+                    parse_link(writer, path_db, subforum, missing_id, url, soup)
+            writer.flush()
     return